@@ -1,10 +1,109 @@
+import io
 import os
+import time
+import pstats
 import shutil
-from flask import Flask, render_template, request,redirect
-from mutator import FileHandler, Mutator, MidiMaker
+import secrets
+import cProfile
+from flask import Flask, render_template, request,redirect, send_file, abort, g, Response
+from melody import Melody
+from mutator import FileHandler, Mutator, MidiMaker, CANDIDATES_REJECTED
+from pregeneration import CandidatePregenerator
+from scheduler import MutationScheduler
+from audio import AudioRenderer
+import cache
+import fitness
+import metrics
 
 app = Flask(__name__)
 
+REQUEST_SECONDS = metrics.histogram('evolving_request_seconds', 'Time spent handling requests, by endpoint.')
+
+# Adding ?profile=1 to a request returns its cProfile statistics instead of the page.  Allowed when ALLOW_PROFILING
+# is set, or when running in debug mode.
+ALLOW_PROFILING = False
+PROFILE_STATS_LIMIT = 60
+
+# /review generates CANDIDATE_POOL_SIZE candidates and only shows the REVIEW_COUNT best of them, as ranked by the
+# fitness scorers with FITNESS_WEIGHTS (None weighs every registered scorer equally).  With ADAPTIVE_MUTATION, the
+# mutation_percentage and operator weights are chosen for each workspace from which candidates were selected before
+# (see scheduler.py); otherwise MUTATION_PERCENTAGE is always used.
+CANDIDATE_POOL_SIZE = 200
+REVIEW_COUNT = 10
+FITNESS_WEIGHTS = None
+MUTATION_PERCENTAGE = 5
+ADAPTIVE_MUTATION = True
+# e.g. MutationConstraints(key='D', scale='dorian', lowest_pitch=48, highest_pitch=84) keeps every candidate in a key,
+# range and meter (see constraints.py); None mutates freely.
+MUTATION_CONSTRAINTS = None
+
+# As soon as candidates are shown, the pools for the next /review are generated in the background, one per candidate.
+pregenerator = CandidatePregenerator(
+    pool_size=CANDIDATE_POOL_SIZE, mutation_percentage=MUTATION_PERCENTAGE, constraints=MUTATION_CONSTRAINTS)
+
+# Candidates offered by /review and the steps shown by /progression are kept in cache.MELODIES, keyed by
+# Melody.fingerprint, so /candidates and /lineage can render them from memory; their midi is then kept in
+# cache.MIDI_FILES.  Only the selected candidate is ever written to disk (see select()).
+# With SHARED_MIDI_CACHE, rendered midi is also kept in MIDI_CACHE_DIRECTORY, up to MIDI_CACHE_BYTES, so worker
+# processes reuse each other's renders.
+SHARED_MIDI_CACHE = False
+CONTENT_MAX_AGE = 365 * 24 * 60 * 60  # seconds browsers may cache anything named by its fingerprint
+MIDI_CACHE_DIRECTORY = os.path.join(FileHandler.ROOT_DIRECTORY, 'midi_cache')
+MIDI_CACHE_BYTES = 256 * 2**20
+
+
+# With AUDIO_PREVIEWS, the reviewed candidates are also synthesized to WAV files in background processes (see
+# audio.py), which start playing much sooner than MIDI.  They are cached in AUDIO_CACHE_DIRECTORY, which is shared by
+# every workspace, up to AUDIO_CACHE_BYTES.
+AUDIO_PREVIEWS = False
+AUDIO_CACHE_DIRECTORY = os.path.join(FileHandler.ROOT_DIRECTORY, 'audio_cache')
+AUDIO_CACHE_BYTES = 256 * 2**20
+audio_renderer = None
+
+
+def get_audio_renderer():
+    global audio_renderer
+    if audio_renderer is None:
+        audio_renderer = AudioRenderer(AUDIO_CACHE_DIRECTORY, max_cache_bytes=AUDIO_CACHE_BYTES)
+    return audio_renderer
+
+
+# Each browser session can have a workspace of its own (see FileHandler), named by a random token kept in the
+# WORKSPACE_COOKIE; /workspaces/new starts one.  A 'workspace' request parameter overrides the cookie, and without
+# either the shared default workspace is used.  All state lives in the workspace's files, so any number of worker
+# processes can serve the same sessions, e.g.:  gunicorn --workers 4 app:app
+WORKSPACE_COOKIE = 'workspace'
+WORKSPACE_COOKIE_MAX_AGE = 365 * 24 * 60 * 60
+
+
+def current_workspace():
+    return request.values.get('workspace') or request.cookies.get(WORKSPACE_COOKIE)
+
+
+def get_file_handler():
+    """Return the FileHandler for this request's workspace, created once per request."""
+    if 'file_handler' not in g:
+        try:
+            g.file_handler = FileHandler(workspace=current_workspace())
+        except ValueError:
+            abort(400)
+    return g.file_handler
+
+
+def mutation_settings():
+    """Return the (mutation_percentage, operator_weights) to generate this workspace's next candidates with, drawn
+    once per request."""
+    if 'mutation_settings' not in g:
+        if ADAPTIVE_MUTATION:
+            g.mutation_settings = MutationScheduler(get_file_handler().lineage).choose()
+        else:
+            g.mutation_settings = MUTATION_PERCENTAGE, None
+    return g.mutation_settings
+
+
+# /progression shows PROGRESSION_PAGE_SIZE steps per page.
+PROGRESSION_PAGE_SIZE = 50
+
 """ 
 TODO:
 - create a '/progression' route that displays each of the files in the progression folder in order.
@@ -15,6 +114,37 @@ TODO:
 - create test suite
 """
 
+@app.before_request
+def start_request_timing():
+    g.request_start = time.perf_counter()
+    if request.args.get('profile') and (ALLOW_PROFILING or app.debug):
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+
+@app.before_request
+def enable_shared_midi_cache():
+    if SHARED_MIDI_CACHE and cache.midi_disk_cache is None:
+        cache.enable_midi_disk_cache(MIDI_CACHE_DIRECTORY, max_bytes=MIDI_CACHE_BYTES)
+
+
+@app.after_request
+def finish_request_timing(response):
+    REQUEST_SECONDS.observe(time.perf_counter() - g.request_start, endpoint=request.endpoint or 'unknown')
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return response
+    profiler.disable()
+    stats_output = io.StringIO()
+    pstats.Stats(profiler, stream=stats_output).sort_stats('cumulative').print_stats(PROFILE_STATS_LIMIT)
+    return Response(stats_output.getvalue(), mimetype='text/plain')
+
+
+@app.route("/metrics")
+def metrics_route():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
 @app.route("/test")
 def test():
     return render_template('test.html')
@@ -25,6 +155,14 @@ def home():
     return render_template('home.html')
 
 
+@app.route("/workspaces/new", methods=['POST', 'GET'])
+def new_workspace():
+    """Start a session with a workspace of its own; its first /review makes the chosen file its seed."""
+    response = redirect('/')
+    response.set_cookie(WORKSPACE_COOKIE, secrets.token_urlsafe(12), max_age=WORKSPACE_COOKIE_MAX_AGE, samesite='Lax')
+    return response
+
+
 @app.route("/review", methods=['POST', 'GET'])
 def review():
     seed_from_form = request.form.get('seed_file')
@@ -38,64 +176,168 @@ def review():
         raise AttributeError('You must specify the seed file via POST or GET parameter.')
 
     # alter to allow submittal of seed files that already have relative path
-    file_handler = FileHandler()
-    seed_file_with_full_path = file_handler.find_seed_file_on_disk()
+    file_handler = get_file_handler()
+    seed_melody = file_handler.filename_to_melody(seed_file)
+    seed_file_with_full_path = file_handler.ensure_seed_file(seed_melody)
     seed_file_with_relative_path = file_handler.full_to_relative_path(seed_file_with_full_path)
-
-    seed_melody = file_handler.filename_to_list(filename=seed_file)
-    i = 0
-    created_melodies = []
-    created_files = []
-    output_directory = file_handler.setup_output_directory()
-    output_directory_seed_folder = os.path.join(output_directory, 'seed')
-    shutil.copy2(seed_file_with_full_path, output_directory_seed_folder)
-    mutator = Mutator(seed_melody=seed_melody, mutation_percentage=5)
-    while i < 10:
-        mutated_melody = mutator.mutate()
-        if mutated_melody != seed_melody and mutated_melody not in created_melodies:
-            midi_maker = MidiMaker(output_directory=output_directory, melody=mutated_melody)
-            mutated_file = midi_maker.write()
-            created_melodies.append(mutated_melody)
-            created_files.append(file_handler.full_to_relative_path(mutated_file))
-            i += 1
-    # print(created_files)
+    candidates = []
+    # skip anything already offered earlier in this lineage
+    seen_melodies = file_handler.load_seen_melodies()
+    candidate_pool = []
+    pregenerated_pool, provenance = pregenerator.take(seed_melody, group=file_handler.workspace) or ([], {})
+    for melody in pregenerated_pool:
+        if melody.fingerprint in seen_melodies:
+            CANDIDATES_REJECTED.inc(reason='seen')
+        else:
+            candidate_pool.append(melody)
+    if len(candidate_pool) < REVIEW_COUNT:
+        mutation_percentage, operator_weights = mutation_settings()
+        mutator = Mutator(
+            seed_melody=seed_melody, mutation_percentage=mutation_percentage, constraints=MUTATION_CONSTRAINTS,
+            operator_weights=operator_weights)
+        provenance = {}
+        candidate_pool = mutator.generate_unique(count=CANDIDATE_POOL_SIZE, seen=seen_melodies, provenance=provenance)
+    reviewed_melodies = fitness.top_k(candidate_pool, k=REVIEW_COUNT, weights=FITNESS_WEIGHTS)
+    file_handler.lineage.add_candidates(seed_melody, candidate_pool, provenance=provenance)
+    file_handler.lineage.mark_offered(reviewed_melodies)
+    if ADAPTIVE_MUTATION:
+        MutationScheduler(file_handler.lineage).record_offered(seed_melody, reviewed_melodies, provenance=provenance)
+    # the seed itself is included for "Reject All and Regenerate"
+    mutation_percentage, operator_weights = mutation_settings()
+    pregenerator.schedule(
+        reviewed_melodies + [seed_melody], group=file_handler.workspace, mutation_percentage=mutation_percentage,
+        operator_weights=operator_weights)
+    if AUDIO_PREVIEWS:
+        get_audio_renderer().prefetch(reviewed_melodies)
+    for mutated_melody in reviewed_melodies:
+        cache.MELODIES.put(mutated_melody.fingerprint, mutated_melody)
+        candidates.append({
+            'fingerprint': mutated_melody.fingerprint,
+            'notation': file_handler.list_to_filename(melody_list=mutated_melody),
+            'encoding': mutated_melody.to_base64(),
+        })
+        seen_melodies.add(mutated_melody.fingerprint)
+    file_handler.save_seen_melodies(seen_melodies)
 
     return render_template(
         'review.html',
         seed_file_no_path=seed_file,
         seed_file_with_relative_path = seed_file_with_relative_path,
-        created_files = created_files
+        seed_fingerprint = seed_melody.fingerprint,
+        audio_previews = AUDIO_PREVIEWS,
+        candidates = candidates
+    )
+
+
+def find_candidate(fingerprint):
+    melody = cache.MELODIES.get(fingerprint)
+    if melody is None:
+        # offered by another worker process; every candidate is recorded in the workspace's lineage
+        melody = get_file_handler().lineage.melody(fingerprint)
+    if melody is None:
+        abort(404)
+    return melody
+
+
+@app.route("/candidates/<fingerprint>.wav", methods=['GET'])
+def candidate_audio(fingerprint):
+    """Send a candidate's audio preview, rendering it now if it wasn't prefetched."""
+    if not AUDIO_PREVIEWS:
+        abort(404)
+    return send_file(
+        get_audio_renderer().render(find_candidate(fingerprint)),
+        mimetype='audio/wav',
+        etag=fingerprint,
+        max_age=CONTENT_MAX_AGE
+    )
+
+
+def send_midi(melody, fingerprint):
+    """Stream melody's midi from memory.  It is named by its fingerprint, which also serves as its ETag: melodies are
+    content-addressed, so they can be cached forever."""
+    return send_file(
+        io.BytesIO(MidiMaker(melody=melody).to_bytes()),
+        mimetype='audio/midi',
+        download_name=f'{fingerprint}.mid',
+        etag=fingerprint,
+        max_age=CONTENT_MAX_AGE
     )
 
 
+@app.route("/candidates/<fingerprint>.mid", methods=['GET'])
+def candidate(fingerprint):
+    """Stream a candidate's midi from memory."""
+    return send_midi(find_candidate(fingerprint), fingerprint)
+
+
 @app.route("/select", methods=['POST', 'GET'])
 def select():
-    file_handler = FileHandler()
-    selected_file_with_relative_path = request.form.get('relative_file_path')
+    file_handler = get_file_handler()
+    try:
+        selected_melody = Melody.from_base64(request.form.get('melody_encoding') or '')
+    except ValueError:
+        abort(400)  # missing or corrupt
     selection_type = request.form.get('selection_type')
-    # 1 archive the current seed file in the 'progression' directory
-    file_handler.archive_seed_file()
-    # 2 write the selected file to seed_file directory
-    file_handler.selected_file_to_seed_file(selected_file_with_relative_path)
+    output_directory = file_handler.setup_output_directory()
+    # the seed can't change under us while it is copied and replaced
+    with file_handler.seed_lock():
+        # 1 persist the seed and the selected candidate in a new output directory
+        seed_file_full_path = file_handler.find_seed_file_on_disk()
+        shutil.copy2(seed_file_full_path, os.path.join(output_directory, 'seed'))
+        selected_file = MidiMaker(
+            output_directory=output_directory, melody=selected_melody, file_handler=file_handler).write()
+        file_handler.record_candidate(selected_melody, selected_file)
+        if ADAPTIVE_MUTATION:
+            seed_melody = file_handler.filename_to_melody(os.path.basename(seed_file_full_path))
+            MutationScheduler(file_handler.lineage).record_selection(seed_melody, selected_melody)
+        # 2 archive the current seed file in the 'progression' directory,
+        # 3 write the selected file to seed_file directory and record the selection in the lineage, atomically
+        file_handler.advance_seed_file(
+            file_handler.full_to_relative_path(selected_file), selected_melody=selected_melody)
     if selection_type == 'regenerate':
-        # 3 redirect to the /review route, passing the selected file as a GET parameter
-        selected_file_no_path = selected_file_with_relative_path.split('/')[-1]
+        # 4 redirect to the /review route, passing the selected file as a GET parameter
+        selected_file_no_path = os.path.basename(selected_file)
         return redirect(f"/review?seed_file={selected_file_no_path}")
     elif selection_type == 'quit':
-        # 3 render the 'exit' template.
+        # 4 render the 'exit' template.
         return render_template('exit.html')
 
 
 @app.route("/progression", methods=['GET'])
 def progression():
-    file_handler = FileHandler()
-    progression_files = file_handler.get_sorted_progression_files()
+    """Page through the selections recorded in the LineageStore, PROGRESSION_PAGE_SIZE steps at a time."""
+    file_handler = get_file_handler()
+    page = max(request.args.get('page', 1, type=int), 1)
+    start = (page - 1) * PROGRESSION_PAGE_SIZE + 1
+    steps = []
+    for step, melody in file_handler.lineage.replay(start=start, count=PROGRESSION_PAGE_SIZE):
+        cache.MELODIES.put(melody.fingerprint, melody)
+        steps.append({
+            'step': step,
+            'fingerprint': melody.fingerprint,
+            'notation': file_handler.list_to_filename(melody_list=melody),
+        })
+    step_count = file_handler.lineage.step_count()
     return render_template(
         'progression.html',
-        progression_files = progression_files
+        steps = steps,
+        page = page,
+        page_count = max((step_count + PROGRESSION_PAGE_SIZE - 1) // PROGRESSION_PAGE_SIZE, 1)
     )
 
 
+@app.route("/lineage/<fingerprint>.mid", methods=['GET'])
+def lineage_melody(fingerprint):
+    """Stream any melody recorded in the LineageStore, rebuilt from its deltas."""
+    melody = cache.MELODIES.get(fingerprint)
+    if melody is None:
+        melody = get_file_handler().lineage.melody(fingerprint)
+    if melody is None:
+        abort(404)
+    cache.MELODIES.put(fingerprint, melody)
+    return send_midi(melody, fingerprint)
+
+
 
 
 if __name__ == '__main__':
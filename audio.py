@@ -0,0 +1,207 @@
+"""Audio previews of melodies, so candidates can be heard without waiting for MIDI playback to start in the browser.
+
+Melodies are synthesized to WAV files, either with the small NumPy synthesizer below or, if a fluidsynth binary and a
+SoundFont are available, with FluidSynth.  AudioRenderer renders them in a pool of worker processes and keeps the
+files in a cache directory, named by melody fingerprint, evicting the least recently used ones once the cache grows
+past its size cap.
+"""
+
+import io
+import os
+import wave
+import shutil
+import tempfile
+import threading
+import subprocess
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, CancelledError, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+import metrics
+from cache import evict_least_recently_used
+from melody import TICKS_PER_BEAT
+
+
+AUDIO_CACHE_REQUESTS = metrics.counter(
+    'evolving_audio_cache_requests_total', 'Audio previews requested, by whether they were already cached.')
+
+SAMPLE_RATE = 22050
+TEMPO = 120  # matches MidiMaker's default
+HARMONICS = (1.0, 0.5, 0.25, 0.125)  # relative amplitudes of the partials of each note
+ATTACK_SECONDS = 0.005
+RELEASE_SECONDS = 0.03
+DECAY_PER_SECOND = 3.0  # exponential decay rate of a held note, like a plucked or struck string
+
+
+@lru_cache(maxsize=1024)
+def _note_samples(pitch, sample_count, sample_rate):
+    """The samples of one note; melodies repeat the same pitches and durations a lot, so these are memoized."""
+    frequency = 440.0 * 2 ** ((pitch - 69) / 12)
+    times = np.arange(sample_count) / sample_rate
+    samples = np.zeros(sample_count)
+    for harmonic, amplitude in enumerate(HARMONICS, start=1):
+        if frequency * harmonic < sample_rate / 2:
+            samples += amplitude * np.sin(2 * np.pi * frequency * harmonic * times)
+    envelope = np.exp(-DECAY_PER_SECOND * times)
+    attack = min(int(ATTACK_SECONDS * sample_rate), sample_count)
+    envelope[:attack] *= np.linspace(0, 1, attack, endpoint=False)
+    release = min(int(RELEASE_SECONDS * sample_rate), sample_count)
+    envelope[sample_count - release:] *= np.linspace(1, 0, release)
+    samples *= envelope
+    samples.flags.writeable = False
+    return samples
+
+
+def synthesize(melody, sample_rate=SAMPLE_RATE, tempo=TEMPO):
+    """Render melody with a simple additive synthesizer.
+
+    Args:
+        melody (Melody)
+    Kwargs:
+        sample_rate (Int)
+        tempo (Int): in beats per minute
+    Returns:
+        numpy int16 array of mono samples
+    """
+    samples_per_tick = sample_rate * 60 / tempo / TICKS_PER_BEAT
+    boundaries = np.round(np.cumsum(np.concatenate([[0], np.frombuffer(melody.ticks, dtype=np.int32)]))
+                          * samples_per_tick).astype(np.int64)
+    output = np.zeros(int(boundaries[-1]))
+    for pitch, start, end in zip(melody.pitches, boundaries[:-1].tolist(), boundaries[1:].tolist()):
+        if end > start:
+            output[start:end] = _note_samples(pitch, end - start, sample_rate)
+    peak = np.abs(output).max() if len(output) else 0
+    if peak > 0:
+        output *= 0.8 / peak
+    return (output * 32767).astype(np.int16)
+
+
+def to_wav(samples, sample_rate=SAMPLE_RATE):
+    """Return mono int16 samples as the contents of a WAV file."""
+    output_buffer = io.BytesIO()
+    with wave.open(output_buffer, 'wb') as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(samples.astype('<i2').tobytes())
+    return output_buffer.getvalue()
+
+
+def render_with_fluidsynth(melody, soundfont, output_path, sample_rate=SAMPLE_RATE):
+    """Render melody to a WAV file with the fluidsynth binary.
+
+    Raises:
+        subprocess.CalledProcessError or OSError if fluidsynth fails
+    """
+    from mutator import MidiMaker  # imported here, since mutator is only needed for this renderer
+    with tempfile.NamedTemporaryFile(suffix='.mid') as midi_file:
+        midi_file.write(MidiMaker(melody=melody).to_bytes())
+        midi_file.flush()
+        subprocess.run(
+            ['fluidsynth', '-ni', '-r', str(sample_rate), '-T', 'wav', '-F', output_path, soundfont, midi_file.name],
+            check=True, capture_output=True)
+
+
+def render_to_file(melody, output_path, soundfont=None):
+    """Render melody to output_path as WAV; runs in a worker process.
+
+    The file is written under a temporary name, unique to the process and thread, and renamed into place, so readers
+    never see a partial file and concurrent renders of the same melody don't clobber each other.
+    FluidSynth is used if soundfont is given and the binary can be found, falling back to synthesize().
+    """
+    temporary_path = f'{output_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        if soundfont and shutil.which('fluidsynth'):
+            try:
+                render_with_fluidsynth(melody, soundfont, temporary_path)
+                os.replace(temporary_path, output_path)
+                return output_path
+            except (subprocess.CalledProcessError, OSError):
+                pass
+        with open(temporary_path, 'wb') as output_file:
+            output_file.write(to_wav(synthesize(melody)))
+        os.replace(temporary_path, output_path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+    return output_path
+
+
+class AudioRenderer(object):
+    """
+    Renders audio previews in background processes and caches them on disk by melody fingerprint.
+
+    prefetch() starts rendering the candidates about to be reviewed; render() returns the cached file, waiting for
+    (or doing) the rendering if needed.  Reading a cached file refreshes its modification time, which the eviction
+    uses as its LRU order, so the cache directory can be shared by several processes.
+    """
+
+    def __init__(self, cache_directory, max_cache_bytes=256 * 2**20, max_workers=None, soundfont=None):
+        """
+        Args:
+            cache_directory (String): created if necessary
+        Kwargs:
+            max_cache_bytes (Int): the least recently used previews are removed once the cache is larger than this
+            max_workers (Int): the number of worker processes; defaults to the number of cores
+            soundfont (String): a SoundFont (.sf2) file; enables FluidSynth if the binary is installed.  Defaults to
+                the EVOLVING_MUSIC_SOUNDFONT environment variable.
+        """
+        self.cache_directory = cache_directory
+        self.max_cache_bytes = max_cache_bytes
+        self.max_workers = max_workers
+        self.soundfont = soundfont or os.environ.get('EVOLVING_MUSIC_SOUNDFONT')
+        self.executor = None
+        self.pending = {}  # fingerprint -> Future
+        os.makedirs(cache_directory, exist_ok=True)
+
+    def _get_executor(self):
+        # created on first use, so importing the app doesn't start any processes
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        return self.executor
+
+    def cache_path(self, melody):
+        return os.path.join(self.cache_directory, f'{melody.fingerprint}.wav')
+
+    def prefetch(self, melodies):
+        """Start rendering any of melodies that aren't cached or being rendered already."""
+        for fingerprint, future in list(self.pending.items()):
+            if future.done():
+                del self.pending[fingerprint]  # rendered, but never asked for
+        self.evict()
+        for melody in melodies:
+            if melody.fingerprint not in self.pending and not os.path.exists(self.cache_path(melody)):
+                self.pending[melody.fingerprint] = self._get_executor().submit(
+                    render_to_file, melody, self.cache_path(melody), self.soundfont)
+
+    def render(self, melody, timeout=None):
+        """Return the path of melody's cached preview, rendering it first if needed."""
+        path = self.cache_path(melody)
+        future = self.pending.pop(melody.fingerprint, None)
+        if future is not None and not future.cancel():
+            try:
+                future.result(timeout=timeout)
+            except (CancelledError, FutureTimeoutError, BrokenProcessPool):
+                pass
+        if os.path.exists(path):
+            AUDIO_CACHE_REQUESTS.inc(result='hit' if future is None else 'prefetched')
+            os.utime(path)
+            return path
+        AUDIO_CACHE_REQUESTS.inc(result='miss')
+        render_to_file(melody, path, self.soundfont)
+        self.evict()
+        return path
+
+    def evict(self):
+        """Remove the least recently used previews until the cache fits in max_cache_bytes."""
+        evict_least_recently_used(self.cache_directory, self.max_cache_bytes, '.wav')
+
+    def shutdown(self):
+        for future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
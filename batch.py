@@ -0,0 +1,286 @@
+"""Headless generation of candidate sets, for batch pipelines where the web interface isn't available.
+
+Seeds can be melody filenames (in the notation described in FileHandler, or hashed names recorded in the index),
+MIDI files, melodies encoded with Melody.to_base64, or directories holding a corpus (shards written by corpus.py,
+or MIDI files).  Each seed's candidates are generated in a pool of worker processes and either streamed to stdout
+(or a file) as JSON lines, or rendered to MIDI in the workers and written to a single zip or tar archive, with a
+directory per seed.
+
+examples:
+    python batch.py 48-1p0__51-0p25_53-0p25.mid --count 200 > candidates.jsonl
+    python batch.py ~/corpus --count 50 --seed 1 --output candidates.zip
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import random
+import struct
+import sqlite3
+import tarfile
+import zipfile
+import argparse
+
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+import corpus
+from constraints import add_constraint_arguments, constraints_from_arguments
+from melody import Melody
+from mutator import FileHandler, Mutator, MidiMaker
+from progression_index import ProgressionIndex
+
+
+ARCHIVE_FORMATS = (('.zip', 'zip'), ('.tar', 'tar'), ('.tar.gz', 'tar'), ('.tgz', 'tar'))
+PROGRESS_INTERVAL = 1.0  # seconds between progress reports
+
+
+def recorded_melody(content_hash, root_directory):
+    """Return the melody recorded under content_hash in the index of root_directory (see FileHandler), or None.
+
+    The index is only read, so nothing is created or migrated under root_directory, and one that can't be opened is
+    treated like a missing one.
+    """
+    index_path = os.path.join(root_directory, 'index.sqlite3')
+    if not os.path.exists(index_path):
+        return None
+    try:
+        encoding = ProgressionIndex(index_path, read_only=True).get_melody_encoding(content_hash)
+    except sqlite3.Error:
+        return None
+    return None if encoding is None else Melody.from_bytes(encoding)
+
+
+def load_seeds(arguments, root_directory=None, counts=None):
+    """Yield a (name, Melody) pair for every seed given by arguments, lazily.
+
+    A MIDI file in a directory that can't be read is reported on stderr and skipped, like corpus.import_corpus does,
+    so one corrupt file doesn't end a long batch.
+
+    Args:
+        arguments (Iterable): Strings, each a directory, a MIDI file, a melody filename or an encoded melody
+    Kwargs:
+        root_directory (String): where to look up hashed melody filenames; defaults to FileHandler.ROOT_DIRECTORY
+        counts (Dict): if given, its 'failed' count is incremented for every file skipped
+    Raises:
+        ValueError if an argument is none of these
+    """
+    root_directory = root_directory or FileHandler.ROOT_DIRECTORY
+    for argument in arguments:
+        if os.path.isdir(argument):
+            if corpus.shard_paths(argument):
+                yield from corpus.read_corpus(argument)
+            else:
+                for path in corpus.find_midi_files(argument):
+                    try:
+                        melody = corpus.midi_file_to_melody(path)
+                    except (OSError, ValueError) as error:
+                        print(f'skipped {path}: {error}', file=sys.stderr)
+                        if counts is not None:
+                            counts['failed'] = counts.get('failed', 0) + 1
+                        continue
+                    if melody is not None:
+                        yield os.path.basename(path), melody
+            continue
+        filename = os.path.basename(argument)
+        if filename.lower().endswith(corpus.MIDI_SUFFIXES):
+            hashed_filename_match = FileHandler.HASHED_FILENAME_PATTERN.match(filename)
+            try:
+                if hashed_filename_match:
+                    melody = recorded_melody(hashed_filename_match.group(1), root_directory)
+                else:
+                    melody = FileHandler.filename_to_list(filename)
+            except (ValueError, IndexError):
+                melody = None
+            if melody is None:
+                if not os.path.isfile(argument):
+                    raise ValueError(f'Not a recorded melody filename or a MIDI file: {argument}')
+                melody = corpus.midi_file_to_melody(argument)  # named some other way: read the notes themselves
+            if melody is not None:
+                yield filename, melody
+            continue
+        try:
+            melody = Melody.from_base64(argument)
+        except (ValueError, struct.error):
+            raise ValueError(f'Not a directory, MIDI file, melody filename or encoded melody: {argument}')
+        yield melody.fingerprint[:FileHandler.CONTENT_HASH_LENGTH], melody
+
+
+def generate_candidates(indexed_seed, count, mutation_percentage, constraints, entropy, render):
+    """Generate up to count distinct candidates from one seed; runs in a worker process.
+
+    Args:
+        indexed_seed (Tuple): (index, name, Melody); the index selects the seed's random stream
+        entropy (Int): the batch's seed, as SeedSequence entropy
+        render (Bool): also render each candidate to MIDI
+    Returns:
+        Tuple of (name, seed Melody, list of (Melody, midi bytes or None) pairs)
+    """
+    index, name, seed_melody = indexed_seed
+    seed_sequence = np.random.SeedSequence(entropy, spawn_key=(index,))
+    rng = random.Random(int(seed_sequence.generate_state(1, np.uint64)[0]))
+    mutator = Mutator(seed_melody=seed_melody, mutation_percentage=mutation_percentage, rng=rng,
+                      constraints=constraints)
+    midi_maker = MidiMaker()
+    candidates = []
+    for candidate in mutator.generate_unique(count=count):
+        midi_maker.melody = candidate
+        candidates.append((candidate, midi_maker.to_bytes() if render else None))
+    return name, seed_melody, candidates
+
+
+class JsonLinesWriter(object):
+    """Writes one JSON object per candidate: the seed's name and fingerprint, and the candidate's fingerprint, encoding
+    (see Melody.to_base64) and notes (see Melody.to_list)."""
+
+    render = False
+
+    def __init__(self, output_file):
+        self.output_file = output_file
+
+    def write(self, seed_name, seed_melody, candidates):
+        for candidate, _ in candidates:
+            self.output_file.write(json.dumps({
+                'seed': seed_name,
+                'seed_fingerprint': seed_melody.fingerprint,
+                'fingerprint': candidate.fingerprint,
+                'encoding': candidate.to_base64(),
+                'melody': candidate.to_list(),
+            }) + '\n')
+        self.output_file.flush()
+
+    def close(self):
+        if self.output_file is not sys.stdout:
+            self.output_file.close()
+
+
+class ArchiveWriter(object):
+    """Writes the candidates of each seed to a directory of a zip or tar archive, named by the seed's content hash,
+    holding the seed as seed.mid and each candidate named by its own content hash."""
+
+    render = True
+
+    def __init__(self, path, archive_format):
+        self.path = path
+        self.archive_format = archive_format
+        self.midi_maker = MidiMaker()
+        if archive_format == 'zip':
+            self.archive = zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED)
+        else:
+            self.archive = tarfile.open(path, 'w:gz' if path.endswith(('.gz', '.tgz')) else 'w')
+
+    def _add(self, name, data):
+        if self.archive_format == 'zip':
+            self.archive.writestr(name, data)
+        else:
+            entry = tarfile.TarInfo(name)
+            entry.size = len(data)
+            entry.mtime = int(time.time())
+            self.archive.addfile(entry, io.BytesIO(data))
+
+    def write(self, seed_name, seed_melody, candidates):
+        directory = seed_melody.fingerprint[:FileHandler.CONTENT_HASH_LENGTH]
+        self.midi_maker.melody = seed_melody
+        self._add(f'{directory}/seed.mid', self.midi_maker.to_bytes())
+        for candidate, midi_bytes in candidates:
+            self._add(f'{directory}/{candidate.fingerprint[:FileHandler.CONTENT_HASH_LENGTH]}.mid', midi_bytes)
+
+    def close(self):
+        self.archive.close()
+
+
+def open_writer(output):
+    """Return the writer for output: a JSON lines file ('-' or None for stdout), or a zip or tar archive, chosen by
+    its suffix."""
+    if output in (None, '-'):
+        return JsonLinesWriter(sys.stdout)
+    for suffix, archive_format in ARCHIVE_FORMATS:
+        if output.endswith(suffix):
+            return ArchiveWriter(output, archive_format)
+    return JsonLinesWriter(open(output, 'w'))
+
+
+def generate_batch(seeds, writer, count, mutation_percentage=5, constraints=None, seed=None, workers=None,
+                   progress=None):
+    """Generate count candidates for each of seeds in worker processes, and hand them to writer in order of seeds.
+
+    Args:
+        seeds (Iterable): (name, Melody) pairs, as yielded by load_seeds(); consumed lazily
+        writer (JsonLinesWriter or ArchiveWriter)
+        count (Int): candidates per seed
+    Kwargs:
+        mutation_percentage (Int), constraints (MutationConstraints): passed to Mutator
+        seed (Int): seeds every random stream of the batch; each seed melody gets its own stream, so a batch can be
+            reproduced exactly regardless of the number of workers
+        workers (Int): the number of worker processes; defaults to the number of cores
+        progress (Callable): called with (seeds done, candidates written, seconds elapsed) after every seed
+    Returns:
+        Tuple of (seeds done, candidates written)
+    """
+    entropy = np.random.SeedSequence(seed).entropy
+    workers = workers or os.cpu_count()
+    indexed_seeds = ((index, name, melody) for index, (name, melody) in enumerate(seeds))
+    seed_count = 0
+    candidate_count = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for name, seed_melody, candidates in corpus.bounded_map(
+                executor, generate_candidates, indexed_seeds, workers * 4,
+                count, mutation_percentage, constraints, entropy, writer.render):
+            writer.write(name, seed_melody, candidates)
+            seed_count += 1
+            candidate_count += len(candidates)
+            if progress is not None:
+                progress(seed_count, candidate_count, time.perf_counter() - start)
+    return seed_count, candidate_count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate candidate melodies from seeds, without the web interface.')
+    parser.add_argument('seeds', nargs='+',
+                        help='melody filenames (e.g. 48-1p0__51-0p25_53-0p25.mid), MIDI files, encoded melodies, or '
+                             'corpus directories')
+    parser.add_argument('--count', type=int, default=20, help='candidates generated per seed')
+    parser.add_argument('--mutation-percentage', type=int, default=5)
+    parser.add_argument('--output', help='a .jsonl file, or a .zip, .tar or .tar.gz archive of MIDI files; '
+                                         'JSON lines go to stdout by default')
+    parser.add_argument('--seed', type=int, help='seed for a reproducible batch')
+    parser.add_argument('--workers', type=int, help='number of worker processes (defaults to the number of cores)')
+    parser.add_argument('--quiet', action='store_true', help="don't report progress on stderr")
+    parser.add_argument('--root', help='storage root to look up hashed melody filenames in (defaults to '
+                                       'FileHandler.ROOT_DIRECTORY); it is only read')
+    add_constraint_arguments(parser)
+    args = parser.parse_args()
+
+    seed = args.seed if args.seed is not None else int(np.random.SeedSequence().entropy % 2**63)
+    last_report = [0.0]
+
+    def report(seed_count, candidate_count, elapsed, final=False):
+        if not args.quiet and (final or elapsed - last_report[0] >= PROGRESS_INTERVAL):
+            last_report[0] = elapsed
+            print(f'{seed_count} seeds, {candidate_count} candidates, {candidate_count / max(elapsed, 1e-9):.0f} '
+                  f'candidates/s', file=sys.stderr)
+
+    if not args.quiet:
+        print(f'seed: {seed}', file=sys.stderr)
+    writer = open_writer(args.output)
+    seed_counts = {'failed': 0}
+    start = time.perf_counter()
+    try:
+        seed_count, candidate_count = generate_batch(
+            load_seeds(args.seeds, root_directory=args.root, counts=seed_counts), writer, args.count,
+            mutation_percentage=args.mutation_percentage, constraints=constraints_from_arguments(args), seed=seed,
+            workers=args.workers, progress=report)
+    except ValueError as error:  # an unreadable seed or bad constraints
+        parser.error(str(error))
+    finally:
+        writer.close()
+    report(seed_count, candidate_count, time.perf_counter() - start, final=True)
+    if seed_counts['failed']:
+        print(f'{seed_counts["failed"]} unreadable seed files skipped', file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,25 @@
+import os
+import sys
+import random
+
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tests'))
+
+from helpers import empty_caches, make_melody, root_directory  # noqa: E402,F401
+
+
+MELODY_SIZES = [8, 64, 512, 2000]  # in notes
+
+
+@pytest.fixture(params=MELODY_SIZES, ids=lambda size: f'{size}_notes')
+def melody(request):
+    return make_melody(request.param)
+
+
+@pytest.fixture(autouse=True)
+def seeded_random():
+    random.seed(1234)
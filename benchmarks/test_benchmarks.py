@@ -0,0 +1,149 @@
+"""
+Benchmarks for the hot paths of generating and reviewing candidates.
+
+Run with:
+    pytest benchmarks --benchmark-json=benchmark_results.json
+and compare runs across commits with pytest-benchmark's --benchmark-autosave / --benchmark-compare options.
+"""
+
+import os
+import re
+
+import pytest
+
+import audio
+import cache
+import fitness
+from constraints import MutationConstraints
+from helpers import make_melody
+from melody import Melody
+from mutator import FileHandler, MidiMaker, Mutator
+
+
+def test_mutate(benchmark, melody):
+    mutator = Mutator(seed_melody=melody, mutation_percentage=5)
+    benchmark(mutator.mutate)
+
+
+def test_mutate_batch(benchmark, melody):
+    mutator = Mutator(seed_melody=melody, mutation_percentage=5)
+    benchmark(mutator.mutate_batch, 100, rng=1234)
+
+
+def test_mutate_batch_constrained(benchmark, melody):
+    mutator = Mutator(seed_melody=melody, mutation_percentage=5, constraints=MutationConstraints(key='C', scale='chromatic'))
+    benchmark(mutator.mutate_batch, 100, rng=1234)
+
+
+def test_generate_unique(benchmark, melody):
+    mutator = Mutator(seed_melody=melody, mutation_percentage=5)
+    benchmark(mutator.generate_unique, 200)
+
+
+def test_mutate_batch_deltas(benchmark, melody):
+    mutator = Mutator(seed_melody=melody, mutation_percentage=5)
+    benchmark(mutator.mutate_batch_deltas, 100, rng=1234)
+
+
+def test_score_children(benchmark, melody):
+    children = Mutator(seed_melody=melody, mutation_percentage=5).mutate_batch(200, rng=1234)
+    benchmark(fitness.score, children)
+
+
+def test_render_children(benchmark, melody, root_directory):
+    midi_maker = MidiMaker(melody=melody)
+    midi_maker.to_bytes()  # the parent has been rendered before, as in /review
+    mutator = Mutator(seed_melody=melody, mutation_percentage=5)
+
+    def render(child):
+        midi_maker.melody = child
+        return midi_maker.to_bytes()
+    benchmark.pedantic(render, setup=lambda: ((mutator.mutate(),), {}), rounds=200)
+
+
+@pytest.mark.parametrize('unit_length', [2, 8, 32])
+def test_join_or_split(benchmark, unit_length):
+    mutator = Mutator(seed_melody=make_melody(8), mutation_percentage=5)
+    note_unit = [[60 + i % 12, 1.5] for i in range(unit_length)]
+    benchmark(lambda: mutator._join_or_split(note_unit=list(note_unit)))
+
+
+def test_filename_to_list(benchmark, melody):
+    filename = FileHandler.list_to_filename(melody_list=melody)
+    benchmark(FileHandler.filename_to_list, filename)
+
+
+def test_list_to_filename(benchmark, melody):
+    benchmark(FileHandler.list_to_filename, melody)
+
+
+def test_melody_from_bytes(benchmark, melody):
+    benchmark(Melody.from_bytes, melody.to_bytes())
+
+
+def test_melody_to_bytes(benchmark, melody):
+    benchmark(lambda: Melody(melody.note_units).to_bytes())
+
+
+@pytest.mark.parametrize('use_midiutil', [False, True], ids=['native', 'midiutil'])
+def test_midi_to_bytes(benchmark, melody, use_midiutil):
+    midi_maker = MidiMaker(melody=melody)
+    if use_midiutil:
+        benchmark(midi_maker.to_bytes, use_midiutil=True)
+    else:
+        benchmark(midi_maker._encode_native)  # bypasses cache.MIDI_FILES
+
+
+def test_midi_to_bytes_cached(benchmark, melody):
+    midi_maker = MidiMaker(melody=melody)
+    midi_maker.to_bytes()
+    benchmark(midi_maker.to_bytes)
+
+
+def test_midi_to_bytes_disk_cached(benchmark, melody, tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, 'midi_disk_cache', cache.DiskCache(str(tmp_path / 'midi_cache'), 2**30, suffix='.mid'))
+    midi_maker = MidiMaker(melody=melody)
+    midi_maker.to_bytes()
+
+    def render():
+        cache.MIDI_FILES.clear()  # as in a worker process that hasn't rendered this melody yet
+        return midi_maker.to_bytes()
+    benchmark(render)
+
+
+def test_synthesize_audio(benchmark, melody):
+    benchmark(lambda: audio.to_wav(audio.synthesize(melody)))
+
+
+def test_midi_write(benchmark, melody, root_directory):
+    midi_maker = MidiMaker(output_directory=str(root_directory), melody=melody)
+    benchmark(midi_maker.write)
+
+
+@pytest.fixture
+def review_client(root_directory):
+    import app as app_module
+    seed_melody = make_melody(64)
+    file_handler = FileHandler()
+    MidiMaker(output_directory=os.path.join(str(root_directory), 'seed_file'), melody=seed_melody).write()
+    yield app_module, app_module.app.test_client(), seed_melody, file_handler.melody_to_filename(seed_melody)
+    app_module.pregenerator.shutdown()
+
+
+@pytest.mark.parametrize('pregenerated', [False, True], ids=['cold', 'warm'])
+def test_review_request(benchmark, review_client, pregenerated):
+    app_module, client, seed_melody, seed_file = review_client
+
+    def setup():
+        app_module.pregenerator.shutdown()
+        if pregenerated:
+            app_module.pregenerator.schedule([seed_melody])
+            for future in app_module.pregenerator.pending[None].values():
+                future.result()
+
+    def review():
+        response = client.get(f'/review?seed_file={seed_file}')
+        assert response.status_code == 200
+        assert len(re.findall(r'/candidates/[0-9a-f]+\.mid', response.get_data(as_text=True))) > 0
+
+    benchmark.pedantic(review, setup=setup, rounds=20)
@@ -0,0 +1,167 @@
+"""Process-wide caches keyed by content (melody fingerprints, content-hashed filenames), shared by every request.
+
+Because the keys are derived from the content, cached values never go stale and need no invalidation; the caches
+only have to stay within their size bounds, which they do by evicting the least recently used entries.
+
+    MELODIES            parsed Melodies, by filename or fingerprint
+    MIDI_FILES          rendered midi bytes, by fingerprint and rendering settings
+    RECORDED_MELODIES   the (index path, content hash) pairs already stored by FileHandler.melody_to_filename
+
+Rendered midi can also be kept in a DiskCache shared by every worker process (see enable_midi_disk_cache), so a
+melody rendered by one process is read back, not re-encoded, by the others.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+import metrics
+
+
+CACHE_REQUESTS = metrics.counter(
+    'evolving_cache_requests_total', 'Lookups in the content-addressed caches, by cache and whether they hit.')
+
+
+class LRUCache(object):
+    """A thread-safe mapping that evicts its least recently used entries once their total size exceeds max_size."""
+
+    def __init__(self, name, max_size, sizeof=len):
+        """
+        Args:
+            name (String): labels the cache's metrics
+            max_size (Int): the largest total size of the entries kept
+        Kwargs:
+            sizeof (Callable): the size of a value, in whatever unit max_size uses
+        """
+        self.name = name
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.entries = OrderedDict()  # key -> (value, size)
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+        CACHE_REQUESTS.inc(cache=self.name, result='miss' if entry is None else 'hit')
+        return default if entry is None else entry[0]
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous[1]
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size and len(self.entries) > 1:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+        return value
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+def evict_least_recently_used(directory, max_bytes, suffix):
+    """Remove the files ending in suffix with the oldest modification times until those left fit in max_bytes.
+
+    Readers refresh a file's modification time (os.utime), so this is an LRU order that any number of processes
+    sharing the directory agree on.
+    """
+    entries = []
+    total_size = 0
+    with os.scandir(directory) as directory_entries:
+        for entry in directory_entries:
+            if entry.name.endswith(suffix):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total_size += stat.st_size
+    for _, size, path in sorted(entries):
+        if total_size <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass  # evicted by another process
+        total_size -= size
+
+
+class DiskCache(object):
+    """
+    Byte strings stored as files in a directory shared by several processes.
+
+    Files are written under a temporary name and renamed into place, so readers only ever see complete values, and
+    the operating system's page cache keeps the hot ones in memory for every process.  Once the directory grows
+    past max_bytes, the least recently read files are removed.
+    """
+
+    EVICTION_INTERVAL = 100  # writes between checks of the directory's size
+
+    def __init__(self, directory, max_bytes, suffix='.bin'):
+        """
+        Args:
+            directory (String): created on the first write
+            max_bytes (Int)
+        Kwargs:
+            suffix (String): appended to the keys to form filenames
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self.writes = 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}{self.suffix}')
+
+    def get(self, key):
+        """Return the bytes stored under key, or None."""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as cached_file:
+                value = cached_file.read()
+            os.utime(path)
+        except FileNotFoundError:
+            CACHE_REQUESTS.inc(cache=f'{os.path.basename(self.directory)}_disk', result='miss')
+            return None
+        CACHE_REQUESTS.inc(cache=f'{os.path.basename(self.directory)}_disk', result='hit')
+        return value
+
+    def put(self, key, value):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key)
+        temporary_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temporary_path, 'wb') as cached_file:
+            cached_file.write(value)
+        os.replace(temporary_path, path)
+        self.writes += 1
+        if self.writes % self.EVICTION_INTERVAL == 0:
+            evict_least_recently_used(self.directory, self.max_bytes, self.suffix)
+        return value
+
+
+def _melody_size(melody):
+    return len(melody) + melody.offsets[-1]
+
+
+MELODIES = LRUCache('melodies', max_size=4 * 2**20, sizeof=_melody_size)  # in note_units plus notes
+MIDI_FILES = LRUCache('midi_files', max_size=64 * 2**20)  # in bytes
+RECORDED_MELODIES = LRUCache('recorded_melodies', max_size=2**17, sizeof=lambda value: 1)  # in entries
+
+midi_disk_cache = None
+
+
+def enable_midi_disk_cache(directory, max_bytes=256 * 2**20):
+    """Share rendered midi between processes through a DiskCache in directory."""
+    global midi_disk_cache
+    midi_disk_cache = DiskCache(directory, max_bytes, suffix='.mid')
@@ -0,0 +1,220 @@
+"""Musical constraints for Mutator: a key and scale, a pitch range and a bar length.
+
+MutationConstraints precomputes, for every midi pitch and every duration on its grid, the legal moves a pitch or
+duration mutation can make and their probabilities, so a constrained Mutator samples only legal candidates instead of
+generating invalid ones and rejecting them.  The probabilities follow the unconstrained mutations (smaller changes
+are more likely; see Mutator._build_scaled_probabilities_list), renormalized over the legal moves.
+"""
+
+import bisect
+
+import numpy as np
+
+from melody import LOWEST_PITCH, HIGHEST_PITCH
+
+
+PITCH_CLASSES = {
+    'C': 0, 'B#': 0, 'C#': 1, 'Db': 1, 'D': 2, 'D#': 3, 'Eb': 3, 'E': 4, 'Fb': 4, 'F': 5, 'E#': 5, 'F#': 6, 'Gb': 6,
+    'G': 7, 'G#': 8, 'Ab': 8, 'A': 9, 'A#': 10, 'Bb': 10, 'B': 11, 'Cb': 11,
+}
+
+SCALES = {  # semitones above the key's pitch class
+    'major': (0, 2, 4, 5, 7, 9, 11),
+    'minor': (0, 2, 3, 5, 7, 8, 10),
+    'harmonic_minor': (0, 2, 3, 5, 7, 8, 11),
+    'dorian': (0, 2, 3, 5, 7, 9, 10),
+    'mixolydian': (0, 2, 4, 5, 7, 9, 10),
+    'major_pentatonic': (0, 2, 4, 7, 9),
+    'minor_pentatonic': (0, 3, 5, 7, 10),
+    'blues': (0, 3, 5, 6, 7, 10),
+    'chromatic': tuple(range(12)),
+}
+
+MAX_PITCH_CHANGE = 12  # matches Mutator's pitch_change_probs
+DURATION_CHANGES = (0.25, 0.5, 1)  # matches Mutator.DURATION_CHANGES
+
+
+def _scaled_weights(max_change):
+    """The probability of a change of 1 to max_change steps in Mutator's scaled draws: halved at every step."""
+    return [2.0 ** (max_change - change) for change in range(1, max_change + 1)]
+
+
+def _cumulative(weights):
+    cumulative = np.cumsum(weights, axis=-1)
+    return cumulative / cumulative[..., -1:]
+
+
+def add_constraint_arguments(parser):
+    """Add the options read by constraints_from_arguments() to an argparse parser."""
+    parser.add_argument('--key', help='keep mutations in this key, e.g. C, F# or Bb (see constraints.py)')
+    parser.add_argument('--scale', choices=sorted(SCALES), default='major')
+    parser.add_argument('--lowest-pitch', type=int, default=LOWEST_PITCH)
+    parser.add_argument('--highest-pitch', type=int, default=HIGHEST_PITCH)
+    parser.add_argument('--bar-beats', type=float, default=4, help='with --key, the longest a note_unit can grow')
+
+
+def constraints_from_arguments(args):
+    """Return the MutationConstraints given by the options added by add_constraint_arguments(), or None without --key."""
+    if not args.key:
+        return None
+    return MutationConstraints(
+        key=args.key, scale=args.scale, lowest_pitch=args.lowest_pitch, highest_pitch=args.highest_pitch,
+        bar_beats=args.bar_beats)
+
+
+class MutationConstraints(object):
+    """
+    The legal pitches and durations of a constrained Mutator, with tables of the moves between them.
+
+        pitch_targets[p], pitch_cdf[p]: the pitches a pitch mutation can move pitch p to, and their cumulative
+            probabilities.  A pitch outside the key or range moves back into it.
+        duration_targets[s], duration_weights[s]: the durations (in beats) a duration mutation can move a duration of
+            s grid steps to, and their relative probabilities.
+
+    Durations are whole multiples of grid beats, up to bar_beats, and a duration mutation never makes a note_unit
+    longer than a bar (or longer than it already was).
+    """
+
+    def __init__(self, key='C', scale='major', lowest_pitch=LOWEST_PITCH, highest_pitch=HIGHEST_PITCH, bar_beats=4,
+                 grid=0.25):
+        """
+        Kwargs:
+            key (String): the tonic's pitch class, e.g. 'C', 'F#' or 'Bb'
+            scale (String): one of SCALES
+            lowest_pitch (Int), highest_pitch (Int): the midi pitch range, inclusive
+            bar_beats (Number): the length of a bar, and so of the longest note, in beats
+            grid (Number): durations are whole multiples of this, in beats
+        Raises:
+            ValueError if the key or scale is unknown, no pitch of the scale is in range, or bar_beats isn't a whole
+            number of grid steps
+        """
+        if key not in PITCH_CLASSES:
+            raise ValueError(f'Unknown key: {key!r}')
+        if scale not in SCALES:
+            raise ValueError(f'Unknown scale: {scale!r}; expected one of {", ".join(sorted(SCALES))}')
+        self.key = key
+        self.scale = scale
+        self.lowest_pitch = max(lowest_pitch, LOWEST_PITCH)
+        self.highest_pitch = min(highest_pitch, HIGHEST_PITCH)
+        self.bar_beats = bar_beats
+        self.grid = grid
+        pitch_classes = {(PITCH_CLASSES[key] + interval) % 12 for interval in SCALES[scale]}
+        self.allowed_pitches = [
+            pitch for pitch in range(self.lowest_pitch, self.highest_pitch + 1) if pitch % 12 in pitch_classes]
+        if not self.allowed_pitches:
+            raise ValueError(f'No pitch of {key} {scale} is between {lowest_pitch} and {highest_pitch}')
+        self.bar_steps = int(round(bar_beats / grid))
+        if self.bar_steps < 1 or abs(self.bar_steps * grid - bar_beats) > 1e-9:
+            raise ValueError(f'bar_beats ({bar_beats}) must be a whole number of grid steps ({grid})')
+        self._allowed_pitch_set = frozenset(self.allowed_pitches)
+        self._build_pitch_table()
+        self._build_duration_table()
+
+    def __reduce__(self):
+        # rebuild the tables in worker processes rather than pickling them
+        return MutationConstraints, (
+            self.key, self.scale, self.lowest_pitch, self.highest_pitch, self.bar_beats, self.grid)
+
+    def __repr__(self):
+        return (f'MutationConstraints({self.key!r}, {self.scale!r}, {self.lowest_pitch}, {self.highest_pitch}, '
+                f'{self.bar_beats}, {self.grid})')
+
+    def _build_pitch_table(self):
+        weights = _scaled_weights(MAX_PITCH_CHANGE)
+        rows = []
+        for pitch in range(HIGHEST_PITCH + 1):
+            moves = [(pitch + sign * change, weight / 2)
+                     for change, weight in enumerate(weights, start=1) for sign in (1, -1)
+                     if pitch + sign * change in self._allowed_pitch_set]
+            if not moves:  # too far from any legal pitch: move to the nearest ones
+                nearest = min(abs(allowed - pitch) for allowed in self.allowed_pitches)
+                moves = [(allowed, 1.0) for allowed in self.allowed_pitches if abs(allowed - pitch) == nearest]
+            rows.append(moves)
+        width = max(len(moves) for moves in rows)
+        self.pitch_targets = np.zeros((HIGHEST_PITCH + 1, width), dtype=np.int64)
+        pitch_weights = np.zeros((HIGHEST_PITCH + 1, width))
+        for pitch, moves in enumerate(rows):
+            self.pitch_targets[pitch, :len(moves)] = [target for target, _ in moves]
+            self.pitch_targets[pitch, len(moves):] = moves[-1][0]  # never drawn: their probability is 0
+            pitch_weights[pitch, :len(moves)] = [weight for _, weight in moves]
+        self.pitch_cdf = _cumulative(pitch_weights)
+        self._pitch_cdf_lists = self.pitch_cdf.tolist()
+
+    def _build_duration_table(self):
+        weights = _scaled_weights(len(DURATION_CHANGES))
+        change_steps = [change / self.grid for change in DURATION_CHANGES]
+        width = 2 * len(DURATION_CHANGES)
+        self.duration_targets = np.zeros((self.bar_steps + 1, width))
+        self.duration_weights = np.zeros((self.bar_steps + 1, width))
+        for steps in range(1, self.bar_steps + 1):
+            column = 0
+            for change, weight in zip(change_steps, weights):
+                for sign in (1, -1):
+                    target_steps = steps + sign * change
+                    if change == int(change) and 1 <= target_steps <= self.bar_steps:
+                        self.duration_targets[steps, column] = target_steps * self.grid
+                        self.duration_weights[steps, column] = weight / 2
+                    column += 1
+
+    def allows_pitch(self, pitch):
+        return pitch in self._allowed_pitch_set
+
+    def allows_duration(self, duration):
+        steps = duration / self.grid
+        return abs(steps - round(steps)) < 1e-9 and 1 <= round(steps) <= self.bar_steps
+
+    def allows(self, melody):
+        """Return True if every note of melody has a legal pitch and duration."""
+        return all(self.allows_pitch(pitch) and self.allows_duration(duration)
+                   for note_unit in melody for pitch, duration in note_unit)
+
+    def duration_steps(self, durations):
+        """The row of the duration table for each duration: the nearest whole number of grid steps, within a bar."""
+        return np.clip(np.rint(np.asarray(durations) / self.grid).astype(np.int64), 1, self.bar_steps)
+
+    def choose_pitch(self, rng, pitch):
+        """Draw a legal move for pitch with rng (a random.Random)."""
+        row = self._pitch_cdf_lists[pitch]
+        return int(self.pitch_targets[pitch, min(bisect.bisect_right(row, rng.random()), len(row) - 1)])
+
+    def choose_duration(self, rng, duration, unit_duration):
+        """Draw a legal move for duration, in a note_unit unit_duration beats long, with rng (a random.Random);
+        returns duration unchanged if there is none."""
+        steps = int(self.duration_steps(duration))
+        longest = max(self.bar_beats, unit_duration) - unit_duration + duration
+        moves = [(target, weight) for target, weight in zip(
+            self.duration_targets[steps].tolist(), self.duration_weights[steps].tolist())
+            if weight and target <= longest + 1e-9]
+        draw = rng.random() * sum(weight for _, weight in moves)
+        for target, weight in moves:
+            draw -= weight
+            if draw < 0:
+                return target
+        return moves[-1][0] if moves else duration
+
+    def sample_pitches(self, rng, pitches):
+        """Draw a legal move for each of pitches with rng (a numpy.random.Generator)."""
+        pitches = np.asarray(pitches, dtype=np.int64)
+        cdf = self.pitch_cdf[pitches]
+        choices = np.minimum((cdf < rng.random(len(pitches))[:, None]).sum(axis=1), cdf.shape[1] - 1)
+        return self.pitch_targets[pitches, choices]
+
+    def sample_durations(self, rng, durations, unit_durations):
+        """Draw a legal move for each of durations with rng (a numpy.random.Generator).
+
+        Args:
+            durations (Array): in beats
+            unit_durations (Array): the total duration of each duration's note_unit, in beats
+        Returns:
+            Array of new durations; a duration without a legal move is returned unchanged
+        """
+        durations = np.asarray(durations, dtype=float)
+        unit_durations = np.asarray(unit_durations, dtype=float)
+        steps = self.duration_steps(durations)
+        targets = self.duration_targets[steps]
+        longest = np.maximum(self.bar_beats, unit_durations) - unit_durations + durations
+        weights = np.where(targets <= longest[:, None] + 1e-9, self.duration_weights[steps], 0.0)
+        totals = weights.sum(axis=1)
+        draws = rng.random(len(durations)) * totals
+        choices = np.minimum((np.cumsum(weights, axis=1) <= draws[:, None]).sum(axis=1), weights.shape[1] - 1)
+        return np.where(totals > 0, targets[np.arange(len(durations)), choices], durations)
@@ -0,0 +1,386 @@
+"""Bulk import and export of melody corpora.
+
+import_corpus() reads a tree of ordinary MIDI files, reduces each to a single line of notes, quantizes it and groups
+the notes into NoteUnits (see quantize_notes), and writes the melodies to shards: compressed files holding up to
+SHARD_SIZE melodies each in the Melody.to_bytes encoding.  Files are parsed in a pool of worker processes and
+streamed through it, so corpora of any size can be imported without holding them in memory.  export_corpus() writes
+the melodies of a shard directory back out as MIDI files.
+
+    python corpus.py import ~/midi_catalog --output-directory ~/corpus
+    python corpus.py export ~/corpus --output-directory ~/exported
+"""
+
+import os
+import sys
+import zlib
+import struct
+import argparse
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
+
+import metrics
+from melody import Melody
+
+
+CORPUS_FILES = metrics.counter('evolving_corpus_files_total', 'MIDI files read by import_corpus, by result.')
+
+# Shard file format, all little-endian, compressed as a whole with zlib:
+#   magic (4 bytes), version (uint8), melody count (uint32), then for each melody:
+#   name length (uint16), encoding length (uint32), name (utf-8), encoding (see Melody.to_bytes)
+SHARD_MAGIC = b'EMSH'
+SHARD_VERSION = 1
+SHARD_HEADER = struct.Struct('<4sBI')
+SHARD_RECORD_HEADER = struct.Struct('<HI')
+SHARD_SUFFIX = '.shard'
+SHARD_SIZE = 1000  # melodies per shard
+
+MIDI_SUFFIXES = ('.mid', '.midi')
+DRUM_CHANNEL = 9  # General MIDI channel 10 holds percussion, which has no melody
+
+# Quantization and grouping defaults (see quantize_notes), in beats unless noted
+GRID = 0.25
+REST_SPLIT = 0.5  # a rest at least this long ends a note_unit
+LONG_NOTE = 1.0  # a note at least this long ends a note_unit
+LEAP_SPLIT = 7  # in semitones; a larger leap starts a new note_unit
+MAX_UNIT_NOTES = 4
+BAR_BEATS = 4  # note_units don't cross bar lines
+
+
+def _read_variable_length(data, position):
+    value = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value = (value << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            return value, position
+
+
+def read_midi_notes(data):
+    """Parse the notes of a standard MIDI file.
+
+    Args:
+        data (Bytes): the contents of a format 0 or 1 MIDI file
+    Returns:
+        Tuple of (notes, ticks per beat), where notes is a list of (start tick, end tick, pitch) tuples in order of
+        start, from every track and every channel but the drum channel
+    Raises:
+        ValueError if data isn't a MIDI file this can read
+    """
+    if data[:4] != b'MThd':
+        raise ValueError('Not a MIDI file')
+    header_length, _, track_count, division = struct.unpack_from('>IHHH', data, 4)
+    if division & 0x8000:
+        raise ValueError('SMPTE time division is not supported')
+    notes = []
+    position = 8 + header_length
+    try:
+        for _ in range(track_count):
+            chunk_type, chunk_length = struct.unpack_from('>4sI', data, position)
+            position += 8
+            if chunk_type == b'MTrk':
+                notes.extend(_read_track_notes(data, position, min(position + chunk_length, len(data))))
+            position += chunk_length
+    except (IndexError, struct.error):
+        raise ValueError('Truncated MIDI file')
+    notes.sort()
+    return notes, division
+
+
+def _read_track_notes(data, position, end):
+    notes = []
+    sounding = {}  # (channel, pitch) -> start ticks of the notes still sounding, in order
+    tick = 0
+    status = None
+    while position < end:
+        delta, position = _read_variable_length(data, position)
+        tick += delta
+        if data[position] & 0x80:
+            status = data[position]
+            position += 1
+        elif status is None or status >= 0xF0:
+            raise ValueError('Running status without a preceding channel message')
+        if status == 0xFF:
+            meta_type = data[position]
+            length, position = _read_variable_length(data, position + 1)
+            position += length
+            status = None
+            if meta_type == 0x2F:  # end of track
+                break
+            continue
+        if status in (0xF0, 0xF7):
+            length, position = _read_variable_length(data, position)
+            position += length
+            status = None
+            continue
+        message, channel = status & 0xF0, status & 0x0F
+        if message in (0xC0, 0xD0):
+            position += 1
+            continue
+        pitch, velocity = data[position], data[position + 1]
+        position += 2
+        if channel == DRUM_CHANNEL:
+            continue
+        if message == 0x90 and velocity:
+            sounding.setdefault((channel, pitch), []).append(tick)
+        elif message == 0x80 or message == 0x90:
+            starts = sounding.get((channel, pitch))
+            if starts:
+                notes.append((starts.pop(0), tick, pitch))
+    return notes
+
+
+def quantize_notes(notes, ticks_per_beat, grid=GRID, rest_split=REST_SPLIT, long_note=LONG_NOTE,
+                   leap_split=LEAP_SPLIT, max_unit_notes=MAX_UNIT_NOTES, bar_beats=BAR_BEATS):
+    """Reduce notes to a single line and group it into note_units.
+
+    Note starts are snapped to a grid of grid beats; where several notes start together, the highest is kept (the
+    'skyline', which is usually the melody).  Melodies have no rests, so shorter rests are absorbed by the note
+    before them, and rests of at least rest_split beats are left out and end the note_unit.  A note_unit also ends
+    after a note of at least long_note beats, before a leap of more than leap_split semitones, at a bar line, or once
+    it holds max_unit_notes notes.
+
+    Args:
+        notes (List): (start tick, end tick, pitch) tuples, as returned by read_midi_notes()
+        ticks_per_beat (Int)
+    Returns:
+        Melody, or None if there are no notes
+    """
+    ticks_per_step = ticks_per_beat * grid
+    line = {}  # grid step -> (pitch, end tick)
+    for start, end, pitch in notes:
+        step = int(round(start / ticks_per_step))
+        if step not in line or pitch > line[step][0]:
+            line[step] = (pitch, end)
+    if not line:
+        return None
+    steps = sorted(line)
+    steps_per_bar = int(round(bar_beats / grid))
+    note_units = []
+    note_unit = []
+    for i, step in enumerate(steps):
+        pitch, end = line[step]
+        end_step = max(int(round(end / ticks_per_step)), step + 1)
+        next_step = steps[i + 1] if i + 1 < len(steps) else end_step
+        rest = (next_step - end_step) * grid
+        duration = ((end_step if rest >= rest_split else next_step) - step) * grid
+        if note_unit and (abs(pitch - note_unit[-1][0]) > leap_split or step % steps_per_bar == 0):
+            note_units.append(note_unit)
+            note_unit = []
+        note_unit.append([pitch, duration])
+        if rest >= rest_split or duration >= long_note or len(note_unit) >= max_unit_notes:
+            note_units.append(note_unit)
+            note_unit = []
+    if note_unit:
+        note_units.append(note_unit)
+    return Melody(note_units)
+
+
+def midi_file_to_melody(path, **quantize_kwargs):
+    """Read the MIDI file at path into a Melody; see quantize_notes() for quantize_kwargs.
+
+    Raises:
+        ValueError if the file can't be read
+    """
+    with open(path, 'rb') as midi_file:
+        notes, ticks_per_beat = read_midi_notes(midi_file.read())
+    return quantize_notes(notes, ticks_per_beat, **quantize_kwargs)
+
+
+def _import_file(path, quantize_kwargs):
+    """Runs in a worker process; returns (path, melody encoding or None, error message or None)."""
+    try:
+        melody = midi_file_to_melody(path, **quantize_kwargs)
+    except (OSError, ValueError) as error:
+        return path, None, str(error)
+    return path, None if melody is None else melody.to_bytes(), None
+
+
+def find_midi_files(directory):
+    """Yield the paths of the MIDI files under directory, walking it lazily."""
+    for root, directories, filenames in os.walk(directory):
+        directories.sort()
+        for filename in sorted(filenames):
+            if filename.lower().endswith(MIDI_SUFFIXES) and not filename.startswith('.'):
+                yield os.path.join(root, filename)
+
+
+def write_shard(path, records):
+    """Write (name, Melody) records to a shard file, atomically."""
+    parts = [SHARD_HEADER.pack(SHARD_MAGIC, SHARD_VERSION, len(records))]
+    for name, melody in records:
+        encoded_name = name.encode('utf-8')
+        encoding = melody if isinstance(melody, bytes) else melody.to_bytes()
+        parts.extend((SHARD_RECORD_HEADER.pack(len(encoded_name), len(encoding)), encoded_name, encoding))
+    temporary_path = f'{path}.{os.getpid()}.tmp'
+    with open(temporary_path, 'wb') as shard_file:
+        shard_file.write(zlib.compress(b''.join(parts)))
+    os.replace(temporary_path, path)
+    return path
+
+
+def read_shard(path):
+    """Yield the (name, Melody) records of a shard file.
+
+    Raises:
+        ValueError if the file isn't a shard of a known version
+    """
+    with open(path, 'rb') as shard_file:
+        data = zlib.decompress(shard_file.read())
+    magic, version, count = SHARD_HEADER.unpack_from(data)
+    if magic != SHARD_MAGIC or version != SHARD_VERSION:
+        raise ValueError(f'Not a version {SHARD_VERSION} melody shard: {path}')
+    position = SHARD_HEADER.size
+    for _ in range(count):
+        name_length, encoding_length = SHARD_RECORD_HEADER.unpack_from(data, position)
+        position += SHARD_RECORD_HEADER.size
+        name = data[position:position + name_length].decode('utf-8')
+        position += name_length
+        yield name, Melody.from_bytes(data[position:position + encoding_length])
+        position += encoding_length
+
+
+def shard_paths(directory):
+    return sorted(
+        os.path.join(directory, filename) for filename in os.listdir(directory) if filename.endswith(SHARD_SUFFIX))
+
+
+def read_corpus(directory):
+    """Yield the (name, Melody) records of every shard in directory, in order."""
+    for path in shard_paths(directory):
+        yield from read_shard(path)
+
+
+def bounded_map(executor, function, items, window, *args):
+    """Like executor.map, but only window calls are submitted ahead, so items can be an endless stream."""
+    items = iter(items)
+    pending = [executor.submit(function, item, *args) for item in islice(items, window)]
+    while pending:
+        result = pending.pop(0).result()
+        for item in islice(items, 1):
+            pending.append(executor.submit(function, item, *args))
+        yield result
+
+
+def import_corpus(paths, output_directory, shard_size=SHARD_SIZE, workers=None, deduplicate=True, progress=None,
+                  **quantize_kwargs):
+    """Import MIDI files into shards in output_directory.
+
+    Args:
+        paths (Iterable): MIDI files, or directories to search for them (see find_midi_files)
+        output_directory (String): created if necessary; shards are named corpus-00000.shard, corpus-00001.shard, ...
+            after any already there
+    Kwargs:
+        shard_size (Int): melodies per shard
+        workers (Int): the number of worker processes; defaults to the number of cores
+        deduplicate (Bool): skip melodies already imported in this run, by fingerprint
+        progress (Callable): called with the counts dict after every shard
+        quantize_kwargs: passed to quantize_notes()
+    Returns:
+        Dict of counts: 'imported', 'duplicate', 'empty' and 'failed' files, and 'shards' written
+    """
+    os.makedirs(output_directory, exist_ok=True)
+
+    def midi_files():
+        for path in paths:
+            if os.path.isdir(path):
+                yield from find_midi_files(path)
+            else:
+                yield path
+
+    counts = {'imported': 0, 'duplicate': 0, 'empty': 0, 'failed': 0, 'shards': 0}
+    first_shard = len(shard_paths(output_directory))
+    seen = set()
+    records = []
+
+    def flush():
+        write_shard(os.path.join(output_directory, f'corpus-{first_shard + counts["shards"]:05d}{SHARD_SUFFIX}'),
+                    records)
+        counts['shards'] += 1
+        records.clear()
+        if progress is not None:
+            progress(dict(counts))
+
+    workers = workers or os.cpu_count()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for path, encoding, error in bounded_map(executor, _import_file, midi_files(), workers * 16, quantize_kwargs):
+            if error is not None:
+                result = 'failed'
+            elif encoding is None:
+                result = 'empty'
+            else:
+                melody = Melody.from_bytes(encoding)
+                if deduplicate and melody.fingerprint in seen:
+                    result = 'duplicate'
+                else:
+                    result = 'imported'
+                    seen.add(melody.fingerprint)
+                    records.append((os.path.basename(path), encoding))
+            counts[result] += 1
+            CORPUS_FILES.inc(result=result)
+            if len(records) >= shard_size:
+                flush()
+    if records:
+        flush()
+    return counts
+
+
+def _export_shard(shard_path, output_directory, tempo):
+    """Runs in a worker process; writes every melody of a shard and returns how many."""
+    from mutator import MidiMaker  # imported here, like audio.render_with_fluidsynth, to keep importing light
+    count = 0
+    midi_maker = MidiMaker()
+    midi_maker.tempo = tempo
+    for _, melody in read_shard(shard_path):
+        midi_maker.melody = melody
+        with open(os.path.join(output_directory, f'{melody.fingerprint[:16]}.mid'), 'wb') as midi_file:
+            midi_file.write(midi_maker.to_bytes())
+        count += 1
+    return count
+
+
+def export_corpus(directory, output_directory, workers=None, tempo=120, progress=None):
+    """Write every melody in the shards in directory to output_directory as a MIDI file, named by content hash
+    like FileHandler.melody_to_filename; one shard per worker process at a time.  Returns the number written."""
+    os.makedirs(output_directory, exist_ok=True)
+    paths = shard_paths(directory)
+    exported = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for count in executor.map(_export_shard, paths, [output_directory] * len(paths), [tempo] * len(paths)):
+            exported += count
+            if progress is not None:
+                progress(exported)
+    return exported
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import MIDI files into melody shards, or export shards to MIDI.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    import_parser = subparsers.add_parser('import', help='read MIDI files into shards')
+    import_parser.add_argument('paths', nargs='+', help='MIDI files or directories holding them')
+    import_parser.add_argument('--output-directory', required=True)
+    import_parser.add_argument('--shard-size', type=int, default=SHARD_SIZE)
+    import_parser.add_argument('--grid', type=float, default=GRID, help='in beats')
+    import_parser.add_argument('--max-unit-notes', type=int, default=MAX_UNIT_NOTES)
+    import_parser.add_argument('--keep-duplicates', action='store_true')
+    import_parser.add_argument('--workers', type=int, help='number of worker processes (defaults to the number of cores)')
+    export_parser = subparsers.add_parser('export', help='write the melodies in shards to MIDI files')
+    export_parser.add_argument('directory', help='a directory of shards')
+    export_parser.add_argument('--output-directory', required=True)
+    export_parser.add_argument('--tempo', type=int, default=120)
+    export_parser.add_argument('--workers', type=int, help='number of worker processes (defaults to the number of cores)')
+    args = parser.parse_args()
+
+    if args.command == 'import':
+        counts = import_corpus(
+            args.paths, args.output_directory, shard_size=args.shard_size, workers=args.workers,
+            deduplicate=not args.keep_duplicates, grid=args.grid, max_unit_notes=args.max_unit_notes,
+            progress=lambda counts: print(f'{counts["imported"]} melodies imported', file=sys.stderr))
+        print(', '.join(f'{count} {name}' for name, count in counts.items()))
+    else:
+        exported = export_corpus(args.directory, args.output_directory, workers=args.workers, tempo=args.tempo)
+        print(f'{exported} melodies exported to {args.output_directory}')
+
+
+if __name__ == "__main__":
+    main()
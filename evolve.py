@@ -0,0 +1,161 @@
+"""Offline evolution of a melody over many generations, using a pool of worker processes.
+
+Every generation, each melody in the population has children generated by a Mutator, and a selection function picks
+the next population from the parents and their children.  Each breeding task gets its own random stream, derived
+from the run's seed, the generation number and the parent's position in the population, so a run can be reproduced
+exactly from its seed regardless of how many workers are used.  Every child, with its parent, delta and random
+state, can be recorded in a LineageStore for later analysis.
+
+example:
+    python evolve.py 48-1p0__51-0p25_53-0p25_55-1p0_51-0p5__48-2p0.mid --generations 500 --output-directory ~/evolved
+"""
+
+import os
+import json
+import random
+import argparse
+
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+import fitness
+from constraints import add_constraint_arguments, constraints_from_arguments
+from lineage import LineageStore
+from mutator import FileHandler, Mutator, MidiMaker
+
+
+def _task_rng(entropy, *spawn_key):
+    """Return a NumPy SeedSequence for one task of the run identified by entropy."""
+    return np.random.SeedSequence(entropy, spawn_key=spawn_key)
+
+
+def _breed(task):
+    """Generate the children of one melody; runs in a worker process.
+
+    Args:
+        task (Tuple): (melody, child_count, mutation_percentage, seed_sequence, constraints)
+    Returns:
+        Tuple of (List of Melodies, provenance Dict as filled in by Mutator.generate_unique)
+    """
+    melody, child_count, mutation_percentage, seed_sequence, constraints = task
+    rng = random.Random(int(seed_sequence.generate_state(1, np.uint64)[0]))
+    mutator = Mutator(seed_melody=melody, mutation_percentage=mutation_percentage, rng=rng, constraints=constraints)
+    provenance = {}
+    return mutator.generate_unique(count=child_count, provenance=provenance), provenance
+
+
+def random_selection(candidates, count, rng):
+    """Keep a random sample of count candidates (neutral drift); the default selection function.
+
+    Args:
+        candidates (List): Melodies
+        count (Int): the size of the next population
+        rng (numpy.random.Generator)
+    Returns:
+        List of Melodies
+    """
+    if len(candidates) <= count:
+        return list(candidates)
+    chosen = rng.choice(len(candidates), size=count, replace=False)
+    return [candidates[i] for i in sorted(chosen)]
+
+
+def fitness_selection(candidates, count, rng):
+    """Keep the count candidates ranked highest by the fitness scorers."""
+    return fitness.top_k(candidates, k=count)
+
+
+SELECTIONS = {'random': random_selection, 'fitness': fitness_selection}
+
+
+def evolve(seed_melody, generations, population_size=100, children_per_melody=10, mutation_percentage=5,
+           seed=None, workers=None, select=random_selection, lineage=None, constraints=None):
+    """Evolve seed_melody, yielding (generation number, population) after every generation.
+
+    Args:
+        seed_melody (Melody)
+        generations (Int)
+    Kwargs:
+        population_size (Int): the number of melodies kept after each generation
+        children_per_melody (Int): the number of distinct children generated for each melody
+        mutation_percentage (Int): passed to Mutator
+        seed (Int): seeds every random stream of the run; a random one is used if not given
+        workers (Int): the number of worker processes; defaults to the number of cores.  1 runs in-process.
+        select (Callable): select(candidates, count, rng) returns the next population
+        lineage (LineageStore): if given, every generated child is recorded in it
+        constraints (MutationConstraints): passed to Mutator
+    """
+    entropy = np.random.SeedSequence(seed).entropy
+    workers = workers or os.cpu_count()
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    map_function = executor.map if executor else map
+    population = [seed_melody]
+    try:
+        for generation in range(1, generations + 1):
+            tasks = [
+                (melody, children_per_melody, mutation_percentage, _task_rng(entropy, generation, i), constraints)
+                for i, melody in enumerate(population)
+            ]
+            candidates = list(population)
+            seen_fingerprints = {melody.fingerprint for melody in population}
+            for task, (children, provenance) in zip(tasks, map_function(_breed, tasks)):
+                if lineage is not None:
+                    lineage.add_candidates(task[0], children, provenance=provenance)
+                for child in children:
+                    if child.fingerprint not in seen_fingerprints:
+                        seen_fingerprints.add(child.fingerprint)
+                        candidates.append(child)
+            population = select(candidates, population_size, np.random.default_rng(_task_rng(entropy, generation)))
+            yield generation, population
+    finally:
+        if executor:
+            executor.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Evolve a melody offline over many generations.')
+    parser.add_argument('seed_file', help='melody filename, e.g. 48-1p0__51-0p25_53-0p25.mid')
+    parser.add_argument('--generations', type=int, default=100)
+    parser.add_argument('--population', type=int, default=100)
+    parser.add_argument('--children', type=int, default=10, help='children generated per melody per generation')
+    parser.add_argument('--mutation-percentage', type=int, default=5)
+    parser.add_argument('--selection', choices=sorted(SELECTIONS), default='fitness')
+    parser.add_argument('--seed', type=int, help='seed for a reproducible run')
+    parser.add_argument('--workers', type=int, help='number of worker processes (defaults to the number of cores)')
+    parser.add_argument('--output-directory', required=True)
+    parser.add_argument('--no-lineage', action='store_true',
+                        help="don't record every child in lineage.sqlite3 in the output directory")
+    add_constraint_arguments(parser)
+    args = parser.parse_args()
+
+    seed = args.seed if args.seed is not None else int(np.random.SeedSequence().entropy % 2**63)
+    print(f'seed: {seed}')
+    os.makedirs(args.output_directory, exist_ok=True)
+    seed_melody = FileHandler.filename_to_list(filename=os.path.basename(args.seed_file))
+    population = [seed_melody]
+    lineage = None if args.no_lineage else LineageStore(os.path.join(args.output_directory, 'lineage.sqlite3'))
+    with open(os.path.join(args.output_directory, 'generations.jsonl'), 'w') as log_file:
+        for generation, population in evolve(
+                seed_melody, args.generations, population_size=args.population,
+                children_per_melody=args.children, mutation_percentage=args.mutation_percentage, seed=seed,
+                workers=args.workers, select=SELECTIONS[args.selection], lineage=lineage,
+                constraints=constraints_from_arguments(args)):
+            log_file.write(json.dumps({
+                'generation': generation,
+                'population': [FileHandler.list_to_filename(melody_list=melody) for melody in population],
+            }) + '\n')
+            print(f'generation {generation}: {len(population)} melodies')
+
+    # named by content hash like FileHandler.melody_to_filename, but without recording anything in the app's index
+    final_directory = os.path.join(args.output_directory, 'final')
+    os.makedirs(final_directory, exist_ok=True)
+    midi_maker = MidiMaker()
+    for melody in population:
+        midi_maker.melody = melody
+        filename = f'{melody.fingerprint[:FileHandler.CONTENT_HASH_LENGTH]}.mid'
+        with open(os.path.join(final_directory, filename), 'wb') as midi_file:
+            midi_file.write(midi_maker.to_bytes())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""Automatic fitness scoring, used to pre-rank candidates so that people only listen to the most promising ones.
+
+A scorer takes a MelodyBatch and returns one score per melody, between 0 (worst) and 1 (best).  Scorers are
+registered by name with register_scorer(), and score() combines any of them with weights:
+
+    @register_scorer('no_repeated_notes')
+    def no_repeated_notes(batch):
+        ...
+
+    best = top_k(candidates, k=10, weights={'interval_size': 2, 'key_conformance': 1})
+"""
+
+import numpy as np
+
+from melody import TICKS_PER_BEAT
+
+
+SCORERS = {}
+
+MAJOR_SCALE = (0, 2, 4, 5, 7, 9, 11)
+LARGEST_INTERVAL = 12  # intervals of an octave or more get no credit from interval_size
+RHYTHMIC_GRID = 0.5  # in beats; note onsets on this grid count as regular
+
+
+class MelodyBatch(object):
+    """
+    Melodies encoded as padded NumPy arrays, so scorers can work on all of them at once.
+
+    pitches and durations (in beats) have shape (melody count, longest melody's note count); mask marks the entries
+    that hold real notes.  Melodies made with Melody.apply() are encoded by splicing their changed note_units into
+    their parent's arrays, so a batch of siblings only encodes the parent once.
+    """
+
+    def __init__(self, melodies):
+        self.melodies = list(melodies)
+        parent_rows = {}  # id(parent) -> (parent, pitches, ticks); the parent is kept so its id isn't reused
+        rows = [self._encode(melody, parent_rows) for melody in self.melodies]
+        self.lengths = np.array([len(row_pitches) for row_pitches, _ in rows], dtype=np.int64)
+        width = int(self.lengths.max()) if len(self.melodies) else 0
+        self.pitches = np.zeros((len(self.melodies), width), dtype=np.int64)
+        self.durations = np.zeros((len(self.melodies), width), dtype=np.float64)
+        for i, (row_pitches, row_ticks) in enumerate(rows):
+            self.pitches[i, :self.lengths[i]] = row_pitches
+            self.durations[i, :self.lengths[i]] = row_ticks / TICKS_PER_BEAT
+        self.mask = np.arange(width) < self.lengths[:, None]
+
+    @staticmethod
+    def _encode(melody, parent_rows):
+        """Return (pitches, ticks) arrays for melody."""
+        origin = melody.origin
+        if origin is None:
+            return np.frombuffer(melody.pitches, dtype=np.int8), np.frombuffer(melody.ticks, dtype=np.int32)
+        parent, delta = origin
+        if id(parent) not in parent_rows:
+            parent_rows[id(parent)] = (
+                parent, np.frombuffer(parent.pitches, dtype=np.int8), np.frombuffer(parent.ticks, dtype=np.int32))
+        _, parent_pitches, parent_ticks = parent_rows[id(parent)]
+        offsets = parent.offsets
+        pitch_pieces, tick_pieces = [], []
+        position = 0
+        for index, note_unit in sorted(delta, key=lambda change: change[0]):
+            pitch_pieces += [parent_pitches[position:offsets[index]], np.frombuffer(note_unit.pitches, dtype=np.int8)]
+            tick_pieces += [parent_ticks[position:offsets[index]], np.frombuffer(note_unit.ticks, dtype=np.int32)]
+            position = offsets[index + 1]
+        pitch_pieces.append(parent_pitches[position:])
+        tick_pieces.append(parent_ticks[position:])
+        return np.concatenate(pitch_pieces), np.concatenate(tick_pieces)
+
+    def __len__(self):
+        return len(self.melodies)
+
+
+def register_scorer(name):
+    """Decorator that adds a scorer to SCORERS under name."""
+    def decorator(scorer):
+        SCORERS[name] = scorer
+        return scorer
+    return decorator
+
+
+def _masked_mean(values, mask, empty_value=1.0):
+    """Mean of values along axis 1, counting only entries where mask is True."""
+    counts = mask.sum(axis=1)
+    totals = np.where(mask, values, 0).sum(axis=1)
+    return np.where(counts > 0, totals / np.maximum(counts, 1), empty_value)
+
+
+@register_scorer('interval_size')
+def interval_size(batch):
+    """Favor small intervals between consecutive notes."""
+    intervals = np.abs(np.diff(batch.pitches, axis=1))
+    interval_scores = 1 - np.minimum(intervals, LARGEST_INTERVAL) / LARGEST_INTERVAL
+    return _masked_mean(interval_scores, batch.mask[:, 1:])
+
+
+@register_scorer('key_conformance')
+def key_conformance(batch):
+    """The share of the melody's duration spent in the major key that fits it best."""
+    pitch_class_durations = np.zeros((len(batch), 12))
+    rows = np.broadcast_to(np.arange(len(batch))[:, None], batch.pitches.shape)
+    np.add.at(pitch_class_durations, (rows, batch.pitches % 12), np.where(batch.mask, batch.durations, 0))
+    keys = np.zeros((12, 12))
+    for tonic in range(12):
+        keys[tonic, [(tonic + degree) % 12 for degree in MAJOR_SCALE]] = 1
+    total_durations = pitch_class_durations.sum(axis=1)
+    in_key_durations = (pitch_class_durations @ keys.T).max(axis=1)
+    return np.where(total_durations > 0, in_key_durations / np.maximum(total_durations, 1e-9), 1.0)
+
+
+@register_scorer('rhythmic_regularity')
+def rhythmic_regularity(batch):
+    """The share of notes that start on the RHYTHMIC_GRID."""
+    onsets = np.cumsum(batch.durations, axis=1) - batch.durations
+    steps = onsets / RHYTHMIC_GRID
+    on_grid = np.isclose(steps, np.round(steps))
+    return _masked_mean(on_grid.astype(np.float64), batch.mask)
+
+
+@register_scorer('contour_smoothness')
+def contour_smoothness(batch):
+    """Penalize changes of melodic direction, so that lines move in phrases rather than zig-zagging."""
+    directions = np.sign(np.diff(batch.pitches, axis=1))
+    reversals = (directions[:, 1:] * directions[:, :-1]) < 0
+    return 1 - _masked_mean(reversals.astype(np.float64), batch.mask[:, 2:], empty_value=0.0)
+
+
+def score(melodies, weights=None):
+    """Score melodies with the registered scorers.
+
+    Args:
+        melodies (List): Melodies, or a MelodyBatch
+    Kwargs:
+        weights (Dict): scorer name to weight; defaults to every registered scorer with a weight of 1
+    Returns:
+        numpy array with the weighted mean score of each melody
+    """
+    batch = melodies if isinstance(melodies, MelodyBatch) else MelodyBatch(melodies)
+    if weights is None:
+        weights = {name: 1 for name in SCORERS}
+    total = np.zeros(len(batch))
+    for name, weight in weights.items():
+        total += weight * SCORERS[name](batch)
+    return total / max(sum(weights.values()), 1e-9)
+
+
+def top_k(melodies, k, weights=None):
+    """Return the k best scoring melodies, best first."""
+    if not melodies:
+        return []
+    scores = score(melodies, weights=weights)
+    # a stable sort keeps generation order among ties
+    order = np.argsort(-scores, kind='stable')[:k]
+    return [melodies[i] for i in order]
@@ -0,0 +1,263 @@
+import time
+
+from melody import Melody, delta_to_bytes, delta_from_bytes
+from sqlite_store import SQLiteStore
+
+
+class LineageStore(SQLiteStore):
+    """
+    A SQLite store of the lineage DAG: every generated candidate, the parent melodies it was generated from, the
+    delta from each parent (see Melody.apply) and the random state that produced it.
+
+    Only roots (melodies recorded without a known parent) and selected melodies keep their full encoding; any other
+    melody is rebuilt by applying deltas from its nearest stored ancestor, so tens of thousands of candidates take
+    little space.  The random state is what Mutator.generate_unique() drew the candidate with, so
+
+        Mutator(parent, mutation_percentage, operator_weights=operator_weights).mutate_batch_deltas(
+            batch_size, rng=rng_seed)[batch_position]
+
+    regenerates its delta.  Selections are numbered as steps, so a progression can be paged through and replayed
+    without listing directories.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS melodies (
+            id INTEGER PRIMARY KEY,
+            fingerprint BLOB NOT NULL UNIQUE,
+            encoding BLOB,
+            offered INTEGER NOT NULL DEFAULT 0,
+            created REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS edges (
+            child INTEGER NOT NULL,
+            parent INTEGER NOT NULL,
+            delta BLOB NOT NULL,
+            rng_seed BLOB,
+            batch_size INTEGER,
+            batch_position INTEGER,
+            mutation_percentage INTEGER,
+            operator_weights BLOB,
+            PRIMARY KEY (child, parent)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS edges_by_parent ON edges (parent, child);
+        CREATE TABLE IF NOT EXISTS selections (
+            step INTEGER PRIMARY KEY,
+            melody INTEGER NOT NULL,
+            selected REAL NOT NULL
+        );
+    """
+
+    QUERY_CHUNK_SIZE = 500  # ids per IN (...) clause, well below SQLite's limit on query parameters
+
+    def __init__(self, path, timeout=30):
+        """
+        Args:
+            path (String): the SQLite database file; created if necessary
+        Kwargs:
+            timeout (Int): seconds to wait for another process's write lock
+        """
+        super(LineageStore, self).__init__(path, timeout=timeout)
+        edge_columns = [row[1] for row in self.connection.execute('PRAGMA table_info(edges)')]
+        if 'operator_weights' not in edge_columns:  # stores created before operator weights were recorded
+            self.connection.execute('ALTER TABLE edges ADD COLUMN operator_weights BLOB')
+
+    @staticmethod
+    def _key(fingerprint):
+        """Fingerprints are stored as 16 raw bytes rather than 32 hex digits; malformed ones map to an empty key,
+        which matches nothing."""
+        try:
+            return bytes.fromhex(fingerprint)
+        except ValueError:
+            return b''
+
+    def find(self, prefix):
+        """Return the fingerprint of a recorded melody that starts with the hex digits prefix (e.g. the content hash
+        of a filename, see FileHandler.melody_to_filename), or None."""
+        key = self._key(prefix)
+        if not key:
+            return None
+        fingerprint = self._value(
+            'SELECT fingerprint FROM melodies WHERE fingerprint BETWEEN ? AND ? ORDER BY fingerprint LIMIT 1',
+            (key, key + b'\xff' * (16 - len(key))))
+        return None if fingerprint is None else fingerprint.hex()
+
+    def _melody_id(self, fingerprint):
+        return self._value('SELECT id FROM melodies WHERE fingerprint = ?', (self._key(fingerprint),))
+
+    def _add_melody(self, melody, store_encoding=False):
+        """Return the id of melody, adding it if needed.  A melody that can't be rebuilt from a parent (because it
+        has none yet) always stores its encoding."""
+        melody_id = self._melody_id(melody.fingerprint)
+        if melody_id is None:
+            return self.connection.execute(
+                'INSERT INTO melodies (fingerprint, encoding, created) VALUES (?, ?, ?)',
+                (self._key(melody.fingerprint), melody.to_bytes(), time.time())).lastrowid
+        if store_encoding:
+            self.connection.execute(
+                'UPDATE melodies SET encoding = ? WHERE id = ? AND encoding IS NULL', (melody.to_bytes(), melody_id))
+        return melody_id
+
+    def __len__(self):
+        return self._value('SELECT COUNT(*) FROM melodies')
+
+    def __contains__(self, fingerprint):
+        return self._melody_id(fingerprint) is not None
+
+    def add_candidates(self, parent, candidates, provenance=None):
+        """Record candidates generated from parent.
+
+        Args:
+            parent (Melody)
+            candidates (List): Melodies with the same number of note_units as parent
+        Kwargs:
+            provenance (Dict): fingerprint -> (rng_seed, batch_size, batch_position, mutation_percentage,
+                operator_weights), as filled in by Mutator.generate_unique()
+        """
+        provenance = provenance or {}
+        candidates = [candidate for candidate in candidates if candidate.fingerprint != parent.fingerprint]
+        created = time.time()
+        with self.transaction():
+            parent_id = self._add_melody(parent)
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO melodies (fingerprint, created) VALUES (?, ?)',
+                [(self._key(candidate.fingerprint), created) for candidate in candidates])
+            edges = []
+            for candidate in candidates:
+                rng_seed, batch_size, batch_position, mutation_percentage, operator_weights = provenance.get(
+                    candidate.fingerprint, (None, None, None, None, None))
+                edges.append((
+                    self._melody_id(candidate.fingerprint), parent_id, delta_to_bytes(candidate.diff(parent)),
+                    None if rng_seed is None else rng_seed.to_bytes(8, 'little'),
+                    batch_size, batch_position, mutation_percentage,
+                    None if operator_weights is None else bytes(operator_weights)))
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO edges (child, parent, delta, rng_seed, batch_size, batch_position, '
+                'mutation_percentage, operator_weights) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', edges)
+
+    def edge(self, child, parent):
+        """Return how child was generated from parent: a (delta, provenance) pair, with the provenance as in
+        add_candidates(), or None if no such edge is recorded.
+
+        Args:
+            child (String): a fingerprint
+            parent (String): a fingerprint
+        """
+        row = self.connection.execute(
+            'SELECT delta, rng_seed, batch_size, batch_position, mutation_percentage, operator_weights FROM edges '
+            'WHERE child = (SELECT id FROM melodies WHERE fingerprint = ?) '
+            'AND parent = (SELECT id FROM melodies WHERE fingerprint = ?)',
+            (self._key(child), self._key(parent))).fetchone()
+        if row is None:
+            return None
+        delta, rng_seed, batch_size, batch_position, mutation_percentage, operator_weights = row
+        return delta_from_bytes(delta), (
+            None if rng_seed is None else int.from_bytes(rng_seed, 'little'), batch_size, batch_position,
+            mutation_percentage, None if operator_weights is None else tuple(operator_weights))
+
+    def mark_offered(self, melodies):
+        """Record that melodies were shown for review."""
+        self.connection.executemany(
+            'UPDATE melodies SET offered = 1 WHERE fingerprint = ?',
+            [(self._key(melody.fingerprint),) for melody in melodies])
+
+    def add_selection(self, melody):
+        """Record melody as the next step of the progression; returns the step number."""
+        with self.transaction():
+            melody_id = self._add_melody(melody, store_encoding=True)
+            step = self._value('SELECT COALESCE(MAX(step), 0) + 1 FROM selections')
+            self.connection.execute(
+                'INSERT INTO selections (step, melody, selected) VALUES (?, ?, ?)', (step, melody_id, time.time()))
+        return step
+
+    def step_count(self):
+        return self._value('SELECT COUNT(*) FROM selections')
+
+    def steps(self, start=1, count=50):
+        """Return (step, fingerprint) pairs for up to count steps, starting at step start."""
+        rows = self.connection.execute(
+            'SELECT step, fingerprint FROM selections JOIN melodies ON melodies.id = selections.melody '
+            'WHERE step >= ? ORDER BY step LIMIT ?', (start, count))
+        return [(step, fingerprint.hex()) for step, fingerprint in rows]
+
+    def replay(self, start=1, count=50):
+        """Return (step, Melody) pairs for up to count steps, starting at step start."""
+        rows = self.connection.execute(
+            'SELECT step, encoding FROM selections JOIN melodies ON melodies.id = selections.melody '
+            'WHERE step >= ? ORDER BY step LIMIT ?', (start, count))
+        return [(step, Melody.from_bytes(encoding)) for step, encoding in rows]
+
+    def melody(self, fingerprint):
+        """Rebuild the melody stored under fingerprint, or return None if it isn't in the store.
+
+        Deltas are applied along the chain of earliest recorded parents, which always ends at a stored encoding.
+        """
+        rows = self.connection.execute("""
+            WITH RECURSIVE chain (id, delta, depth) AS (
+                SELECT id, NULL, 0 FROM melodies WHERE fingerprint = ?
+                UNION ALL
+                SELECT edges.parent, edges.delta, chain.depth + 1
+                FROM chain JOIN edges ON edges.child = chain.id
+                WHERE edges.parent = (SELECT MIN(parent) FROM edges WHERE child = chain.id)
+                    AND (SELECT encoding FROM melodies WHERE id = chain.id) IS NULL
+            )
+            SELECT chain.delta, melodies.encoding FROM chain JOIN melodies ON melodies.id = chain.id
+            ORDER BY chain.depth DESC
+        """, (self._key(fingerprint),)).fetchall()
+        if not rows:
+            return None
+        melody = Melody.from_bytes(rows[0][1])
+        for delta, _ in rows:
+            if delta is not None:
+                melody = melody.apply(delta_from_bytes(delta))
+        return melody
+
+    def parents(self, fingerprint):
+        """Return the fingerprints of the melodies fingerprint was generated from."""
+        rows = self.connection.execute(
+            'SELECT parents.fingerprint FROM melodies JOIN edges ON edges.child = melodies.id '
+            'JOIN melodies AS parents ON parents.id = edges.parent WHERE melodies.fingerprint = ?',
+            (self._key(fingerprint),))
+        return [row[0].hex() for row in rows]
+
+    def children(self, fingerprint):
+        """Return the fingerprints of the melodies generated from fingerprint."""
+        rows = self.connection.execute(
+            'SELECT children.fingerprint FROM melodies JOIN edges ON edges.parent = melodies.id '
+            'JOIN melodies AS children ON children.id = edges.child WHERE melodies.fingerprint = ?',
+            (self._key(fingerprint),))
+        return [row[0].hex() for row in rows]
+
+    def _related(self, fingerprint, from_column, to_column, max_depth):
+        """Walk the edges breadth first, one query per generation; melodies met again (a mutation can undo an earlier
+        one) are only reported at their nearest depth."""
+        melody_id = self._melody_id(fingerprint)
+        if melody_id is None:
+            return []
+        visited = {melody_id}
+        frontier = [melody_id]
+        related = []
+        depth = 0
+        while frontier and (max_depth is None or depth < max_depth):
+            depth += 1
+            next_frontier = []
+            for start in range(0, len(frontier), self.QUERY_CHUNK_SIZE):
+                chunk = frontier[start:start + self.QUERY_CHUNK_SIZE]
+                rows = self.connection.execute(
+                    f'SELECT DISTINCT edges.{to_column}, melodies.fingerprint FROM edges '
+                    f'JOIN melodies ON melodies.id = edges.{to_column} '
+                    f'WHERE edges.{from_column} IN ({", ".join("?" * len(chunk))})', chunk)
+                for related_id, related_fingerprint in rows:
+                    if related_id not in visited:
+                        visited.add(related_id)
+                        next_frontier.append(related_id)
+                        related.append((related_fingerprint.hex(), depth))
+            frontier = next_frontier
+        return related
+
+    def ancestors(self, fingerprint, max_depth=None):
+        """Return (fingerprint, generations back) pairs for every ancestor, nearest first."""
+        return self._related(fingerprint, 'child', 'parent', max_depth)
+
+    def descendants(self, fingerprint, max_depth=None):
+        """Return (fingerprint, generations down) pairs for every descendant, nearest first."""
+        return self._related(fingerprint, 'parent', 'child', max_depth)
@@ -0,0 +1,406 @@
+import sys
+import base64
+import struct
+import hashlib
+import weakref
+from array import array
+
+
+TICKS_PER_BEAT = 960  # fixed-point resolution for durations; matches midiutil's default ticks per quarter note
+LOWEST_PITCH = 0
+HIGHEST_PITCH = 127
+
+# Binary melody encoding (see Melody.to_bytes), all little-endian:
+#   version (uint8), tick typecode ('H' or 'i'), note_unit count (uint32),
+#   note_unit lengths (uint16 each), pitches (int8 each), durations in ticks (uint16 or int32 each)
+CODEC_VERSION = 1
+CODEC_HEADER = struct.Struct('<BcI')
+
+# Binary delta encoding (see delta_to_bytes), all little-endian.  For each changed note_unit:
+#   note_unit index (uint32), length (uint16), pitches (int8 each), durations in ticks (int32 each)
+DELTA_ENTRY_HEADER = struct.Struct('<IH')
+
+
+def _validate_notes(pitches, ticks):
+    """Raise ValueError unless pitches are in the midi range and ticks aren't negative; for decoded arrays, which
+    NoteUnit.from_arrays doesn't validate."""
+    if pitches and (min(pitches) < LOWEST_PITCH or max(pitches) > HIGHEST_PITCH):
+        raise ValueError(f'Pitches must be between {LOWEST_PITCH} and {HIGHEST_PITCH}')
+    if ticks and min(ticks) < 0:
+        raise ValueError('Durations must not be negative')
+
+
+def beats_to_ticks(duration):
+    """Convert a duration in beats to an integer number of ticks."""
+    return int(round(duration * TICKS_PER_BEAT))
+
+
+def ticks_to_beats(ticks):
+    """Convert an integer number of ticks to a duration in beats."""
+    return ticks / TICKS_PER_BEAT
+
+
+class NoteUnit(object):
+    """
+    An immutable group of notes.
+
+    Pitches are stored as int8 midi note numbers and durations as integer ticks (see TICKS_PER_BEAT).  Iterating over
+    a NoteUnit yields (pitch, duration) tuples with the duration in beats, so it can be used anywhere the old
+    [[pitch, duration], ...] lists were.
+    """
+
+    __slots__ = ('_pitches', '_ticks', '_hash', '_digest', '_derived')
+
+    def __init__(self, notes):
+        """
+        Args:
+            notes (Iterable): (midi note number, duration in beats) pairs
+        Raises:
+            ValueError if a pitch is outside of the midi range
+        """
+        notes = list(notes)  # may be a generator; it's read twice
+        pitches = [note[0] for note in notes]
+        if any(pitch < LOWEST_PITCH or pitch > HIGHEST_PITCH for pitch in pitches):
+            raise ValueError(f'Pitches must be between {LOWEST_PITCH} and {HIGHEST_PITCH}: {pitches}')
+        self._pitches = array('b', pitches)
+        self._ticks = array('i', [beats_to_ticks(note[1]) for note in notes])
+        self._hash = None
+        self._digest = None
+        self._derived = None
+
+    @classmethod
+    def from_arrays(cls, pitches, ticks):
+        """Build a NoteUnit directly from pitch and tick arrays, skipping validation."""
+        note_unit = cls.__new__(cls)
+        note_unit._pitches = array('b', pitches)
+        note_unit._ticks = array('i', ticks)
+        note_unit._hash = None
+        note_unit._digest = None
+        note_unit._derived = None
+        return note_unit
+
+    @property
+    def pitches(self):
+        return self._pitches
+
+    @property
+    def ticks(self):
+        return self._ticks
+
+    @property
+    def digest(self):
+        """A stable 16 byte digest of the note_unit, over its little-endian notes; Melody.fingerprint is built from
+        these."""
+        if self._digest is None:
+            ticks = self._ticks
+            if sys.byteorder == 'big':
+                ticks = array('i', ticks)
+                ticks.byteswap()
+            digest = hashlib.blake2b(digest_size=16)
+            digest.update(len(self._pitches).to_bytes(4, 'little'))
+            digest.update(self._pitches.tobytes())
+            digest.update(ticks.tobytes())
+            self._digest = digest.digest()
+        return self._digest
+
+    def cached(self, key, compute):
+        """Return compute(self), remembering the result under key.  Used for values derived from a NoteUnit (such as
+        its midi events), so the melodies that share it only compute them once."""
+        if self._derived is None:
+            self._derived = {}
+        if key not in self._derived:
+            self._derived[key] = compute(self)
+        return self._derived[key]
+
+    def __len__(self):
+        return len(self._pitches)
+
+    def __getitem__(self, index):
+        return self._pitches[index], ticks_to_beats(self._ticks[index])
+
+    def __iter__(self):
+        for pitch, ticks in zip(self._pitches, self._ticks):
+            yield pitch, ticks_to_beats(ticks)
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, NoteUnit):
+            return NotImplemented
+        return self._pitches == other._pitches and self._ticks == other._ticks
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash((self._pitches.tobytes(), self._ticks.tobytes()))
+        return self._hash
+
+    def __reduce__(self):
+        # leave out the cached hash: hashes of bytes differ between processes
+        return NoteUnit.from_arrays, (self._pitches, self._ticks)
+
+    def __repr__(self):
+        return f'NoteUnit({[list(note) for note in self]})'
+
+    def to_list(self):
+        return [list(note) for note in self]
+
+
+class Melody(object):
+    """
+    An immutable sequence of NoteUnits.
+
+    Melodies derived from one another share the NoteUnit objects they have in common (see replace() and apply()), so
+    a mutated melody only allocates the note_units that actually changed, and comparing, hashing or rendering it only
+    does new work for those.
+    """
+
+    __slots__ = ('_note_units', '_hash', '_offsets', '_fingerprint', '_origin', '__weakref__')
+
+    def __init__(self, note_units):
+        """
+        Args:
+            note_units (Iterable): NoteUnits, or lists of (midi note number, duration in beats) pairs
+        """
+        self._note_units = tuple(
+            note_unit if isinstance(note_unit, NoteUnit) else NoteUnit(note_unit) for note_unit in note_units)
+        self._hash = None
+        self._offsets = None
+        self._fingerprint = None
+        self._origin = None
+
+    @property
+    def note_units(self):
+        return self._note_units
+
+    @property
+    def origin(self):
+        """(parent Melody, delta) if this melody was made by parent.apply(delta) and parent is still alive, else None.
+        Only a weak reference to the parent is kept, so lineages don't keep every ancestor in memory."""
+        if self._origin is None:
+            return None
+        parent = self._origin[0]()
+        return None if parent is None else (parent, self._origin[1])
+
+    @property
+    def offsets(self):
+        """Flat note index at which each note_unit starts, followed by the total number of notes."""
+        if self._offsets is None:
+            origin = self.origin
+            if origin is not None and origin[0]._offsets is not None and all(
+                    len(note_unit) == len(origin[0][index]) for index, note_unit in origin[1]):
+                # no note_unit changed length, so the parent's offsets still hold
+                self._offsets = origin[0]._offsets
+                return self._offsets
+            offsets = array('i', [0])
+            for note_unit in self._note_units:
+                offsets.append(offsets[-1] + len(note_unit))
+            self._offsets = offsets
+        return self._offsets
+
+    @property
+    def fingerprint(self):
+        """A canonical hex digest of the melody.  Unlike hash(), it is stable across processes and hosts, so it can be
+        persisted and used to key files and caches.  It is built from the note_units' cached digests, so a mutated
+        melody only digests the note_units that changed."""
+        if self._fingerprint is None:
+            self._fingerprint = hashlib.blake2b(
+                b''.join([note_unit.digest for note_unit in self._note_units]), digest_size=16).hexdigest()
+        return self._fingerprint
+
+    @property
+    def pitches(self):
+        """All pitches of the melody as a flat int8 array."""
+        pitches = array('b')
+        for note_unit in self._note_units:
+            pitches.extend(note_unit.pitches)
+        return pitches
+
+    @property
+    def ticks(self):
+        """All durations of the melody, in ticks, as a flat array."""
+        ticks = array('i')
+        for note_unit in self._note_units:
+            ticks.extend(note_unit.ticks)
+        return ticks
+
+    def replace(self, replacements):
+        """Return a new Melody with some note_units replaced, sharing every other NoteUnit with this one.
+
+        Args:
+            replacements (Dict): maps note_unit index to the replacement NoteUnit (or list of notes)
+        Returns:
+            Melody
+        """
+        return self.apply(replacements.items())
+
+    def apply(self, delta):
+        """Return a new Melody with a delta applied, sharing every unchanged NoteUnit with this one.
+
+        Args:
+            delta (Iterable): (note_unit index, replacement NoteUnit or list of notes) pairs, as returned by
+                Mutator.mutate_delta()
+        Returns:
+            Melody
+        """
+        note_units = list(self._note_units)
+        applied = []
+        for index, note_unit in delta:
+            if not isinstance(note_unit, NoteUnit):
+                note_unit = NoteUnit(note_unit)
+            note_units[index] = note_unit
+            applied.append((index, note_unit))
+        melody = Melody(note_units)
+        melody._origin = (weakref.ref(self), tuple(applied))
+        return melody
+
+    def diff(self, parent):
+        """Return the delta that turns parent into this melody, so that parent.apply(delta) == self.
+
+        Raises:
+            ValueError if the melodies have different numbers of note_units; mutations never change that
+        """
+        origin = self.origin
+        if origin is not None and origin[0] is parent:
+            return list(origin[1])
+        if len(self._note_units) != len(parent._note_units):
+            raise ValueError('Only melodies with the same number of note_units can be diffed')
+        return [
+            (index, note_unit) for index, (note_unit, parent_note_unit) in enumerate(zip(self, parent))
+            if note_unit is not parent_note_unit and note_unit != parent_note_unit
+        ]
+
+    def __len__(self):
+        return len(self._note_units)
+
+    def __getitem__(self, index):
+        return self._note_units[index]
+
+    def __iter__(self):
+        return iter(self._note_units)
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, Melody):
+            return NotImplemented
+        return self._note_units == other._note_units
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash(self._note_units)
+        return self._hash
+
+    def __reduce__(self):
+        # leave out the cached hash, offsets and origin so melodies can be sent to worker processes
+        return Melody, (self._note_units,)
+
+    def __repr__(self):
+        return f'Melody({self.to_list()})'
+
+    def to_bytes(self):
+        """Encode the melody in the compact, versioned binary format described by CODEC_HEADER."""
+        ticks = self.ticks
+        tick_typecode = 'H' if max(ticks, default=0) < 2**16 else 'i'
+        lengths = array('H', [len(note_unit) for note_unit in self._note_units])
+        ticks = array(tick_typecode, ticks)
+        if sys.byteorder == 'big':
+            lengths.byteswap()
+            ticks.byteswap()
+        header = CODEC_HEADER.pack(CODEC_VERSION, tick_typecode.encode(), len(lengths))
+        return header + lengths.tobytes() + self.pitches.tobytes() + ticks.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Decode a melody encoded by to_bytes().
+
+        Raises:
+            ValueError if the data uses an unknown version, is truncated, or holds notes outside the midi range
+        """
+        try:
+            version, tick_typecode, unit_count = CODEC_HEADER.unpack_from(data)
+        except struct.error:
+            raise ValueError('Truncated melody encoding')
+        if version != CODEC_VERSION:
+            raise ValueError(f'Unknown melody encoding version: {version}')
+        if tick_typecode not in (b'H', b'i'):
+            raise ValueError(f'Unknown tick typecode: {tick_typecode!r}')
+        position = CODEC_HEADER.size
+        lengths = array('H')
+        lengths.frombytes(data[position:position + unit_count * lengths.itemsize])
+        position += unit_count * lengths.itemsize
+        if sys.byteorder == 'big':
+            lengths.byteswap()
+        note_count = sum(lengths)
+        pitches = array('b')
+        pitches.frombytes(data[position:position + note_count])
+        position += note_count
+        ticks = array(tick_typecode.decode())
+        ticks.frombytes(data[position:position + note_count * ticks.itemsize])
+        if sys.byteorder == 'big':
+            ticks.byteswap()
+        if len(lengths) != unit_count or len(pitches) != note_count or len(ticks) != note_count:
+            raise ValueError('Truncated melody encoding')
+        _validate_notes(pitches, ticks)
+        note_units = []
+        start = 0
+        for length in lengths:
+            note_units.append(NoteUnit.from_arrays(pitches[start:start + length], ticks[start:start + length]))
+            start += length
+        return cls(note_units)
+
+    def to_base64(self):
+        """Encode the melody as URL-safe text, e.g. for forms and query strings."""
+        return base64.urlsafe_b64encode(self.to_bytes()).decode('ascii')
+
+    @classmethod
+    def from_base64(cls, text):
+        """Decode a melody encoded by to_base64().
+
+        Raises:
+            ValueError if text isn't valid base64, or as from_bytes()
+        """
+        return cls.from_bytes(base64.urlsafe_b64decode(text.encode('ascii')))
+
+    def to_list(self):
+        """Return the melody in the nested list notation described in FileHandler."""
+        return [note_unit.to_list() for note_unit in self._note_units]
+
+
+def delta_to_bytes(delta):
+    """Encode a delta (see Melody.apply) in the format described by DELTA_ENTRY_HEADER."""
+    parts = []
+    for index, note_unit in delta:
+        ticks = array('i', note_unit.ticks)
+        if sys.byteorder == 'big':
+            ticks.byteswap()
+        parts += [DELTA_ENTRY_HEADER.pack(index, len(note_unit)), note_unit.pitches.tobytes(), ticks.tobytes()]
+    return b''.join(parts)
+
+
+def delta_from_bytes(data):
+    """Decode a delta encoded by delta_to_bytes(); returns a list of (note_unit index, NoteUnit) pairs.
+
+    Raises:
+        ValueError if the data is truncated or holds notes outside the midi range
+    """
+    delta = []
+    position = 0
+    while position < len(data):
+        try:
+            index, length = DELTA_ENTRY_HEADER.unpack_from(data, position)
+        except struct.error:
+            raise ValueError('Truncated delta encoding')
+        position += DELTA_ENTRY_HEADER.size
+        pitches = array('b')
+        pitches.frombytes(data[position:position + length])
+        position += length
+        ticks = array('i')
+        ticks.frombytes(data[position:position + length * ticks.itemsize])
+        position += length * ticks.itemsize
+        if sys.byteorder == 'big':
+            ticks.byteswap()
+        if len(pitches) != length or len(ticks) != length:
+            raise ValueError('Truncated delta encoding')
+        _validate_notes(pitches, ticks)
+        delta.append((index, NoteUnit.from_arrays(pitches, ticks)))
+    return delta
@@ -0,0 +1,115 @@
+"""Minimal in-process metrics, rendered in the Prometheus text exposition format by the /metrics route.
+
+Counters and histograms are created with counter() and histogram(), which register them for render().  Values are
+per process: work done in ProcessPoolExecutor workers is not included.
+"""
+
+import time
+import threading
+from functools import wraps
+
+
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REGISTRY = []
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(label_key, extra=()):
+    pairs = list(label_key) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+
+class Counter(object):
+    """A monotonically increasing count, optionally split by labels."""
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(_label_key(labels), 0)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f'{self.name}{_format_labels(key)} {value}')
+        return lines
+
+
+class Histogram(object):
+    """Counts observations (usually durations in seconds) into cumulative buckets, optionally split by labels."""
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.values = {}  # label key -> [bucket counts..., sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self.lock:
+            values = self.values.setdefault(key, [0] * (len(self.buckets) + 2))
+            for i, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    values[i] += 1
+            values[-2] += value
+            values[-1] += 1
+
+    def time(self, **labels):
+        """Decorator that observes the duration of every call to the decorated function."""
+        def decorator(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.observe(time.perf_counter() - start, **labels)
+            return wrapper
+        return decorator
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            for key, values in sorted(self.values.items()):
+                for upper_bound, bucket_count in zip(self.buckets, values):
+                    lines.append(f'{self.name}_bucket{_format_labels(key, [("le", upper_bound)])} {bucket_count}')
+                lines.append(f'{self.name}_bucket{_format_labels(key, [("le", "+Inf")])} {values[-1]}')
+                lines.append(f'{self.name}_sum{_format_labels(key)} {values[-2]}')
+                lines.append(f'{self.name}_count{_format_labels(key)} {values[-1]}')
+        return lines
+
+
+def counter(name, documentation):
+    metric = Counter(name, documentation)
+    REGISTRY.append(metric)
+    return metric
+
+
+def histogram(name, documentation, buckets=DEFAULT_BUCKETS):
+    metric = Histogram(name, documentation, buckets=buckets)
+    REGISTRY.append(metric)
+    return metric
+
+
+def render():
+    """Return every registered metric in the Prometheus text format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,14 @@
+"""Rename the seed, progression and output files written with the melody notation as their filename to hashed
+filenames, recording each melody in the index (see FileHandler.migrate_filenames).  Safe to run more than once."""
+
+from mutator import FileHandler
+
+
+def main():
+    file_handler = FileHandler()
+    file_handler.migrate_filenames()
+    print(f'Migrated files under {file_handler.root_directory}')
+
+
+if __name__ == "__main__":
+    main()
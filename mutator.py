@@ -1,10 +1,44 @@
+import bisect
+import io
 import os
 import shutil
 import datetime
 import random
+import re
+import struct
+import logging
+import threading
 
+import numpy as np
+from contextlib import contextmanager
+from functools import lru_cache
 from pathlib import Path
 from midiutil import MIDIFile
+try:
+    import fcntl
+except ImportError:  # not available on Windows; seed swaps are then only serialized by the index's transactions
+    fcntl = None
+
+import cache
+import corpus
+import metrics
+from melody import Melody, NoteUnit, LOWEST_PITCH, HIGHEST_PITCH, TICKS_PER_BEAT
+from lineage import LineageStore
+from progression_index import ProgressionIndex
+
+
+logger = logging.getLogger(__name__)
+
+FILE_HANDLER_SECONDS = metrics.histogram('evolving_file_handler_seconds', 'Time spent in FileHandler methods.')
+MIDI_SECONDS = metrics.histogram('evolving_midi_seconds', 'Time spent rendering and writing midi files.')
+MUTATION_SECONDS = metrics.histogram('evolving_mutation_seconds', 'Time spent generating mutated melodies.')
+CANDIDATES_DRAWN = metrics.counter('evolving_candidates_drawn_total', 'Candidates drawn by Mutator.generate_unique.')
+CANDIDATES_REJECTED = metrics.counter(
+    'evolving_candidates_rejected_total', 'Candidates rejected as duplicates or as already seen in the lineage.')
+GENERATION_RETRIES = metrics.counter(
+    'evolving_generation_retries_total', 'Extra batches drawn because earlier ones held too few new melodies.')
+GENERATION_BUDGET_EXHAUSTED = metrics.counter(
+    'evolving_generation_budget_exhausted_total', 'generate_unique calls that ran out of attempts.')
 
 
 class FileHandler(object):
@@ -21,60 +55,222 @@ class FileHandler(object):
         * and each NoteUnit separated by double underscores
     The above example becomes:
         48-1p0__51-0p25_52-0p25_55-1p0_51_0p5__48-2p0.mid
+
+    Long melodies don't fit in a filename, so files are now written with a short content hash as their name
+    (see melody_to_filename) and the melody itself is kept in the ProgressionIndex.  Files named with the notation
+    above can still be read, and migrate_filenames() renames them.
+
+    In memory, melodies are held as immutable Melody objects (see melody.py), which iterate like the nested lists
+    above.
+
+    The seed file, progression steps and output directories are tracked in a ProgressionIndex stored in the
+    root_directory, so lookups don't need to list directories.  The index is built from the files on disk the first
+    time it is opened, and can be rebuilt with rebuild_index().  Every generated candidate and every selection is
+    recorded in a LineageStore next to it (see lineage.py).
+
+    Each workspace (e.g. one per user session) gets a directory of its own under root_directory/workspaces, with its
+    own seed file, progression, index and lineage, so sessions never see each other's state.  Within a workspace,
+    seed swaps hold an exclusive file lock (see seed_lock) and only use atomic renames, so any number of threads and
+    processes (e.g. gunicorn workers) can share it.
     """
 
     INVALID_SYSTEM_FILES = ('.DS_Store')  # Files automatically added by the OS that should be ignored
+    OUTPUT_DIRECTORY_PATTERN = re.compile(r'^(\d{4}-\d{2}-\d{2})(?:_(\d+))?$')
+    HASHED_FILENAME_PATTERN = re.compile(r'^(?:\d+\^)?([0-9a-f]{16})\.mid$')
+    CONTENT_HASH_LENGTH = 16
+    WORKSPACE_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+    _prepared_roots = set()  # root directories whose directories, index and lineage this process has set up
+    # per thread, since SQLite connections can't be shared between threads: path -> open ProgressionIndex or
+    # LineageStore, so they are opened once rather than by every FileHandler
+    _open_stores = threading.local()
+    # per thread; the least recently used are dropped beyond this, and their connections close once no FileHandler
+    # holds them any more
+    MAX_OPEN_STORES = 64
 
-    def __init__(self):
-        self.root_directory = '/Users/obmuc/Documents/programming/python/evolving/evolving-music/static/midi_files'
+    ROOT_DIRECTORY = os.environ.get(
+        'EVOLVING_MUSIC_ROOT', '/Users/obmuc/Documents/programming/python/evolving/evolving-music/static/midi_files')
+
+    def __init__(self, workspace=None, root_directory=None):
+        """
+        Kwargs:
+            workspace (String): keep all state in root_directory/workspaces/<workspace>; by default the root_directory
+                itself is used
+            root_directory (String): the storage root; defaults to ROOT_DIRECTORY, which can be set with the
+                EVOLVING_MUSIC_ROOT environment variable
+        Raises:
+            ValueError if workspace isn't made of 1 to 64 letters, digits, '-' and '_'
+        """
+        self.storage_root = root_directory or self.ROOT_DIRECTORY
+        self.workspace = workspace
+        if workspace is None:
+            self.root_directory = self.storage_root
+        elif self.WORKSPACE_PATTERN.match(workspace):
+            self.root_directory = os.path.join(self.storage_root, 'workspaces', workspace)
+        else:
+            raise ValueError(f'Invalid workspace name: {workspace!r}')
+        self._seed_lock_file = None
         self.date_string = str(datetime.datetime.now().date())
-        self._setup_meta_directories()
+        prepared = self.root_directory in self._prepared_roots
+        if not prepared:
+            self._setup_meta_directories()
+        self.index = self._open_store(ProgressionIndex, os.path.join(self.root_directory, 'index.sqlite3'))
+        self.lineage = self._open_store(LineageStore, os.path.join(self.root_directory, 'lineage.sqlite3'))
+        if not prepared:
+            if self.index.is_empty():
+                self.rebuild_index()
+            with self.seed_lock():  # checked again under the lock, so concurrent processes backfill only once
+                if not self.lineage.step_count():
+                    self.backfill_lineage()
+            self._prepared_roots.add(self.root_directory)
+
+    @classmethod
+    def _open_store(cls, store_class, path):
+        """Return the store_class (ProgressionIndex or LineageStore) for path, opened once per thread and process."""
+        if getattr(cls._open_stores, 'pid', None) != os.getpid():  # connections don't survive a fork
+            cls._open_stores.stores = cache.LRUCache('sqlite_stores', cls.MAX_OPEN_STORES, sizeof=lambda store: 1)
+            cls._open_stores.pid = os.getpid()
+        store = cls._open_stores.stores.get(path)
+        if store is None:
+            store = cls._open_stores.stores.put(path, store_class(path))
+        return store
 
     def _setup_meta_directories(self):
         """Create the seed_file and progression directories if needed."""
         # Create the 'seed_file' directory, if necessary
         seed_file_directory = os.path.join(self.root_directory, 'seed_file')
         if not os.path.exists(seed_file_directory):
-            os.makedirs(seed_file_directory)
+            os.makedirs(seed_file_directory, exist_ok=True)
 
         # Create the 'progression' directory, if necessary
         progression_directory = os.path.join(self.root_directory, 'progression')
         if not os.path.exists(progression_directory):
-            os.makedirs(progression_directory)
+            os.makedirs(progression_directory, exist_ok=True)
 
-    def _increment_directory_name(self, directory):
-        highest_current = None
-        for path in Path(self.root_directory).iterdir():
-            if path.is_dir():
-                last_part_of_path = str(path).split('/')[-1]
-                date_part_of_name = last_part_of_path.split('_')[0]
-                if (date_part_of_name == self.date_string):
-                    try:
-                        directory_increment = last_part_of_path.split('_')[1]
-                    except IndexError:
-                        continue
-                    if (not highest_current) or (int(directory_increment) > highest_current):
-                        highest_current = int(directory_increment)
-        if highest_current:
-            return f"{directory}_{highest_current + 1}"
-        else:
-            return f"{directory}_1"
+    def _listed_files(self, directory):
+        # hidden files include the temporary files written by selected_file_to_seed_file
+        return [filename for filename in os.listdir(directory)
+                if filename not in self.INVALID_SYSTEM_FILES and not filename.startswith('.')]
+
+    @contextmanager
+    def seed_lock(self):
+        """Hold an exclusive lock on this workspace's seed file, progression and seen melodies, across threads and
+        processes.
+
+        The lock is an flock on a file in the root_directory, released when the file is closed.  Nested uses on the
+        same FileHandler join the outer one.  The lock is taken before any index transaction, never inside one.
+        """
+        if self._seed_lock_file is not None:
+            yield
+            return
+        with open(os.path.join(self.root_directory, 'seed.lock'), 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self._seed_lock_file = lock_file
+            try:
+                yield
+            finally:
+                self._seed_lock_file = None
 
+    @FILE_HANDLER_SECONDS.time(method='rebuild_index')
+    def rebuild_index(self):
+        """Rebuild the ProgressionIndex by scanning the seed_file, progression and output directories."""
+        with self.index.transaction():
+            self.index.clear()
+            seed_files = self._listed_files(os.path.join(self.root_directory, 'seed_file'))
+            if len(seed_files) > 1:
+                raise Exception('Multiple seed files found')
+            self.index.set_seed(seed_files[0] if seed_files else None)
+            if seed_files:
+                self._indexed_melody(os.path.join(self.root_directory, 'seed_file', seed_files[0]))
+            for archived_file in self._listed_files(os.path.join(self.root_directory, 'progression')):
+                step, seed_file = archived_file.split('^', 1)
+                self.index.add_progression_step(int(step), seed_file)
+                self._indexed_melody(os.path.join(self.root_directory, 'progression', archived_file))
+            for path in Path(self.root_directory).iterdir():
+                directory_match = self.OUTPUT_DIRECTORY_PATTERN.match(path.name)
+                if not (path.is_dir() and directory_match):
+                    continue
+                self.index.add_output_directory(path.name, directory_match.group(1), int(directory_match.group(2) or 0))
+                for filename in self._listed_files(str(path)):
+                    if filename.endswith('.mid'):
+                        melody = self._indexed_melody(os.path.join(str(path), filename))
+                        if melody is not None:
+                            self.index.add_candidate(melody.fingerprint, filename, path.name)
+
+    def _indexed_melody(self, file_with_full_path):
+        """Return the melody of a file for rebuild_index().  A hashed file whose melody isn't recorded in the index
+        (e.g. because index.sqlite3 was lost) is recovered from the LineageStore, which keeps every offered and
+        selected melody, or else read back from the file, and recorded again.  Returns None, and logs the file, if it
+        can't be recovered."""
+        filename = os.path.basename(file_with_full_path)
+        try:
+            return self.filename_to_melody(filename)
+        except KeyError:
+            pass
+        content_hash = self.HASHED_FILENAME_PATTERN.match(filename).group(1)
+        fingerprint = self.lineage.find(content_hash)
+        melody = None if fingerprint is None else self.lineage.melody(fingerprint)
+        if melody is None:
+            try:
+                with open(file_with_full_path, 'rb') as midi_file:
+                    notes, ticks_per_beat = corpus.read_midi_notes(midi_file.read())
+                if not notes:
+                    raise ValueError('No notes')
+                # the file doesn't say how its notes were grouped, so each gets a note_unit of its own
+                melody = Melody([[[pitch, (end - start) / ticks_per_beat]] for start, end, pitch in notes])
+            except (OSError, ValueError) as error:
+                logger.warning('Skipping %s, whose melody is not recorded and can not be read: %s',
+                               file_with_full_path, error)
+                return None
+        self.index.add_melody(content_hash, melody.to_bytes())
+        return melody
+
+    def backfill_lineage(self):
+        """Record the progression steps and seed file that predate the LineageStore as its first selections."""
+        filenames = [filename for _, filename in self.index.progression_filenames()]
+        if self.index.get_seed():
+            filenames.append(self.index.get_seed())
+        parent = None
+        for filename in filenames:
+            melody = self.filename_to_melody(filename)
+            if parent is not None and len(parent) == len(melody):
+                self.lineage.add_candidates(parent, [melody])
+            self.lineage.add_selection(melody)
+            parent = melody
+
+    @FILE_HANDLER_SECONDS.time(method='restore_files')
+    def restore_files(self):
+        """Re-render any seed or progression files listed in the index but missing from disk."""
+        files = [(os.path.join(self.root_directory, 'progression'), f'{step}^{filename}', filename)
+                 for step, filename in self.index.progression_filenames()]
+        seed_file = self.index.get_seed()
+        if seed_file:
+            files.append((os.path.join(self.root_directory, 'seed_file'), seed_file, seed_file))
+        for directory, filename, melody_filename in files:
+            file_with_full_path = os.path.join(directory, filename)
+            if not os.path.exists(file_with_full_path):
+                midi_bytes = MidiMaker(melody=self.filename_to_melody(melody_filename)).to_bytes()
+                with open(file_with_full_path, 'wb') as output_file:
+                    output_file.write(midi_bytes)
+
+    @FILE_HANDLER_SECONDS.time(method='setup_output_directory')
     def setup_output_directory(self):
-        # Create a folder to store today's mutations, if necessary
-        output_directory = os.path.join(self.root_directory, self.date_string)
-        if not os.path.exists(output_directory):
-            os.makedirs(output_directory)
-        else:
-            output_directory = self._increment_directory_name(output_directory)
-            os.makedirs(output_directory)
+        # Create a folder to store today's mutations; later folders on the same day are suffixed _1, _2, etc.
+        with self.index.transaction():
+            increment = self.index.next_output_directory_increment(self.date_string)
+            directory_name = f"{self.date_string}_{increment}" if increment else self.date_string
+            self.index.add_output_directory(directory_name, self.date_string, increment)
+        output_directory = os.path.join(self.root_directory, directory_name)
         # create a 'seed' directory inside the folder to store the file used to generate that day's mutations.
-        output_seed_directory = os.path.join(output_directory, 'seed')
-        if not os.path.exists(output_seed_directory):
-            os.makedirs(output_seed_directory)
-
+        os.makedirs(os.path.join(output_directory, 'seed'), exist_ok=True)
         return output_directory
 
+    def record_candidate(self, melody, file_with_full_path):
+        """Add a candidate written into an output directory to the index."""
+        output_directory, filename = os.path.split(file_with_full_path)
+        self.index.add_candidate(melody.fingerprint, filename, os.path.basename(output_directory))
+
     def full_to_relative_path(self, full_path):
         """Convert a full file path to a relative path. """
         current_directory = os.getcwd()
@@ -82,69 +278,136 @@ class FileHandler(object):
 
     def relative_path_to_full(self, relative_path):
         """Convert a relative path to a full path."""
+        # paths under the current directory (see full_to_relative_path) and paths outside of it, which
+        # full_to_relative_path leaves as they are
+        for full_path in (os.getcwd() + relative_path, relative_path):
+            if os.path.isabs(full_path) and os.path.exists(full_path):
+                return full_path
         # /static/midi_files/2021-11-15_1/60-0p5__
         relative_path = relative_path.replace('/static/midi_files/', '')
         full_path = os.path.join(self.root_directory, relative_path)
         return full_path
 
+    @FILE_HANDLER_SECONDS.time(method='find_seed_file_on_disk')
     def find_seed_file_on_disk(self):
-        """Locate the given filename in the seed_file directory, returning its full path."""
-        seed_file_directory = os.path.join(self.root_directory, 'seed_file')
-        seed_file_count = 0
-        for filename in os.listdir(seed_file_directory):
-            if filename not in self.INVALID_SYSTEM_FILES:
-                seed_file_with_full_path = os.path.join(seed_file_directory, filename)
-                seed_file_count += 1
-        if seed_file_count > 1:
-            raise Exception('Multiple seed files found')
-        return seed_file_with_full_path
+        """Return the full path of the current seed file."""
+        seed_file = self.index.get_seed()
+        if seed_file is None:
+            # the seed file may have been put in place by hand
+            seed_files = self._listed_files(os.path.join(self.root_directory, 'seed_file'))
+            if len(seed_files) > 1:
+                raise Exception('Multiple seed files found')
+            seed_file = seed_files[0]
+            with self.index.transaction():
+                self.index.set_seed(seed_file)
+        return os.path.join(self.root_directory, 'seed_file', seed_file)
 
     def _get_next_progression_index(self):
         """Return the next number to use when labeling a file being moved to the progression 
         directory."""
-        progression_directory = os.path.join(self.root_directory, 'progression')
-        archived_files = os.listdir(progression_directory)
-        if len(archived_files) == 0:
-            return 1
-        highest_index = 0
-        for archived_file in archived_files:
-            if archived_file not in self.INVALID_SYSTEM_FILES:
-                filename_parts = archived_file.split('^')
-                index = int(filename_parts[0])
-                if index > highest_index:
-                    highest_index = index
-        return highest_index + 1
-
-    def _get_progression_index_from_file(self, filename):
-        """Return an integer for the index of the file; used in sorting."""
-        return int(filename.split('^')[0])
-
+        return self.index.next_progression_step()
 
+    @FILE_HANDLER_SECONDS.time(method='get_sorted_progression_files')
     def get_sorted_progression_files(self):
         """Return a sorted list of the files in the progression directory, with relative paths."""
         progression_directory = os.path.join(self.root_directory, 'progression')
-        progression_files = []
-        for filename in os.listdir(progression_directory):
-            if filename not in self.INVALID_SYSTEM_FILES:
-                progression_files.append(filename)
-        progression_files.sort(key=self._get_progression_index_from_file)
-        return [self.full_to_relative_path(os.path.join(progression_directory, filename)) for filename in progression_files]
+        return [self.full_to_relative_path(os.path.join(progression_directory, f'{step}^{filename}'))
+                for step, filename in self.index.progression_filenames()]
 
-    def archive_seed_file(self):
-        """Move the current file in the 'seed_file' directory to the 'progression' directory."""
-        seed_file_full_path = self.find_seed_file_on_disk()
-        seed_file = seed_file_full_path.split('/')[-1]
+    @FILE_HANDLER_SECONDS.time(method='archive_seed_file')
+    def archive_seed_file(self, seed_file_full_path=None):
+        """Move a file from the 'seed_file' directory to the 'progression' directory.
 
-        progression_index = self._get_next_progression_index()
-        progression_file_full_path = os.path.join(self.root_directory, 'progression', f'{progression_index}^{seed_file}')
+        Kwargs:
+            seed_file_full_path (String): defaults to the current seed file, which then leaves the seed unset
+        """
+        with self.seed_lock(), self.index.transaction():
+            current_seed_file_full_path = self.find_seed_file_on_disk()
+            seed_file_full_path = seed_file_full_path or current_seed_file_full_path
+            seed_file = os.path.basename(seed_file_full_path)
+
+            progression_index = self._get_next_progression_index()
+            progression_file_full_path = os.path.join(self.root_directory, 'progression', f'{progression_index}^{seed_file}')
+
+            # the progression directory is on the same filesystem, so this is an atomic rename
+            os.replace(seed_file_full_path, progression_file_full_path)
+            self.index.add_progression_step(progression_index, seed_file)
+            if seed_file_full_path == current_seed_file_full_path:
+                self.index.set_seed(None)
+
+    @FILE_HANDLER_SECONDS.time(method='advance_seed_file')
+    def advance_seed_file(self, selected_file_with_relative_path, selected_melody=None):
+        """Archive the current seed file and make the selected file the new one, as a single atomic step, and record
+        the selection in the LineageStore.
+
+        The new seed file is put in place before the old one is archived, so the seed_file directory is never empty.
+
+        Kwargs:
+            selected_melody (Melody): the selected file's melody; read from its filename if not given
+        Returns:
+            Bool: False if the selected file already was the seed file, so nothing changed
+        """
+        with self.seed_lock(), self.index.transaction():
+            previous_seed_file_full_path = self.find_seed_file_on_disk()
+            selected_file = os.path.basename(selected_file_with_relative_path)
+            if os.path.basename(previous_seed_file_full_path) == selected_file:
+                return False
+            self.selected_file_to_seed_file(selected_file_with_relative_path)
+            self.archive_seed_file(previous_seed_file_full_path)
+            # under the same lock, so the lineage's steps follow the progression's
+            self.lineage.add_selection(selected_melody or self.filename_to_melody(selected_file))
+        return True
 
-        shutil.move(seed_file_full_path, progression_file_full_path)
+    def _seen_melodies_path(self):
+        return os.path.join(self.root_directory, 'seen_melodies.bloom')
 
+    @FILE_HANDLER_SECONDS.time(method='load_seen_melodies')
+    def load_seen_melodies(self):
+        """Return the BloomFilter of melodies already offered in this lineage, or an empty one."""
+        seen_melodies_path = self._seen_melodies_path()
+        if os.path.exists(seen_melodies_path):
+            return BloomFilter.load(seen_melodies_path)
+        return BloomFilter()
+
+    @FILE_HANDLER_SECONDS.time(method='save_seen_melodies')
+    def save_seen_melodies(self, seen_melodies):
+        """Add the melodies in seen_melodies to the persisted BloomFilter of this lineage.
+
+        The file is read, merged and rewritten under the seed_lock, so concurrent reviews in the workspace keep each
+        other's melodies.
+        """
+        with self.seed_lock():
+            stored_melodies = self.load_seen_melodies()
+            stored_melodies.update(seen_melodies)
+            stored_melodies.save(self._seen_melodies_path())
+
+    @FILE_HANDLER_SECONDS.time(method='selected_file_to_seed_file')
     def selected_file_to_seed_file(self, selected_file_with_relative_path):
         """Make a copy of the selected_file in the seed_file directory so that it can
         be used as the 'seed_file' for the next iteration."""
         selected_file_with_full_path = self.relative_path_to_full(selected_file_with_relative_path)
-        shutil.copy2(selected_file_with_full_path, os.path.join(self.root_directory, 'seed_file'))
+        seed_file = os.path.basename(selected_file_with_full_path)
+        seed_file_directory = os.path.join(self.root_directory, 'seed_file')
+        with self.seed_lock(), self.index.transaction():
+            # copy under a hidden name first, so the seed file appears complete or not at all
+            temporary_path = os.path.join(seed_file_directory, f'.{seed_file}.{os.getpid()}.tmp')
+            shutil.copy2(selected_file_with_full_path, temporary_path)
+            os.replace(temporary_path, os.path.join(seed_file_directory, seed_file))
+            self.index.set_seed(seed_file)
+
+    def ensure_seed_file(self, melody):
+        """Make melody the seed file if the workspace doesn't have one yet, e.g. when a session starts.
+
+        Returns:
+            String: the full path of the seed file
+        """
+        with self.seed_lock():
+            if self.index.get_seed() is None and not self._listed_files(os.path.join(self.root_directory, 'seed_file')):
+                MidiMaker(output_directory=os.path.join(self.root_directory, 'seed_file'), melody=melody,
+                          file_handler=self).write()
+                if not self.lineage.step_count():
+                    self.lineage.add_selection(melody)  # the first step, as backfill_lineage() records it
+            return self.find_seed_file_on_disk()
 
     # def get_seed_file(self):
     #     """Get the seed file from the root_directory"""
@@ -154,9 +417,60 @@ class FileHandler(object):
     #         if listed_file.endswith(".mid"):
     #             return listed_file
 
+    @FILE_HANDLER_SECONDS.time(method='melody_to_filename')
+    def melody_to_filename(self, melody):
+        """Return the filename for a melody, a short content hash, and record the melody under it in the index."""
+        content_hash = melody.fingerprint[:self.CONTENT_HASH_LENGTH]
+        recorded_key = (self.index.path, content_hash)
+        if cache.RECORDED_MELODIES.get(recorded_key) is None:
+            self.index.add_melody(content_hash, melody.to_bytes())
+            cache.RECORDED_MELODIES.put(recorded_key, True)
+        cache.MELODIES.put(content_hash, melody)
+        return f'{content_hash}.mid'
+
+    @FILE_HANDLER_SECONDS.time(method='filename_to_melody')
+    def filename_to_melody(self, filename):
+        """Return the Melody for a filename written by melody_to_filename(), or in the older melody notation.
+        A progression step prefix ('3^') is ignored."""
+        hashed_filename_match = self.HASHED_FILENAME_PATTERN.match(filename)
+        if hashed_filename_match:
+            melody = cache.MELODIES.get(hashed_filename_match.group(1))
+            if melody is not None:
+                return melody
+            encoding = self.index.get_melody_encoding(hashed_filename_match.group(1))
+            shared_index_path = os.path.join(self.storage_root, 'index.sqlite3')
+            if encoding is None and self.workspace is not None and os.path.exists(shared_index_path):
+                # a workspace may start from a file of the default workspace
+                encoding = self._open_store(ProgressionIndex, shared_index_path).get_melody_encoding(
+                    hashed_filename_match.group(1))
+            if encoding is None:
+                raise KeyError(f'No melody is recorded for {filename}')
+            return cache.MELODIES.put(hashed_filename_match.group(1), Melody.from_bytes(encoding))
+        return self.filename_to_list(filename=filename.split('^')[-1])
+
+    @FILE_HANDLER_SECONDS.time(method='migrate_filenames')
+    def migrate_filenames(self):
+        """Rename every file written with the melody notation as its name to a hashed filename, then rebuild the
+        index."""
+        directories = [os.path.join(self.root_directory, 'seed_file'), os.path.join(self.root_directory, 'progression')]
+        for path in Path(self.root_directory).iterdir():
+            if path.is_dir() and self.OUTPUT_DIRECTORY_PATTERN.match(path.name):
+                directories += [str(path), os.path.join(str(path), 'seed')]
+        with self.index.transaction():
+            for directory in directories:
+                if not os.path.isdir(directory):
+                    continue
+                for filename in self._listed_files(directory):
+                    if not filename.endswith('.mid') or self.HASHED_FILENAME_PATTERN.match(filename):
+                        continue
+                    prefix = filename[:filename.index('^') + 1] if '^' in filename else ''
+                    new_filename = prefix + self.melody_to_filename(self.filename_to_melody(filename))
+                    os.rename(os.path.join(directory, filename), os.path.join(directory, new_filename))
+            self.rebuild_index()
+
     @staticmethod
     def filename_to_list(filename):
-        """Convert a string into a list representing a melody"""
+        """Convert a string into a Melody"""
         melody_list = []
         melody_string = filename.split('.')[0]
         note_unit_strings = melody_string.split('__')
@@ -167,11 +481,11 @@ class FileHandler(object):
                 note_values = note_string.split('-')
                 note_unit_list.append([int(note_values[0]), float(str(note_values[1]).replace('p', '.'))])
             melody_list.append(note_unit_list)
-        return melody_list
+        return Melody(melody_list)
 
     @staticmethod
     def list_to_filename(melody_list):
-        """Convert a list representing a melody into a filename-appropriate string"""
+        """Convert a Melody (or a list representing a melody) into a filename-appropriate string"""
         the_string = ""
         for note_unit in melody_list:
             if the_string != "":
@@ -180,13 +494,100 @@ class FileHandler(object):
         return "%s.mid" % the_string
 
 
+class BloomFilter(object):
+    """
+    A fixed-size Bloom filter of melody fingerprints (see Melody.fingerprint).
+
+    Used to remember every melody offered in a lineage without keeping the melodies themselves.  Membership tests can
+    return false positives (at roughly 1% with the defaults, up to ~100,000 melodies) but never false negatives.
+    """
+
+    HEADER_FORMAT = '>II'  # size_in_bits, hash_count
+
+    def __init__(self, size_in_bits=2**20, hash_count=7, bits=None):
+        self.size_in_bits = size_in_bits
+        self.hash_count = hash_count
+        self.bits = bits if bits is not None else bytearray(size_in_bits // 8)
+
+    def _bit_positions(self, fingerprint):
+        # double hashing: the two halves of the 128-bit fingerprint act as independent hash functions
+        first_hash = int(fingerprint[:16], 16)
+        second_hash = int(fingerprint[16:], 16) | 1
+        return [(first_hash + i * second_hash) % self.size_in_bits for i in range(self.hash_count)]
+
+    def add(self, fingerprint):
+        for position in self._bit_positions(fingerprint):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, fingerprint):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._bit_positions(fingerprint))
+
+    def update(self, other):
+        """Add every fingerprint in other, a BloomFilter of the same size and hash_count.
+
+        Raises:
+            ValueError if the filters' parameters differ
+        """
+        if (other.size_in_bits, other.hash_count) != (self.size_in_bits, self.hash_count):
+            raise ValueError('Only Bloom filters with the same size and hash_count can be merged')
+        self.bits = bytearray((int.from_bytes(self.bits, 'little') | int.from_bytes(other.bits, 'little')).to_bytes(
+            len(self.bits), 'little'))
+
+    def save(self, path):
+        temporary_path = f'{path}.tmp'
+        with open(temporary_path, 'wb') as output_file:
+            output_file.write(struct.pack(self.HEADER_FORMAT, self.size_in_bits, self.hash_count))
+            output_file.write(self.bits)
+        os.replace(temporary_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as input_file:
+            size_in_bits, hash_count = struct.unpack(cls.HEADER_FORMAT, input_file.read(struct.calcsize(cls.HEADER_FORMAT)))
+            bits = bytearray(input_file.read())
+        return cls(size_in_bits=size_in_bits, hash_count=hash_count, bits=bits)
+
+
+def _write_variable_length_quantity(buffer, position, value):
+    """Write value into buffer at position as a midi variable-length quantity; returns the new position."""
+    if value < 0x80:
+        buffer[position] = value
+        return position + 1
+    groups = []
+    while value:
+        groups.append(value & 0x7F)
+        value >>= 7
+    for group in reversed(groups[1:]):
+        buffer[position] = group | 0x80
+        position += 1
+    buffer[position] = groups[0]
+    return position + 1
+
+
 class MidiMaker:
-    """ Transforms NoteUnits into midi notes that can be output. """
+    """ Transforms NoteUnits into midi notes that can be output.
+
+    to_bytes() uses a built-in encoder for our single-track, single-channel melodies, which writes the same bytes
+    midiutil would (a format 1 file with a tempo track and one note track) straight into a bytearray.  midiutil is
+    kept as a fallback and as the reference for verify_native_encoder().
+
+    The events of each NoteUnit are cached on it (see NoteUnit.cached), so rendering a mutated melody only encodes the
+    note_units it doesn't share with its parent.
+    """
+
+    NOTE_EVENT_MAX_SIZE = 7  # a delta time of up to 4 bytes plus a 3 byte note on/off message
+    EXACT_TICK_STEP = TICKS_PER_BEAT // 64  # durations in whole 64ths of a beat add up without float rounding
 
-    def __init__(self, output_directory, melody):
+    def __init__(self, output_directory=None, melody=None, file_handler=None):
+        """
+        Kwargs:
+            output_directory (String): where write() puts the file; not needed for to_bytes()
+            melody (Melody)
+            file_handler (FileHandler): names the files written by write(); defaults to one for the default workspace
+        """
         self.output_directory = output_directory
         self.melody = melody
-        self.file_handler = FileHandler()
+        self._file_handler = file_handler
 
         # set some defaults
         self.track = 0
@@ -195,7 +596,14 @@ class MidiMaker:
         self.tempo = 120
         self.volume = 127
 
-    def write(self):
+    @property
+    def file_handler(self):
+        # only write() needs one, so rendering with to_bytes() doesn't open the index or create directories
+        if self._file_handler is None:
+            self._file_handler = FileHandler()
+        return self._file_handler
+
+    def _build_midi_file(self):
         midi_file = MIDIFile(numTracks=1)
         midi_file.addTempo(self.track, self.time, self.tempo)
         current_time = 0
@@ -203,12 +611,143 @@ class MidiMaker:
             for note in note_unit:
                 midi_file.addNote(self.track, self.channel, note[0], current_time, note[1], self.volume)  # note[1]
                 current_time += note[1]
-        file_name_with_path = os.path.join(self.output_directory, self.file_handler.list_to_filename(melody_list=self.melody))
-        with open(file_name_with_path, "wb") as output_file:
-            midi_file.writeFile(output_file)
+        return midi_file
+
+    def _encode_with_midiutil(self):
+        output_buffer = io.BytesIO()
+        self._build_midi_file().writeFile(output_buffer)
+        return output_buffer.getvalue()
+
+    def _file_header(self):
+        """The midi file header and tempo track that precede the note track."""
+        microseconds_per_beat = struct.pack('>I', int(60000000 / self.tempo))[1:]
+        tempo_track = b'MTrk' + struct.pack('>I', 11) + b'\x00\xff\x51\x03' + microseconds_per_beat + b'\x00\xff\x2f\x00'
+        return b'MThd' + struct.pack('>IHHH', 6, 1, 2, TICKS_PER_BEAT) + tempo_track
+
+    def _note_unit_events(self, note_unit):
+        """Return the encoded note track events of note_unit, or None if its durations aren't whole 64ths of a beat.
+
+        Such note_units always start exactly on a tick, with no rounding carried over from earlier notes, so their
+        events are the same wherever they appear in a melody.
+        """
+        def encode(note_unit):
+            if any(tick % self.EXACT_TICK_STEP for tick in note_unit.ticks):
+                return None
+            events = bytearray(len(note_unit) * 2 * self.NOTE_EVENT_MAX_SIZE)
+            position = 0
+            for pitch, tick in zip(note_unit.pitches, note_unit.ticks):
+                events[position:position + 4] = bytes((0, 0x90 | self.channel, pitch, self.volume))
+                position = _write_variable_length_quantity(events, position + 4, tick)
+                events[position:position + 3] = bytes((0x80 | self.channel, pitch, self.volume))
+                position += 3
+            return bytes(events[:position])
+        return note_unit.cached(('midi_events', self.channel, self.volume), encode)
+
+    def _encode_from_note_units(self):
+        """Join the cached events of the melody's note_units; returns None if any of them can't be reused."""
+        if self.time != 0 or not isinstance(self.melody, Melody):
+            return None
+        events = []
+        for note_unit in self.melody:
+            note_unit_events = self._note_unit_events(note_unit)
+            if note_unit_events is None:
+                return None
+            events.append(note_unit_events)
+        track = b''.join(events) + b'\x00\xff\x2f\x00'
+        return self._file_header() + b'MTrk' + struct.pack('>I', len(track)) + track
+
+    def _encode_native(self):
+        """Encode the melody the way midiutil would, without building a MIDIFile.
+
+        Note times are accumulated in beats and truncated to ticks exactly as midiutil does, so the output is
+        byte-for-byte identical.  Truncation can make a note start a tick before the previous one ends (e.g. after
+        durations of a third of a beat); midiutil reorders overlapping events, so those melodies fall back to it.
+        Melodies without such durations are assembled from their note_units' cached events instead.
+        """
+        encoded = self._encode_from_note_units()
+        if encoded is not None:
+            return encoded
+        notes = [note for note_unit in self.melody for note in note_unit]
+        header = self._file_header()
+        buffer = bytearray(len(header) + 8 + len(notes) * 2 * self.NOTE_EVENT_MAX_SIZE + 4)
+        buffer[0:len(header)] = header
+        track_start = len(header) + 8
+        position = track_start
+        note_on = 0x90 | self.channel
+        note_off = 0x80 | self.channel
+        previous_tick = 0
+        current_time = self.time
+        for pitch, duration in notes:
+            start_tick = int(current_time * TICKS_PER_BEAT)
+            if start_tick < previous_tick:
+                return self._encode_with_midiutil()
+            current_time += duration
+            end_tick = start_tick + int(duration * TICKS_PER_BEAT)
+            position = _write_variable_length_quantity(buffer, position, start_tick - previous_tick)
+            buffer[position:position + 3] = bytes((note_on, pitch, self.volume))
+            position = _write_variable_length_quantity(buffer, position + 3, end_tick - start_tick)
+            buffer[position:position + 3] = bytes((note_off, pitch, self.volume))
+            position += 3
+            previous_tick = end_tick
+        buffer[position:position + 4] = b'\x00\xff\x2f\x00'
+        position += 4
+        buffer[len(header):track_start] = b'MTrk' + struct.pack('>I', position - track_start)
+        del buffer[position:]
+        return bytes(buffer)
+
+    @MIDI_SECONDS.time(method='to_bytes')
+    def to_bytes(self, use_midiutil=False):
+        """Render the melody to the contents of a midi file, without touching the disk.
+
+        Kwargs:
+            use_midiutil (Bool): build the file with midiutil instead of the built-in encoder
+        """
+        if use_midiutil:
+            return self._encode_with_midiutil()
+        if not isinstance(self.melody, Melody):
+            return self._encode_native()
+        # the rendering depends only on the melody and these settings, so it can be looked up by them
+        settings = (self.tempo, self.channel, self.volume, self.time)
+        memory_key = (self.melody.fingerprint,) + settings
+        midi_bytes = cache.MIDI_FILES.get(memory_key)
+        if midi_bytes is not None:
+            return midi_bytes
+        disk_key = '-'.join(str(part) for part in memory_key)
+        if cache.midi_disk_cache is not None:
+            midi_bytes = cache.midi_disk_cache.get(disk_key)
+        if midi_bytes is None:
+            midi_bytes = self._encode_native()
+            if cache.midi_disk_cache is not None:
+                cache.midi_disk_cache.put(disk_key, midi_bytes)
+        return cache.MIDI_FILES.put(memory_key, midi_bytes)
+
+    def verify_native_encoder(self):
+        """Return True if the built-in encoder and midiutil produce identical files for this melody."""
+        return self._encode_native() == self._encode_with_midiutil()
+
+    @MIDI_SECONDS.time(method='write')
+    def write(self):
+        """Render the melody into output_directory, named by FileHandler.melody_to_filename; returns the full path.
+        Files are named by their content, so one that already exists is left as it is."""
+        file_name_with_path = os.path.join(self.output_directory, self.file_handler.melody_to_filename(self.melody))
+        if not os.path.exists(file_name_with_path):
+            with open(file_name_with_path, "wb") as output_file:
+                output_file.write(self.to_bytes())
         return file_name_with_path
 
 
+@lru_cache(maxsize=None)
+def scaled_probabilities_table(max_change):
+    """Memoized, immutable version of Mutator._build_scaled_probabilities_list, with the values as Ints."""
+    return tuple(int(value) for value in Mutator._build_scaled_probabilities_list(max_change=max_change))
+
+
+def sample_scaled_index(table, rng=random):
+    """Draw a random number between 1 and the last value of a scaled probabilities table, and return the index of
+    the lowest value in the table that is greater than or equal to it (found by bisection)."""
+    return bisect.bisect_left(table, rng.randint(1, table[-1]))
+
+
 class Mutator(object):
     """
     Possible Mutations:
@@ -233,23 +772,53 @@ class Mutator(object):
             * If cleanly divisible by 3:
                 * split into thirds
         * Joining Mutations (2 or more notes become one; randomly choose which pitch to use)
+
+    With constraints (see constraints.py), pitch and duration mutations only draw legal moves from the constraints'
+    precomputed tables, and splits and joins only happen when their results are legal, so every candidate keeps to
+    the key, range and meter (as long as the seed melody does).
+
+    By default a mutating note_unit joins or splits mutation_percentage percent of the time (each half of those), and
+    otherwise changes the pitch of a third of its chosen notes and the duration of the rest.  operator_weights
+    replaces these shares with relative weights for the OPERATORS (see scheduler.py, which adapts them).
     """
 
+    OPERATORS = ('pitch', 'duration', 'join', 'split')
+
     # TODO: Allow deletion of a note if multiple in note-unit
 
     DURATION_CHANGES = {0: 0.25, 1: 0.5, 2: 1}
+    ATTEMPTS_PER_MELODY = 100  # default retry budget for generate_unique()
+    MIN_BATCH_SIZE = 32  # the fewest candidates generate_unique() draws from mutate_batch() at a time
 
-    def __init__(self, seed_melody, mutation_percentage=25):
+    def __init__(self, seed_melody, mutation_percentage=25, rng=random, constraints=None, operator_weights=None):
         """
         Args:
-            seed_melody (List)
+            seed_melody (Melody or List)
         Kwargs:
             mutation_percentage (Int): defines what percent of the time a note_unit should mutate.
+            rng (random.Random): random source for mutate(); defaults to the global random module.
+            constraints (MutationConstraints): restrict mutations to a key, pitch range and bar length
+            operator_weights (Tuple): relative weights of the OPERATORS for a mutating note_unit, Ints from 0 to 255
+        Raises:
+            ValueError if operator_weights doesn't hold a weight from 0 to 255 per operator, with a positive total
         """
-        self.seed_melody = seed_melody
+        self.rng = rng
+        self.seed_melody = seed_melody if isinstance(seed_melody, Melody) else Melody(seed_melody)
         self.mutation_percentage = mutation_percentage
-        self.pitch_change_probs = self._build_scaled_probabilities_list(max_change=12)
-        self.duration_change_probs = self._build_scaled_probabilities_list(max_change=3)
+        self.constraints = constraints
+        self.operator_weights = None
+        if operator_weights is not None:
+            operator_weights = tuple(operator_weights)
+            if (len(operator_weights) != len(self.OPERATORS) or min(operator_weights) < 0 or max(operator_weights) > 255
+                    or not sum(operator_weights)):
+                raise ValueError(f'Invalid operator weights: {operator_weights}')
+            self.operator_weights = operator_weights
+            pitch, duration, join, split = operator_weights
+            self._join_split_probability = (join + split) / sum(operator_weights)
+            self._split_probability = split / (join + split) if join + split else 0.5
+            self._pitch_probability = pitch / (pitch + duration) if pitch + duration else 0.5
+        self.pitch_change_probs = scaled_probabilities_table(max_change=12)
+        self.duration_change_probs = scaled_probabilities_table(max_change=3)
 
     @staticmethod
     def _build_scaled_probabilities_list(max_change):
@@ -294,57 +863,60 @@ class Mutator(object):
         Args:
             note_unit (list)
         Returns:
-            note_unit (list)
+            note_unit (list): a new list; note_unit itself is left unchanged
         """
-        operation = random.choice(['join', 'split'])
+        if self.operator_weights is None:
+            operation = self.rng.choice(['join', 'split'])
+        else:
+            operation = 'split' if self.rng.random() < self._split_probability else 'join'
         if operation == 'split':
-            target_note = random.choice(note_unit)
-            target_note_index = note_unit.index(target_note)
+            # pick the note by position, so that with duplicate notes the chosen one is split rather than the first
+            target_note_index = self.rng.randrange(len(note_unit))
+            target_note = note_unit[target_note_index]
             if target_note[1] < 0.5:
                 return note_unit  # too small - do nothing
             elif target_note[1] % 0.5 == 0.0:
                 shortened_note = [target_note[0], target_note[1] * 0.5]
-                note_unit[target_note_index] = shortened_note
-                note_unit.insert(target_note_index + 1, self._mutate_pitch(seed_note=shortened_note))
-                return note_unit
+                if self.constraints and not self.constraints.allows_duration(shortened_note[1]):
+                    return note_unit
+                new_notes = [shortened_note, self._mutate_pitch(seed_note=shortened_note)]
             elif target_note[1] % 0.75 == 0.0:
-                new_duration = target_note[1] / 3
-                shortened_note = [target_note[0], new_duration]
-                note_unit[target_note_index] = shortened_note
-                note_unit.insert(target_note_index + 1, self._mutate_pitch(seed_note=shortened_note))
-                note_unit.insert(target_note_index + 2, self._mutate_pitch(seed_note=shortened_note))
+                shortened_note = [target_note[0], target_note[1] / 3]
+                if self.constraints and not self.constraints.allows_duration(shortened_note[1]):
+                    return note_unit
+                new_notes = [
+                    shortened_note,
+                    self._mutate_pitch(seed_note=shortened_note),
+                    self._mutate_pitch(seed_note=shortened_note),
+                ]
+            else:
                 return note_unit
+            return note_unit[:target_note_index] + new_notes + note_unit[target_note_index + 1:]
         else:
             if len(note_unit) <= 1:
                 return note_unit
             else:
-                number_of_notes_to_join = 2
-                note_join_probs_list = self._build_scaled_probabilities_list(max_change=len(note_unit) - 1)
-                note_join_probs_index = random.randint(1, note_join_probs_list[-1])
-                for j, note_change_prob in enumerate(note_join_probs_list):
-                    if note_join_probs_index <= note_change_prob:
-                        number_of_notes_to_join = j + 2
-                        break
+                note_join_probs_list = scaled_probabilities_table(max_change=len(note_unit) - 1)
+                number_of_notes_to_join = sample_scaled_index(note_join_probs_list, rng=self.rng) + 2
                 notes_to_join = note_unit[0:number_of_notes_to_join]
                 remaining_notes = note_unit[number_of_notes_to_join:]
-                new_pitch = random.choice(notes_to_join)[0]
+                new_pitch = self.rng.choice(notes_to_join)[0]
                 new_duration = 0
                 for note in notes_to_join:
                     new_duration += note[1]
-                remaining_notes.insert(0, [new_pitch, new_duration])
-                return remaining_notes
-        return note_unit
+                if self.constraints and not self.constraints.allows_duration(new_duration):
+                    return note_unit
+                return [[new_pitch, new_duration]] + remaining_notes
 
-    def _mutate_duration(self, seed_note):
+    def _mutate_duration(self, seed_note, unit_duration=None):
         note = list(seed_note)  # make a copy of the note so we don't overwrite seed_melody
-        duration_change_rand = random.randint(1, self.duration_change_probs[-1])
-        duration_change_index = 0
-        for i, dcp_value in enumerate(self.duration_change_probs):
-            if duration_change_rand <= dcp_value:
-                duration_change_index = i
-                break
+        if self.constraints:
+            note[1] = self.constraints.choose_duration(
+                self.rng, note[1], note[1] if unit_duration is None else unit_duration)
+            return note
+        duration_change_index = sample_scaled_index(self.duration_change_probs, rng=self.rng)
         duration_change_amount = self.DURATION_CHANGES[duration_change_index]
-        increase_duration = random.choice([True, False])
+        increase_duration = self.rng.choice([True, False])
         if increase_duration:
             new_duration = note[1] + duration_change_amount
         else:
@@ -355,17 +927,17 @@ class Mutator(object):
 
     def _mutate_pitch(self, seed_note):
         note = list(seed_note)  # make a copy of the note so we don't overwrite seed_melody
-        pitch_change_rand = random.randint(1, self.pitch_change_probs[-1])
-        pitch_change_amount = 0
-        for i, pcp_value in enumerate(self.pitch_change_probs):
-            if pitch_change_rand <= pcp_value:
-                pitch_change_amount = i + 1
-                break
-        increase_pitch = random.choice([True, False])
+        if self.constraints:
+            note[0] = self.constraints.choose_pitch(self.rng, note[0])
+            return note
+        pitch_change_amount = sample_scaled_index(self.pitch_change_probs, rng=self.rng) + 1
+        increase_pitch = self.rng.choice([True, False])
         if increase_pitch:
-            note[0] += pitch_change_amount
+            new_pitch = note[0] + pitch_change_amount
         else:
-            note[0] -= pitch_change_amount
+            new_pitch = note[0] - pitch_change_amount
+        if LOWEST_PITCH <= new_pitch <= HIGHEST_PITCH:
+            note[0] = new_pitch
         return note
 
     def _mutate_duration_and_pitch(self, note_unit):
@@ -378,19 +950,14 @@ class Mutator(object):
         """
         # if there's more than one note in the note_unit:
         if len(note_unit) > 1:
-            # choose which notes in the note_unit to mutate randomly select which to change
-            # a probability scale is used to determine how many notes to mutate, with fewer mutations being more common.
-            number_of_notes_to_change = 1
-            note_change_probs_list = self._build_scaled_probabilities_list(max_change=len(note_unit))
-            note_change_index = random.randint(1, note_change_probs_list[-1])
-            for j, note_change_prob in enumerate(note_change_probs_list):
-                if note_change_index <= note_change_prob:
-                    number_of_notes_to_change = j + 1
-            notes_to_change = []
-            while len(notes_to_change) < number_of_notes_to_change:
-                chosen_note = random.choice(note_unit)
-                if chosen_note not in notes_to_change:
-                    notes_to_change.append(note_unit.index(chosen_note))
+            # choose which notes in the note_unit to mutate randomly select which to change.
+            # A draw from a probability scale was meant to make fewer changes more common, but the scan of the scale
+            # never stopped at the first match, so every note_unit always gets one selection per note (as
+            # mutate_batch does).  The draw is still made, so seeded runs give the same melodies.
+            self.rng.randint(1, scaled_probabilities_table(max_change=len(note_unit))[-1])
+            number_of_notes_to_change = len(note_unit)
+            # notes are chosen by position (with replacement), so duplicate notes are as likely to change as any other
+            notes_to_change = [self.rng.randrange(len(note_unit)) for _ in range(number_of_notes_to_change)]
         else:
             notes_to_change = [0]
         for note_index in notes_to_change:
@@ -402,48 +969,307 @@ class Mutator(object):
                 ['_mutate_duration', ],
                 ['_mutate_pitch', '_mutate_duration']
             ]
-            mutation_type = random.choice(mutation_types)
+            if self.operator_weights is None:
+                mutation_type = self.rng.choice(mutation_types)
+            else:
+                mutation_type = mutation_types[0] if self.rng.random() < self._pitch_probability else mutation_types[1]
             for mutation_method in mutation_type:
-                mutated_note = getattr(self, mutation_method)(note)
+                if mutation_method == '_mutate_duration':
+                    mutated_note = self._mutate_duration(note, unit_duration=sum(duration for _, duration in note_unit))
+                else:
+                    mutated_note = self._mutate_pitch(note)
             note_unit[note_index] = mutated_note
         return note_unit
 
-    def mutate(self):
-        mutated_melody = []
+    @MUTATION_SECONDS.time(method='mutate_delta')
+    def mutate_delta(self):
+        """Mutate the seed melody, returning only what changed.
+
+        Returns:
+            List of (note_unit index, replacement NoteUnit) pairs, in index order.  Note_units whose mutation left
+            them unchanged are not included.  seed_melody.apply(delta) builds the mutated melody.
+        """
+        delta = []
         # loop through each note_unit
-        for note_unit in self.seed_melody:
+        for i, note_unit in enumerate(self.seed_melody):
             # decide if each one should mutate
-            mutate_rand = random.randint(1, 100)
+            mutate_rand = self.rng.randint(1, 100)
             if mutate_rand <= self.mutation_percentage:
-                mutating_note_unit = list(note_unit)  # copy note_unit so we don't alter seed melody
                 # we join/split note_units randomly using the same mutation percentage passed into __init__()
-                join_split_rand = random.randint(1, 100)
-                if join_split_rand <= self.mutation_percentage:
-                    mutating_note_unit = self._join_or_split(note_unit=mutating_note_unit)
+                if self.operator_weights is None:
+                    join_split = self.rng.randint(1, 100) <= self.mutation_percentage
+                else:
+                    join_split = self.rng.random() < self._join_split_probability
+                if join_split:
+                    mutated_note_unit = NoteUnit(self._join_or_split(note_unit=list(note_unit)))
                 else:  # if the note_unit isn't joining/splitting, alter it's pitch and/or duration
-                    mutating_note_unit = self._mutate_duration_and_pitch(note_unit=mutating_note_unit)
-                mutated_melody.append(mutating_note_unit)
+                    mutated_note_unit = NoteUnit(self._mutate_duration_and_pitch(note_unit=list(note_unit)))
+                if mutated_note_unit != note_unit:
+                    delta.append((i, mutated_note_unit))
+        return delta
+
+    @MUTATION_SECONDS.time(method='mutate')
+    def mutate(self):
+        """Return a mutated copy of the seed melody.  Note_units that don't mutate are shared with seed_melody."""
+        return self.seed_melody.apply(self.mutate_delta())
+
+    @MUTATION_SECONDS.time(method='generate_unique')
+    def generate_unique(self, count, seen=None, max_attempts=None, provenance=None):
+        """Generate up to count distinct mutated melodies.
+
+        Candidates are drawn with mutate_batch(), seeded from self.rng.  Candidates equal to the seed, already
+        generated in this call, or whose fingerprint is in seen are rejected.  Duplicates are detected by fingerprint,
+        so each check is O(1).
+
+        Args:
+            count (Int): the number of melodies wanted
+        Kwargs:
+            seen (Set or BloomFilter): fingerprints of melodies that should not be offered again
+            max_attempts (Int): the number of candidates to draw before giving up; defaults to
+                count * ATTEMPTS_PER_MELODY.  Fewer than count melodies are returned if it runs out.
+            provenance (Dict): if given, filled in with fingerprint -> (rng_seed, batch_size, batch_position,
+                mutation_percentage, operator_weights) for every returned melody; mutate_batch_deltas(batch_size,
+                rng=rng_seed) then regenerates it at batch_position (see LineageStore)
+        Returns:
+            List of Melodies
+        """
+        if max_attempts is None:
+            max_attempts = count * self.ATTEMPTS_PER_MELODY
+        created_fingerprints = {self.seed_melody.fingerprint}
+        created_melodies = []
+        attempts = 0
+        while len(created_melodies) < count and attempts < max_attempts:
+            if attempts:
+                GENERATION_RETRIES.inc()
+            batch_size = min(max(count - len(created_melodies), self.MIN_BATCH_SIZE), max_attempts - attempts)
+            attempts += batch_size
+            CANDIDATES_DRAWN.inc(batch_size)
+            rng_seed = self.rng.getrandbits(64)
+            for batch_position, mutated_melody in enumerate(self.mutate_batch(batch_size, rng=rng_seed)):
+                fingerprint = mutated_melody.fingerprint
+                if fingerprint in created_fingerprints:
+                    CANDIDATES_REJECTED.inc(reason='duplicate')
+                    continue
+                if seen is not None and fingerprint in seen:
+                    CANDIDATES_REJECTED.inc(reason='seen')
+                    continue
+                created_fingerprints.add(fingerprint)
+                created_melodies.append(mutated_melody)
+                if provenance is not None:
+                    provenance[fingerprint] = (
+                        rng_seed, batch_size, batch_position, self.mutation_percentage, self.operator_weights)
+                if len(created_melodies) == count:
+                    break
+        if len(created_melodies) < count:
+            GENERATION_BUDGET_EXHAUSTED.inc()
+        return created_melodies
+
+    @staticmethod
+    def encode_melody(melody):
+        """Flatten a Melody into NumPy arrays.
+
+        Args:
+            melody (Melody)
+        Returns:
+            Tuple of (pitches, durations, offsets).  pitches and durations (in beats) hold one entry per note; the
+            notes of note_unit i are pitches[offsets[i]:offsets[i + 1]].
+        """
+        offsets = np.frombuffer(melody.offsets, dtype=melody.offsets.typecode).astype(np.int64)
+        pitches = np.frombuffer(melody.pitches, dtype=np.int8).astype(np.int64)
+        durations = np.frombuffer(melody.ticks, dtype=melody.ticks.typecode) / TICKS_PER_BEAT
+        return pitches, durations, offsets
+
+    def _draw_pitch_changes(self, rng, size):
+        """Vectorized equivalent of the draws made by _mutate_pitch; returns signed pitch changes."""
+        pitch_change_rand = rng.integers(1, self.pitch_change_probs[-1] + 1, size=size)
+        pitch_change_amount = np.searchsorted(self.pitch_change_probs, pitch_change_rand) + 1
+        increase_pitch = rng.integers(0, 2, size=size).astype(bool)
+        return np.where(increase_pitch, pitch_change_amount, -pitch_change_amount)
+
+    def _draw_duration_changes(self, rng, size):
+        """Vectorized equivalent of the draws made by _mutate_duration; returns signed duration changes."""
+        duration_change_rand = rng.integers(1, self.duration_change_probs[-1] + 1, size=size)
+        duration_change_index = np.searchsorted(self.duration_change_probs, duration_change_rand)
+        duration_change_amount = np.array([self.DURATION_CHANGES[i] for i in sorted(self.DURATION_CHANGES)])[
+            duration_change_index]
+        increase_duration = rng.integers(0, 2, size=size).astype(bool)
+        return np.where(increase_duration, duration_change_amount, -duration_change_amount)
+
+    @MUTATION_SECONDS.time(method='mutate_batch')
+    def mutate_batch(self, n, rng=None):
+        """Generate n mutated melodies at once; see mutate_batch_deltas().
+
+        Returns:
+            List of n Melodies
+        """
+        return [self.seed_melody.apply(delta) for delta in self.mutate_batch_deltas(n, rng=rng)]
+
+    @MUTATION_SECONDS.time(method='mutate_batch_deltas')
+    def mutate_batch_deltas(self, n, rng=None):
+        """Generate n mutations at once, returning only what changed in each (see mutate_delta()).
+
+        All of the random decisions for the batch are drawn as NumPy arrays, so the per-note Python work is limited to
+        the note_units that actually mutate.  The results follow the same distribution as calling mutate_delta() n
+        times.
+
+        Args:
+            n (Int): the number of mutations to generate
+        Kwargs:
+            rng (numpy.random.Generator, Int or None): random source, or a seed used to create one
+        Returns:
+            List of n deltas: lists of (note_unit index, replacement NoteUnit) pairs, in index order
+        """
+        rng = np.random.default_rng(rng)
+        pitches, durations, offsets = self.encode_melody(self.seed_melody)
+        unit_lengths = np.diff(offsets)
+        unit_count = len(unit_lengths)
+        mutated_note_units = [{} for _ in range(n)]  # per mutation: note_unit index -> list of notes
+
+        # decide which note_units mutate, and which of those join/split rather than alter pitch and/or duration
+        mutate_mask = rng.integers(1, 101, size=(n, unit_count)) <= self.mutation_percentage
+        if self.operator_weights is None:
+            join_split_mask = rng.integers(1, 101, size=(n, unit_count)) <= self.mutation_percentage
+        else:
+            join_split_mask = rng.random(size=(n, unit_count)) < self._join_split_probability
+        pitch_duration_pairs = np.nonzero(mutate_mask & ~join_split_mask)
+        join_split_pairs = np.nonzero(mutate_mask & join_split_mask)
+
+        self._batch_mutate_duration_and_pitch(rng, pitches, durations, offsets, pitch_duration_pairs, mutated_note_units)
+        self._batch_join_or_split(rng, offsets, join_split_pairs, mutated_note_units)
+        deltas = []
+        for replacements in mutated_note_units:
+            delta = []
+            for index in sorted(replacements):
+                note_unit = NoteUnit(replacements[index])
+                if note_unit != self.seed_melody[index]:
+                    delta.append((index, note_unit))
+            deltas.append(delta)
+        return deltas
+
+    def _batch_mutate_duration_and_pitch(self, rng, pitches, durations, offsets, pairs, mutated_note_units):
+        """Apply _mutate_duration_and_pitch to every (melody, note_unit) pair in pairs.
+
+        Each note_unit of length L receives L note selections (with replacement), applied in order so that repeated
+        selections of the same note compound, exactly as in the scalar path.  The selections are processed in rounds:
+        round k applies the k-th selection of every pair that has one, vectorized across pairs.
+        """
+        melody_indices, unit_indices = pairs
+        if len(unit_indices) == 0:
+            return
+        unit_starts = offsets[unit_indices]
+        pair_lengths = offsets[unit_indices + 1] - unit_starts
+        pair_starts = np.zeros(len(pair_lengths), dtype=np.int64)
+        pair_starts[1:] = np.cumsum(pair_lengths)[:-1]
+        seed_note_indices = np.repeat(unit_starts - pair_starts, pair_lengths) + np.arange(pair_lengths.sum())
+        work_pitches = pitches[seed_note_indices]
+        work_durations = durations[seed_note_indices]
+
+        for selection_round in range(int(pair_lengths.max())):
+            active = np.nonzero(pair_lengths > selection_round)[0]
+            targets = pair_starts[active] + rng.integers(0, pair_lengths[active])
+            # mutation types are pitch, duration, or pitch-then-duration.  In the scalar path both methods of the last
+            # type are applied to the original note, so only the duration change survives.
+            if self.operator_weights is None:
+                mutate_pitch = rng.integers(0, 3, size=len(active)) == 0
+            else:
+                mutate_pitch = rng.random(len(active)) < self._pitch_probability
+            pitch_targets = targets[mutate_pitch]
+            duration_targets = targets[~mutate_pitch]
+            if self.constraints:
+                work_pitches[pitch_targets] = self.constraints.sample_pitches(rng, work_pitches[pitch_targets])
+                unit_durations = np.add.reduceat(work_durations, pair_starts)[active[~mutate_pitch]]
+                work_durations[duration_targets] = self.constraints.sample_durations(
+                    rng, work_durations[duration_targets], unit_durations)
+                continue
+            new_pitches = work_pitches[pitch_targets] + self._draw_pitch_changes(rng, len(pitch_targets))
+            work_pitches[pitch_targets] = np.where(
+                (new_pitches >= LOWEST_PITCH) & (new_pitches <= HIGHEST_PITCH), new_pitches,
+                work_pitches[pitch_targets])
+            new_durations = work_durations[duration_targets] + self._draw_duration_changes(rng, len(duration_targets))
+            work_durations[duration_targets] = np.where(
+                new_durations > 0, new_durations, work_durations[duration_targets])
+
+        work_pitches = work_pitches.tolist()
+        work_durations = work_durations.tolist()
+        for melody_index, unit_index, start, length in zip(
+                melody_indices.tolist(), unit_indices.tolist(), pair_starts.tolist(), pair_lengths.tolist()):
+            mutated_note_units[melody_index][unit_index] = [
+                [work_pitches[i], work_durations[i]] for i in range(start, start + length)]
+
+    def _batch_join_or_split(self, rng, offsets, pairs, mutated_note_units):
+        """Apply _join_or_split to every (melody, note_unit) pair in pairs.
+
+        Joins and splits change the shape of a note_unit, so they are assembled one at a time; they are rare
+        (mutation_percentage squared) and all of their random draws are still made up front.
+        """
+        melody_indices, unit_indices = pairs
+        count = len(unit_indices)
+        if count == 0:
+            return
+        unit_starts = offsets[unit_indices]
+        pair_lengths = offsets[unit_indices + 1] - unit_starts
+        if self.operator_weights is None:
+            split = rng.integers(0, 2, size=count).astype(bool)
+        else:
+            split = rng.random(count) < self._split_probability
+        chosen_notes = rng.integers(0, pair_lengths)
+        new_pitch_changes = self._draw_pitch_changes(rng, (count, 2))
+        if self.constraints:
+            # the pitches of the notes a split adds are drawn from the moves legal from the split note's pitch
+            split_pitches = np.frombuffer(self.seed_melody.pitches, dtype=np.int8).astype(np.int64)[
+                unit_starts + chosen_notes]
+            new_pitch_changes = self.constraints.sample_pitches(
+                rng, np.repeat(split_pitches, 2)).reshape(count, 2) - split_pitches[:, None]
+        # the number of notes to join is drawn from a scaled list sized for each note_unit; its values pass 2 ** 63
+        # for long note_units, so a uniform draw is scaled to the list rather than drawing integers up to its end
+        join_rand = rng.random(count).tolist()
+        join_choice_rand = rng.random(count)
+
+        for i, (melody_index, unit_index) in enumerate(zip(melody_indices.tolist(), unit_indices.tolist())):
+            note_unit = list(self.seed_melody[unit_index])
+            if split[i]:
+                target_note_index = int(chosen_notes[i])
+                target_note = note_unit[target_note_index]
+                if target_note[1] < 0.5:
+                    continue
+                elif target_note[1] % 0.5 == 0.0:
+                    split_count = 2
+                    shortened_note = [target_note[0], target_note[1] * 0.5]
+                elif target_note[1] % 0.75 == 0.0:
+                    split_count = 3
+                    shortened_note = [target_note[0], target_note[1] / 3]
+                else:
+                    continue
+                if self.constraints and not self.constraints.allows_duration(shortened_note[1]):
+                    continue
+                new_notes = [shortened_note]
+                for change in new_pitch_changes[i, :split_count - 1].tolist():
+                    new_pitch = shortened_note[0] + change
+                    if not LOWEST_PITCH <= new_pitch <= HIGHEST_PITCH:
+                        new_pitch = shortened_note[0]
+                    new_notes.append([new_pitch, shortened_note[1]])
+                note_unit[target_note_index:target_note_index + 1] = new_notes
             else:
-                mutated_melody.append(note_unit)
-        return mutated_melody
+                if len(note_unit) <= 1:
+                    continue
+                note_join_probs_list = scaled_probabilities_table(max_change=len(note_unit) - 1)
+                number_of_notes_to_join = bisect.bisect_right(
+                    note_join_probs_list, join_rand[i] * note_join_probs_list[-1]) + 2
+                notes_to_join = note_unit[0:number_of_notes_to_join]
+                new_pitch = notes_to_join[int(join_choice_rand[i] * len(notes_to_join))][0]
+                new_duration = 0
+                for note in notes_to_join:
+                    new_duration += note[1]
+                if self.constraints and not self.constraints.allows_duration(new_duration):
+                    continue
+                note_unit = [[new_pitch, new_duration]] + note_unit[number_of_notes_to_join:]
+            mutated_note_units[melody_index][unit_index] = note_unit
 
 
-# For running via command line
-# TODO: alter this to take a seed file name as an argument instead of calling 'get_seed_file()'
+# For running via command line; see batch.py
 def main():
-    file_handler = FileHandler()
-    seed_file = file_handler.get_seed_file()
-    seed_melody = file_handler.filename_to_list(filename=seed_file)
-    i = 0
-    created_melodies = []
-    mutator = Mutator(seed_melody=seed_melody, mutation_percentage=5)
-    while i < 20:
-        mutated_melody = mutator.mutate()
-        if mutated_melody != seed_melody and mutated_melody not in created_melodies:
-            midi_maker = MidiMaker(file_handler=file_handler, melody=mutated_melody)
-            midi_maker.write()
-            created_melodies.append(mutated_melody)
-            i += 1
+    from batch import main as batch_main  # batch imports this module
+    batch_main()
 
 
 if __name__ == "__main__":
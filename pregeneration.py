@@ -0,0 +1,117 @@
+import random
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, CancelledError, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from mutator import Mutator
+
+
+def generate_candidate_pool(seed_melody, pool_size, mutation_percentage, constraints=None, operator_weights=None):
+    """Generate up to pool_size distinct mutations of seed_melody; runs in a worker process.
+
+    A fresh random.Random is used because forked workers would otherwise share the parent's random state.
+
+    Returns:
+        Tuple of (List of Melodies, provenance Dict as filled in by Mutator.generate_unique)
+    """
+    mutator = Mutator(
+        seed_melody=seed_melody, mutation_percentage=mutation_percentage, rng=random.Random(), constraints=constraints,
+        operator_weights=operator_weights)
+    provenance = {}
+    return mutator.generate_unique(count=pool_size, provenance=provenance), provenance
+
+
+class CandidatePregenerator(object):
+    """
+    Speculatively generates candidate pools in background processes.
+
+    When /review shows a set of candidates, any of them may be selected as the next seed, so a pool is started for
+    each of them right away.  When the next /review arrives, take() hands over the pool for the selected seed, which
+    is usually finished already.  Scheduling a new set of seeds cancels (or discards) the work for the old ones of the
+    same group; groups (e.g. one per workspace) let several sessions share one pregenerator.  Only the max_groups most
+    recently used groups are kept, so abandoned sessions don't hold on to their pools.
+    """
+
+    def __init__(self, pool_size, mutation_percentage, max_workers=None, constraints=None, max_groups=64):
+        """
+        Args:
+            pool_size (Int): the number of candidates generated per seed
+            mutation_percentage (Int): passed to Mutator
+        Kwargs:
+            max_workers (Int): the number of worker processes; defaults to the number of cores
+            constraints (MutationConstraints): passed to Mutator
+            max_groups (Int): the work of the least recently used groups is dropped beyond this many
+        """
+        self.pool_size = pool_size
+        self.mutation_percentage = mutation_percentage
+        self.constraints = constraints
+        self.max_workers = max_workers
+        self.max_groups = max_groups
+        self.executor = None
+        # group -> {(seed fingerprint, mutation_percentage, operator_weights): Future}, least recently used group first;
+        # only used under lock, since requests schedule and take pools from several threads
+        self.pending = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _get_executor(self):
+        # created on first use, so importing the app doesn't start any processes
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        return self.executor
+
+    @staticmethod
+    def _cancel(futures):
+        for future in futures.values():
+            future.cancel()
+
+    def schedule(self, seed_melodies, group=None, mutation_percentage=None, operator_weights=None):
+        """Start generating a pool for each of seed_melodies, and drop the work for any other seeds in group.
+        mutation_percentage and operator_weights override the pregenerator's settings for these pools (see
+        MutationScheduler.choose); a pool generated with other settings isn't reused."""
+        mutation_percentage = mutation_percentage or self.mutation_percentage
+        operator_weights = None if operator_weights is None else tuple(operator_weights)
+        with self.lock:
+            previous_futures = self.pending.pop(group, {})
+            futures = {}
+            for seed_melody in seed_melodies:
+                key = (seed_melody.fingerprint, mutation_percentage, operator_weights)
+                future = previous_futures.pop(key, None)
+                if future is None:
+                    future = self._get_executor().submit(
+                        generate_candidate_pool, seed_melody, self.pool_size, mutation_percentage, self.constraints,
+                        operator_weights)
+                futures[key] = future
+            self._cancel(previous_futures)
+            self.pending[group] = futures
+            while len(self.pending) > self.max_groups:
+                self._cancel(self.pending.popitem(last=False)[1])
+
+    def take(self, seed_melody, timeout=None, group=None):
+        """Return the pregenerated (pool, provenance) for seed_melody, or None if there isn't one.
+
+        A pool that is still being generated is waited for (up to timeout seconds), since that is quicker than
+        starting over.  One that hasn't started yet is cancelled.
+        """
+        with self.lock:
+            futures = self.pending.get(group)
+            if futures is None:
+                return None
+            self.pending.move_to_end(group)
+            key = next((key for key in futures if key[0] == seed_melody.fingerprint), None)
+            future = futures.pop(key, None)
+        if future is None or future.cancel():
+            return None
+        try:
+            return future.result(timeout=timeout)
+        except (CancelledError, FutureTimeoutError, BrokenProcessPool):
+            return None
+
+    def shutdown(self):
+        with self.lock:
+            for futures in self.pending.values():
+                self._cancel(futures)
+            self.pending.clear()
+            if self.executor is not None:
+                self.executor.shutdown(wait=False, cancel_futures=True)
+                self.executor = None
@@ -0,0 +1,115 @@
+import sqlite3
+from pathlib import Path
+
+from sqlite_store import SQLiteStore
+
+
+class ProgressionIndex(SQLiteStore):
+    """
+    A SQLite index of the files FileHandler keeps under its root_directory: the current seed file, the progression
+    steps, the dated output directories and the candidates persisted in them.  It also maps the content hashes used
+    as filenames to the melodies' binary encodings (see Melody.to_bytes).
+
+    FileHandler answers its lookups from here instead of listing directories and parsing filenames, so they cost the
+    same no matter how long a progression gets.  Writes that span several statements should be wrapped in
+    transaction(), which takes SQLite's write lock up front, so concurrent requests are applied one after another.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS seed (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            filename TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS progression (
+            step INTEGER PRIMARY KEY,
+            filename TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS output_directories (
+            name TEXT PRIMARY KEY,
+            date TEXT NOT NULL,
+            increment INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS output_directories_by_date ON output_directories (date, increment);
+        CREATE TABLE IF NOT EXISTS candidates (
+            fingerprint TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            output_directory TEXT NOT NULL,
+            PRIMARY KEY (fingerprint, output_directory)
+        );
+        CREATE TABLE IF NOT EXISTS melodies (
+            content_hash TEXT PRIMARY KEY,
+            encoding BLOB NOT NULL
+        );
+    """
+
+    def __init__(self, path, timeout=30, read_only=False):
+        """
+        Args:
+            path (String): the SQLite database file; created if necessary
+        Kwargs:
+            timeout (Int): seconds to wait for another process's write lock
+            read_only (Bool): open an existing index for lookups only, without creating or changing anything
+        Raises:
+            sqlite3.Error if a read_only index can't be opened
+        """
+        if read_only:
+            self.path = path
+            self.connection = sqlite3.connect(
+                f'{Path(path).resolve().as_uri()}?mode=ro', timeout=timeout, isolation_level=None, uri=True)
+            return
+        super(ProgressionIndex, self).__init__(path, timeout=timeout)
+
+    def is_empty(self):
+        return not any(
+            self._value(f'SELECT EXISTS (SELECT 1 FROM {table})')
+            for table in ('seed', 'progression', 'output_directories')
+        )
+
+    def clear(self):
+        """Remove everything that can be rebuilt from the files on disk.  The melodies table is kept, because
+        hashed filenames can't be decoded without it."""
+        with self.transaction():
+            for table in ('seed', 'progression', 'output_directories', 'candidates'):
+                self.connection.execute(f'DELETE FROM {table}')
+
+    def get_seed(self):
+        """Return the filename of the current seed file, or None."""
+        return self._value('SELECT filename FROM seed WHERE id = 1')
+
+    def set_seed(self, filename):
+        if filename is None:
+            self.connection.execute('DELETE FROM seed')
+        else:
+            self.connection.execute('INSERT OR REPLACE INTO seed (id, filename) VALUES (1, ?)', (filename,))
+
+    def next_progression_step(self):
+        return self._value('SELECT COALESCE(MAX(step), 0) + 1 FROM progression')
+
+    def add_progression_step(self, step, filename):
+        self.connection.execute('INSERT INTO progression (step, filename) VALUES (?, ?)', (step, filename))
+
+    def progression_filenames(self):
+        """Return (step, filename) pairs, in order."""
+        return self.connection.execute('SELECT step, filename FROM progression ORDER BY step').fetchall()
+
+    def next_output_directory_increment(self, date):
+        """Return 0 if no output directory exists for date yet, otherwise one more than the highest increment."""
+        highest = self._value('SELECT MAX(increment) FROM output_directories WHERE date = ?', (date,))
+        return 0 if highest is None else highest + 1
+
+    def add_output_directory(self, name, date, increment):
+        self.connection.execute(
+            'INSERT OR IGNORE INTO output_directories (name, date, increment) VALUES (?, ?, ?)', (name, date, increment))
+
+    def add_candidate(self, fingerprint, filename, output_directory):
+        self.connection.execute(
+            'INSERT OR IGNORE INTO candidates (fingerprint, filename, output_directory) VALUES (?, ?, ?)',
+            (fingerprint, filename, output_directory))
+
+    def add_melody(self, content_hash, encoding):
+        self.connection.execute(
+            'INSERT OR IGNORE INTO melodies (content_hash, encoding) VALUES (?, ?)', (content_hash, encoding))
+
+    def get_melody_encoding(self, content_hash):
+        """Return the binary encoding of the melody stored under content_hash, or None."""
+        return self._value('SELECT encoding FROM melodies WHERE content_hash = ?', (content_hash,))
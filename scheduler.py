@@ -0,0 +1,165 @@
+"""Adaptive mutation settings, learned from which candidates get selected.
+
+MutationScheduler treats every mutation_percentage in RATES, every one of Mutator.OPERATORS and every change
+magnitude as an arm of a bandit.  Each candidate offered for review is a trial for the arms that produced it, and a
+success for them if it is selected.  choose() picks the mutation_percentage and the operator weights for the next
+candidates by Thompson sampling: each arm's acceptance rate is drawn from its Beta posterior, so arms that led to
+selections are used more, while rarely tried ones still get explored.  Observations are discounted by DISCOUNT at
+every review, because what is useful changes as a melody matures (useful mutations become rarer and smaller).
+
+The statistics are a few dozen rows in the lineage store's SQLite file, so each workspace (each lineage) adapts on
+its own, every worker process shares them, and each review or selection updates them in a single transaction.
+Magnitudes (semitones for pitch, beats for duration, notes for joins and splits) are recorded for analysis (see
+statistics()); choose() doesn't use them.
+"""
+
+import numpy as np
+
+import metrics
+from mutator import Mutator
+
+
+MUTATIONS_SCHEDULED = metrics.counter(
+    'evolving_mutations_scheduled_total', 'Candidate batches generated with adaptive settings, by mutation_percentage.')
+
+
+def mutation_operations(parent, child):
+    """Return the (operator, magnitude) pairs of the mutations that turned parent into child.
+
+    Args:
+        parent (Melody)
+        child (Melody): with the same number of note_units as parent
+    Returns:
+        List of pairs: ('pitch', semitones), ('duration', beats), ('join', notes joined) or ('split', notes added)
+    """
+    operations = []
+    for index, note_unit in child.diff(parent):
+        parent_note_unit = parent[index]
+        if len(note_unit) > len(parent_note_unit):
+            operations.append(('split', len(note_unit) - len(parent_note_unit)))
+        elif len(note_unit) < len(parent_note_unit):
+            operations.append(('join', len(parent_note_unit) - len(note_unit) + 1))
+        else:
+            for (pitch, duration), (parent_pitch, parent_duration) in zip(note_unit, parent_note_unit):
+                if pitch != parent_pitch:
+                    operations.append(('pitch', abs(pitch - parent_pitch)))
+                if duration != parent_duration:
+                    operations.append(('duration', abs(duration - parent_duration)))
+    return operations
+
+
+class MutationScheduler(object):
+    """
+    Per-lineage acceptance statistics, and the mutation settings they suggest.
+
+    Arms are identified by a kind and a value: ('rate', mutation_percentage), ('operator', name), and
+    ('pitch', semitones), ('duration', beats), ('join', notes) or ('split', notes) for the magnitudes.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS scheduler_arms (
+            kind TEXT NOT NULL,
+            value TEXT NOT NULL,
+            successes REAL NOT NULL DEFAULT 0,
+            trials REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (kind, value)
+        ) WITHOUT ROWID;
+    """
+
+    RATES = (1, 2, 3, 5, 8, 13, 20)  # the mutation_percentages to choose from
+    DISCOUNT = 0.98  # weight kept by earlier observations at every review
+    # the operator weights are adapted once the operators' discounted successes add up to this; a selection counts
+    # once for every operator that produced it
+    MIN_OPERATOR_SUCCESSES = 5
+
+    def __init__(self, lineage, rng=None):
+        """
+        Args:
+            lineage (LineageStore): the statistics are kept in its database
+        Kwargs:
+            rng (numpy.random.Generator, Int or None): random source for choose(), or a seed used to create one
+        """
+        self.lineage = lineage
+        self.connection = lineage.connection
+        self.connection.executescript(self.SCHEMA)
+        self.rng = np.random.default_rng(rng)
+
+    def _arms(self, melody, parent, mutation_percentage):
+        arms = {('rate', str(mutation_percentage))} if mutation_percentage is not None else set()
+        for operator, magnitude in mutation_operations(parent, melody):
+            arms.add(('operator', operator))
+            arms.add((operator, str(magnitude)))
+        return arms
+
+    def _add(self, arm_counts, column):
+        self.connection.executemany(
+            f'INSERT INTO scheduler_arms (kind, value, {column}) VALUES (?, ?, ?) '
+            f'ON CONFLICT (kind, value) DO UPDATE SET {column} = {column} + excluded.{column}',
+            [(kind, value, count) for (kind, value), count in arm_counts.items()])
+
+    def record_offered(self, parent, candidates, provenance=None):
+        """Count candidates, offered for review, as trials of the arms that produced them.
+
+        Args:
+            parent (Melody)
+            candidates (List): Melodies generated from parent
+        Kwargs:
+            provenance (Dict): as filled in by Mutator.generate_unique(); gives each candidate's mutation_percentage
+        """
+        provenance = provenance or {}
+        trials = {}
+        for candidate in candidates:
+            mutation_percentage = provenance.get(candidate.fingerprint, (None,) * 4)[3]
+            for arm in self._arms(candidate, parent, mutation_percentage):
+                trials[arm] = trials.get(arm, 0) + 1
+        with self.lineage.transaction():
+            self.connection.execute(
+                'UPDATE scheduler_arms SET successes = successes * ?, trials = trials * ?',
+                (self.DISCOUNT, self.DISCOUNT))
+            self._add(trials, 'trials')
+
+    def record_selection(self, parent, selected):
+        """Count selected as a success of the arms that produced it from parent.
+
+        Returns:
+            True, or False if selected wasn't recorded as generated from parent (e.g. the seed was kept)
+        """
+        edge = self.lineage.edge(selected.fingerprint, parent.fingerprint)
+        if edge is None:
+            return False
+        _, provenance = edge
+        with self.lineage.transaction():
+            self._add({arm: 1 for arm in self._arms(selected, parent, provenance[3])}, 'successes')
+        return True
+
+    def statistics(self):
+        """Return {kind: {value: (successes, trials)}}, with the discounted counts of every arm."""
+        statistics = {}
+        for kind, value, successes, trials in self.connection.execute(
+                'SELECT kind, value, successes, trials FROM scheduler_arms ORDER BY kind, value'):
+            statistics.setdefault(kind, {})[value] = (successes, trials)
+        return statistics
+
+    def _sample(self, arm_statistics, values):
+        """Draw an acceptance rate for each of values from its Beta posterior (with a uniform prior)."""
+        counts = [arm_statistics.get(str(value), (0, 0)) for value in values]
+        return self.rng.beta([1 + successes for successes, _ in counts],
+                             [1 + max(trials - successes, 0) for successes, trials in counts])
+
+    def choose(self):
+        """Return (mutation_percentage, operator_weights) for the next candidates, to pass to Mutator.
+
+        operator_weights is None (Mutator's default shares) until the operators' discounted successes add up to
+        MIN_OPERATOR_SUCCESSES.
+        """
+        statistics = self.statistics()
+        rate_samples = self._sample(statistics.get('rate', {}), self.RATES)
+        mutation_percentage = self.RATES[int(np.argmax(rate_samples))]
+        MUTATIONS_SCHEDULED.inc(mutation_percentage=mutation_percentage)
+        operator_statistics = statistics.get('operator', {})
+        if sum(successes for successes, _ in operator_statistics.values()) < self.MIN_OPERATOR_SUCCESSES:
+            return mutation_percentage, None
+        operator_samples = self._sample(operator_statistics, Mutator.OPERATORS)
+        operator_weights = tuple(
+            max(1, int(round(255 * sample / operator_samples.max()))) for sample in operator_samples.tolist())
+        return mutation_percentage, operator_weights
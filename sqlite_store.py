@@ -0,0 +1,41 @@
+import sqlite3
+from contextlib import contextmanager
+
+
+class SQLiteStore(object):
+    """
+    A SQLite database opened in autocommit mode with WAL journaling, so any number of threads and processes can read
+    it while one writes.  Subclasses (ProgressionIndex, LineageStore) give the tables to create as SCHEMA.
+    """
+
+    SCHEMA = ''
+
+    def __init__(self, path, timeout=30):
+        """
+        Args:
+            path (String): the SQLite database file; created if necessary
+        Kwargs:
+            timeout (Int): seconds to wait for another process's write lock
+        """
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(self.SCHEMA)
+
+    @contextmanager
+    def transaction(self):
+        """Run the enclosed statements atomically.  Nested uses join the outermost transaction."""
+        if self.connection.in_transaction:
+            yield
+            return
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self.connection.execute('ROLLBACK')
+            raise
+        self.connection.execute('COMMIT')
+
+    def _value(self, query, parameters=()):
+        row = self.connection.execute(query, parameters).fetchone()
+        return row[0] if row else None
@@ -0,0 +1,42 @@
+"""Melodies and fixtures shared by the tests and the benchmarks; both conftest.py files import them."""
+
+import random
+
+import pytest
+
+import cache
+from melody import Melody
+from mutator import FileHandler
+
+
+DURATIONS = [0.25, 0.5, 0.75, 1.0, 1.5, 2.0]
+
+
+def make_melody(note_count, seed=0, durations=DURATIONS):
+    """Return a reproducible random Melody with note_count notes, in note_units of 1 to 4 notes."""
+    rng = random.Random(seed)
+    note_units = []
+    remaining = note_count
+    while remaining:
+        unit_length = min(rng.randint(1, 4), remaining)
+        note_units.append([[rng.randint(48, 72), rng.choice(durations)] for _ in range(unit_length)])
+        remaining -= unit_length
+    return Melody(note_units)
+
+
+@pytest.fixture(autouse=True)
+def empty_caches():
+    """Start every test without the melodies and midi cached by earlier ones."""
+    for content_cache in (cache.MELODIES, cache.MIDI_FILES, cache.RECORDED_MELODIES):
+        content_cache.clear()
+
+
+@pytest.fixture
+def root_directory(tmp_path, monkeypatch):
+    """Point FileHandler at a temporary static/midi_files directory, with the working directory above it so
+    relative paths resolve the way they do when running app.py."""
+    root_directory = tmp_path / 'static' / 'midi_files'
+    root_directory.mkdir(parents=True)
+    monkeypatch.setattr(FileHandler, 'ROOT_DIRECTORY', str(root_directory))
+    monkeypatch.chdir(tmp_path)
+    return root_directory
@@ -0,0 +1,120 @@
+import os
+import re
+
+import pytest
+
+from helpers import make_melody
+from mutator import FileHandler, MidiMaker
+
+
+@pytest.fixture
+def app_module(root_directory):
+    import app as app_module
+    yield app_module
+    app_module.pregenerator.shutdown()
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
+
+
+@pytest.fixture
+def seed_file(root_directory):
+    seed_melody = make_melody(16)
+    file_handler = FileHandler()
+    MidiMaker(output_directory=os.path.join(str(root_directory), 'seed_file'), melody=seed_melody).write()
+    return file_handler.melody_to_filename(seed_melody)
+
+
+def candidate_urls(response):
+    return re.findall(r'/candidates/[0-9a-f]+\.mid', response.get_data(as_text=True))
+
+
+def midi_files(directory):
+    return sorted(os.path.join(path, filename) for path, _, filenames in os.walk(directory)
+                  for filename in filenames if filename.endswith('.mid'))
+
+
+def test_candidates_are_served_from_memory(client, root_directory, seed_file):
+    files_before = midi_files(root_directory)
+    response = client.get(f'/review?seed_file={seed_file}')
+    assert response.status_code == 200
+    urls = candidate_urls(response)
+    assert len(urls) > 0
+    for url in urls:
+        response = client.get(url)
+        assert response.status_code == 200
+        assert response.mimetype == 'audio/midi'
+        assert response.data.startswith(b'MThd')
+    assert midi_files(root_directory) == files_before  # only a selection is written to disk
+
+
+def test_candidates_are_cached_by_fingerprint(client, seed_file):
+    url = candidate_urls(client.get(f'/review?seed_file={seed_file}'))[0]
+    fingerprint = url.rsplit('/', 1)[1][:-len('.mid')]
+    response = client.get(url)
+    assert response.headers['ETag'] == f'"{fingerprint}"'
+    assert 'max-age=31536000' in response.headers['Cache-Control']
+    assert client.get(url, headers={'If-None-Match': f'"{fingerprint}"'}).status_code == 304
+
+
+def test_unknown_candidate_is_not_found(client, seed_file):
+    assert client.get(f'/candidates/{"0" * 32}.mid').status_code == 404
+
+
+@pytest.mark.parametrize('encoding', [None, '', 'not base64!', 'AQ=='])
+def test_select_rejects_corrupt_encodings(client, seed_file, encoding):
+    data = {'selection_type': 'regenerate'}
+    if encoding is not None:
+        data['melody_encoding'] = encoding
+    assert client.post('/select', data=data).status_code == 400
+
+
+def test_metrics_route(client, seed_file):
+    client.get(f'/review?seed_file={seed_file}')
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    text = response.get_data(as_text=True)
+    assert 'evolving_request_seconds_count{endpoint="review"}' in text
+    assert '# TYPE evolving_candidates_drawn_total counter' in text
+
+
+def test_lineage_melodies_are_served(client, app_module, seed_file):
+    url = candidate_urls(client.get(f'/review?seed_file={seed_file}'))[0]
+    fingerprint = url.rsplit('/', 1)[1][:-len('.mid')]
+    app_module.cache.MELODIES.clear()  # as in a worker process that didn't offer it
+    response = client.get(f'/lineage/{fingerprint}.mid')
+    assert response.status_code == 200
+    assert response.data == client.get(url).data
+    assert response.headers['ETag'] == f'"{fingerprint}"'
+    assert client.get(f'/lineage/{"0" * 32}.mid').status_code == 404
+
+
+def encodings(response):
+    return re.findall(r'name="melody_encoding" type="hidden" value="([^"]+)"', response.get_data(as_text=True))
+
+
+def test_workspaces_are_isolated(app_module, root_directory, seed_file):
+    default_client, session_client = app_module.app.test_client(), app_module.app.test_client()
+    session_client.get('/workspaces/new')
+    workspace = session_client.get_cookie(app_module.WORKSPACE_COOKIE).value
+    response = session_client.get(f'/review?seed_file={seed_file}')
+    assert response.status_code == 200
+    response = session_client.post('/select', data={'melody_encoding': encodings(response)[0],
+                                                    'selection_type': 'regenerate'})
+    assert response.status_code == 302
+
+    session_handler = FileHandler(workspace=workspace)
+    assert session_handler.root_directory == os.path.join(str(root_directory), 'workspaces', workspace)
+    assert len(session_handler.index.progression_filenames()) == 1
+    assert session_handler.lineage.step_count() == 2
+    default_handler = FileHandler()
+    assert os.path.basename(default_handler.find_seed_file_on_disk()) == seed_file
+    assert default_handler.index.progression_filenames() == []
+    assert default_client.get(f'/review?seed_file={seed_file}').status_code == 200
+
+
+def test_invalid_workspace_is_rejected(client, seed_file):
+    assert client.get(f'/review?seed_file={seed_file}&workspace=../elsewhere').status_code == 400
@@ -0,0 +1,100 @@
+import io
+import os
+import threading
+import wave
+
+import audio
+from audio import AudioRenderer, render_to_file, synthesize, to_wav
+from helpers import make_melody
+from melody import Melody
+
+
+def test_synthesize_length_follows_the_durations():
+    samples = synthesize(Melody([[[60, 1.0], [62, 0.5]], [[64, 0.5]]]), sample_rate=1000, tempo=120)
+    assert len(samples) == 1000  # two beats at 120 bpm
+    assert samples.dtype.name == 'int16'
+    assert abs(samples).max() > 0
+
+
+def test_to_wav():
+    samples = synthesize(make_melody(8))
+    with wave.open(io.BytesIO(to_wav(samples)), 'rb') as wav_file:
+        assert wav_file.getnchannels() == 1
+        assert wav_file.getframerate() == audio.SAMPLE_RATE
+        assert wav_file.getnframes() == len(samples)
+
+
+def test_render_to_file_leaves_no_temporary_files(tmp_path):
+    output_path = str(tmp_path / 'preview.wav')
+    assert render_to_file(make_melody(8), output_path) == output_path
+    assert os.listdir(tmp_path) == ['preview.wav']
+    with open(output_path, 'rb') as wav_file:
+        assert wav_file.read() == to_wav(synthesize(make_melody(8)))
+
+
+def test_threads_render_the_same_file_concurrently(tmp_path, monkeypatch):
+    # every thread synthesizes before any of them renames its file into place, so they'd clobber each other's
+    # temporary file if its name only told processes apart
+    thread_count = 4
+    barrier = threading.Barrier(thread_count)
+    unsynchronized_synthesize = audio.synthesize
+
+    def synchronized_synthesize(melody):
+        barrier.wait(timeout=10)
+        return unsynchronized_synthesize(melody)
+
+    monkeypatch.setattr(audio, 'synthesize', synchronized_synthesize)
+    output_path = str(tmp_path / 'preview.wav')
+    errors = []
+
+    def render():
+        try:
+            render_to_file(make_melody(8), output_path)
+        except Exception as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=render) for _ in range(thread_count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    assert os.listdir(tmp_path) == ['preview.wav']
+
+
+def test_renderer_caches_by_fingerprint(tmp_path):
+    renderer = AudioRenderer(str(tmp_path), max_workers=1)
+    try:
+        melody = make_melody(8)
+        path = renderer.render(melody)
+        assert path == renderer.cache_path(melody)
+        assert os.path.exists(path)
+        modified = os.path.getmtime(path)
+        assert renderer.render(melody) == path
+        assert os.path.getmtime(path) >= modified
+    finally:
+        renderer.shutdown()
+
+
+def test_prefetched_previews_are_rendered_in_the_background(tmp_path):
+    renderer = AudioRenderer(str(tmp_path), max_workers=1)
+    try:
+        melodies = [make_melody(8, seed=seed) for seed in range(3)]
+        renderer.prefetch(melodies)
+        assert set(renderer.pending) == {melody.fingerprint for melody in melodies}
+        for melody in melodies:
+            assert os.path.exists(renderer.render(melody))
+        assert not renderer.pending
+    finally:
+        renderer.shutdown()
+
+
+def test_eviction_keeps_the_cache_under_its_cap(tmp_path):
+    renderer = AudioRenderer(str(tmp_path), max_cache_bytes=1, max_workers=1)
+    try:
+        renderer.render(make_melody(8, seed=0))
+        renderer.render(make_melody(8, seed=1))
+        renderer.evict()
+        assert not [name for name in os.listdir(tmp_path) if name.endswith('.wav')]
+    finally:
+        renderer.shutdown()
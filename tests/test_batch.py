@@ -0,0 +1,94 @@
+import io
+import json
+import tarfile
+import zipfile
+
+import pytest
+
+import batch
+import corpus
+from helpers import make_melody
+from melody import Melody
+from mutator import FileHandler, MidiMaker
+
+
+@pytest.fixture
+def midi_directory(tmp_path):
+    """Three MIDI files, with a corrupt one between them."""
+    directory = tmp_path / 'midi'
+    directory.mkdir()
+    melodies = {}
+    for index in (0, 2):
+        melody = make_melody(8, seed=index, durations=[0.25, 0.5, 1.0])
+        melodies[f'{index}.mid'] = melody
+        (directory / f'{index}.mid').write_bytes(MidiMaker(melody=melody).to_bytes())
+    (directory / '1.mid').write_bytes(b'MThd but not really')
+    return directory, melodies
+
+
+def test_load_seeds_skips_unreadable_files(midi_directory, capsys):
+    directory, melodies = midi_directory
+    counts = {}
+    seeds = dict(batch.load_seeds([str(directory)], counts=counts))
+    assert set(seeds) == set(melodies)
+    for name, melody in melodies.items():
+        assert seeds[name].pitches == melody.pitches
+    assert counts == {'failed': 1}
+    assert str(directory / '1.mid') in capsys.readouterr().err
+
+
+def test_load_seeds_reads_filenames_encodings_and_shards(tmp_path, root_directory):
+    melody = make_melody(6)
+    corpus.write_shard(str(tmp_path / f'corpus-00000{corpus.SHARD_SUFFIX}'), [('sharded', melody)])
+    seeds = list(batch.load_seeds(['48-1p0__51-0p25_53-0p25.mid', melody.to_base64(), str(tmp_path)]))
+    assert seeds[0] == ('48-1p0__51-0p25_53-0p25.mid', Melody([[[48, 1.0]], [[51, 0.25], [53, 0.25]]]))
+    assert seeds[1] == (melody.fingerprint[:FileHandler.CONTENT_HASH_LENGTH], melody)
+    assert seeds[2] == ('sharded', melody)
+    with pytest.raises(ValueError):
+        list(batch.load_seeds(['not a seed']))
+
+
+def test_hashed_filenames_are_looked_up_in_the_root(tmp_path, root_directory):
+    melody = make_melody(6)
+    filename = FileHandler().melody_to_filename(melody)
+    assert batch.recorded_melody(filename[:-4], str(root_directory)) == melody
+    assert list(batch.load_seeds([filename], root_directory=str(root_directory))) == [(filename, melody)]
+    assert batch.recorded_melody(filename[:-4], str(tmp_path)) is None  # no index there
+    with pytest.raises(ValueError):
+        list(batch.load_seeds([filename], root_directory=str(tmp_path)))
+
+
+def test_batches_are_reproducible_across_worker_counts():
+    seeds = [(str(index), make_melody(16, seed=index)) for index in range(5)]
+    outputs = []
+    for workers in (1, 3):
+        output_file = io.StringIO()
+        writer = batch.JsonLinesWriter(output_file)
+        assert batch.generate_batch(seeds, writer, 10, mutation_percentage=20, seed=7, workers=workers) == (5, 50)
+        outputs.append(output_file.getvalue())
+    assert outputs[0] == outputs[1]
+    records = [json.loads(line) for line in outputs[0].splitlines()]
+    assert [record['seed'] for record in records[::10]] == ['0', '1', '2', '3', '4']
+    for record in records:
+        candidate = Melody.from_base64(record['encoding'])
+        assert candidate.fingerprint == record['fingerprint']
+        assert candidate.to_list() == record['melody']
+
+
+@pytest.mark.parametrize('suffix', ['.zip', '.tar', '.tar.gz'])
+def test_archives_hold_a_directory_per_seed(tmp_path, suffix):
+    path = str(tmp_path / f'candidates{suffix}')
+    writer = batch.open_writer(path)
+    seed_melody = make_melody(16)
+    batch.generate_batch([('seed', seed_melody)], writer, 5, mutation_percentage=20, seed=1, workers=1)
+    writer.close()
+    if suffix == '.zip':
+        with zipfile.ZipFile(path) as archive:
+            contents = {name: archive.read(name) for name in archive.namelist()}
+    else:
+        with tarfile.open(path) as archive:
+            contents = {member.name: archive.extractfile(member).read() for member in archive.getmembers()}
+    directory = seed_melody.fingerprint[:FileHandler.CONTENT_HASH_LENGTH]
+    assert len(contents) == 6
+    assert contents[f'{directory}/seed.mid'] == MidiMaker(melody=seed_melody).to_bytes()
+    assert all(name.startswith(f'{directory}/') and name.endswith('.mid') for name in contents)
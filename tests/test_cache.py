@@ -0,0 +1,115 @@
+import os
+import time
+
+import pytest
+
+import cache
+from cache import DiskCache, LRUCache, evict_least_recently_used
+from helpers import make_melody
+from mutator import FileHandler, MidiMaker
+
+
+@pytest.fixture
+def midi_disk_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, 'midi_disk_cache', None)
+    cache.enable_midi_disk_cache(str(tmp_path / 'midi_cache'))
+    return cache.midi_disk_cache
+
+
+def test_lru_cache_evicts_the_least_recently_used():
+    lru_cache = LRUCache('test', max_size=6)
+    lru_cache.put('a', b'aa')
+    lru_cache.put('b', b'bb')
+    lru_cache.put('c', b'cc')
+    assert lru_cache.get('a') == b'aa'  # now the most recently used
+    lru_cache.put('d', b'dd')
+    assert 'b' not in lru_cache
+    assert [key for key in ('a', 'c', 'd') if key in lru_cache] == ['a', 'c', 'd']
+    assert lru_cache.size == 6
+
+
+def test_lru_cache_replaces_and_sizes_entries():
+    lru_cache = LRUCache('test', max_size=10)
+    assert lru_cache.put('a', b'aaaa') == b'aaaa'
+    lru_cache.put('a', b'aa')
+    assert lru_cache.size == 2 and len(lru_cache) == 1
+    assert lru_cache.get('missing') is None
+    assert lru_cache.get('missing', 'default') == 'default'
+    lru_cache.put('big', b'x' * 20)  # larger than max_size, but the newest entry is always kept
+    assert len(lru_cache) == 1 and lru_cache.get('big') == b'x' * 20
+    lru_cache.clear()
+    assert len(lru_cache) == 0 and lru_cache.size == 0
+
+
+def test_melody_cache_is_sized_in_note_units_and_notes():
+    melody = make_melody(10)
+    assert cache._melody_size(melody) == len(melody) + 10
+
+
+def test_disk_cache_round_trip(tmp_path):
+    disk_cache = DiskCache(str(tmp_path / 'disk_cache'), max_bytes=2**20)
+    assert disk_cache.get('key') is None
+    assert disk_cache.put('key', b'value') == b'value'
+    assert disk_cache.get('key') == b'value'
+    assert os.listdir(tmp_path / 'disk_cache') == ['key.bin']
+
+
+def test_disk_cache_evicts_the_least_recently_read(tmp_path, monkeypatch):
+    monkeypatch.setattr(DiskCache, 'EVICTION_INTERVAL', 3)
+    disk_cache = DiskCache(str(tmp_path), max_bytes=25)
+    disk_cache.put('old', b'x' * 10)
+    disk_cache.put('read', b'x' * 10)
+    past = time.time() - 60
+    os.utime(tmp_path / 'old.bin', (past, past))
+    os.utime(tmp_path / 'read.bin', (past - 60, past - 60))
+    disk_cache.get('read')
+    disk_cache.put('new', b'x' * 10)
+    assert sorted(os.listdir(tmp_path)) == ['new.bin', 'read.bin']
+
+
+def test_evict_least_recently_used_only_counts_the_suffix(tmp_path):
+    (tmp_path / 'kept.txt').write_bytes(b'x' * 100)
+    (tmp_path / 'a.wav').write_bytes(b'x' * 10)
+    evict_least_recently_used(str(tmp_path), 10, '.wav')
+    assert sorted(os.listdir(tmp_path)) == ['a.wav', 'kept.txt']
+    evict_least_recently_used(str(tmp_path), 5, '.wav')
+    assert os.listdir(tmp_path) == ['kept.txt']
+
+
+def rendering_key(midi_maker):
+    return (midi_maker.melody.fingerprint, midi_maker.tempo, midi_maker.channel, midi_maker.volume, midi_maker.time)
+
+
+def test_rendered_midi_is_cached_in_memory():
+    melody = make_melody(12)
+    midi_maker = MidiMaker(melody=melody)
+    midi_bytes = midi_maker.to_bytes()
+    assert cache.MIDI_FILES.get(rendering_key(midi_maker)) is midi_bytes
+    assert MidiMaker(melody=melody).to_bytes() is midi_bytes
+    slower = MidiMaker(melody=melody)
+    slower.tempo = 90
+    assert slower.to_bytes() != midi_bytes
+
+
+def test_rendered_midi_is_shared_on_disk(midi_disk_cache):
+    melody = make_melody(12)
+    midi_maker = MidiMaker(melody=melody)
+    midi_maker.to_bytes()
+    disk_key = '-'.join(str(part) for part in rendering_key(midi_maker))
+    assert os.listdir(midi_disk_cache.directory) == [f'{disk_key}.mid']
+    cache.MIDI_FILES.clear()  # as if in another process
+    midi_disk_cache.put(disk_key, b'from disk')
+    assert MidiMaker(melody=melody).to_bytes() == b'from disk'
+
+
+def test_recorded_melodies_are_only_stored_once(root_directory, monkeypatch):
+    file_handler = FileHandler()
+    stored = []
+    add_melody = file_handler.index.add_melody
+    monkeypatch.setattr(file_handler.index, 'add_melody', lambda *args: stored.append(args) or add_melody(*args))
+    melody = make_melody(12)
+    filename = file_handler.melody_to_filename(melody)
+    assert file_handler.melody_to_filename(melody) == filename
+    assert len(stored) == 1
+    cache.MELODIES.clear()
+    assert file_handler.filename_to_melody(filename) == melody
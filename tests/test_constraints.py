@@ -0,0 +1,62 @@
+import pickle
+import random
+
+import pytest
+
+from constraints import MutationConstraints
+from melody import Melody
+from mutator import FileHandler, Mutator
+
+
+@pytest.fixture
+def constraints():
+    return MutationConstraints(key='C', scale='major', lowest_pitch=48, highest_pitch=72, bar_beats=4)
+
+
+@pytest.fixture
+def legal_mutator(constraints):
+    seed_melody = FileHandler.filename_to_list('48-1p0__52-0p25_53-0p25_55-1p0_57-0p5__48-2p0__60-1p5_60-1p5__'
+                                               '50-0p75_52-0p5.mid')
+    assert constraints.allows(seed_melody)
+    return Mutator(seed_melody=seed_melody, mutation_percentage=40, constraints=constraints)
+
+
+def test_allows(constraints):
+    assert constraints.allows(Melody([[[60, 1.0], [62, 0.5]], [[72, 4.0]]]))
+    assert not constraints.allows(Melody([[[61, 1.0]]]))  # not in C major
+    assert not constraints.allows(Melody([[[74, 1.0]]]))  # above highest_pitch
+    assert not constraints.allows(Melody([[[60, 5.0]]]))  # longer than a bar
+    assert not constraints.allows(Melody([[[60, 0.1]]]))  # off the grid
+
+
+@pytest.mark.parametrize('arguments', [
+    {'key': 'H'},
+    {'scale': 'lydian'},
+    {'key': 'C', 'lowest_pitch': 61, 'highest_pitch': 61},
+    {'bar_beats': 0.1},
+])
+def test_invalid_constraints(arguments):
+    with pytest.raises(ValueError):
+        MutationConstraints(**arguments)
+
+
+def test_choices_are_legal(constraints):
+    rng = random.Random(3)
+    for pitch in range(128):
+        assert constraints.allows_pitch(constraints.choose_pitch(rng, pitch))
+    for duration in (0.25, 1.0, 3.75, 4.0):
+        assert constraints.allows_duration(constraints.choose_duration(rng, duration, duration))
+
+
+def test_pickles_to_an_equal_table(constraints):
+    unpickled = pickle.loads(pickle.dumps(constraints))
+    assert repr(unpickled) == repr(constraints)
+    assert (unpickled.pitch_cdf == constraints.pitch_cdf).all()
+
+
+def test_constrained_mutate_is_legal(constraints, legal_mutator):
+    assert all(constraints.allows(legal_mutator.mutate()) for _ in range(2000))
+
+
+def test_constrained_mutate_batch_is_legal(constraints, legal_mutator):
+    assert all(constraints.allows(child) for child in legal_mutator.mutate_batch(2000, rng=1))
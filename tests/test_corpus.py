@@ -0,0 +1,49 @@
+import os
+
+import pytest
+
+import corpus
+from helpers import make_melody
+from mutator import MidiMaker
+
+
+@pytest.fixture
+def midi_directory(tmp_path):
+    """A directory of MIDI files, some in a subdirectory, plus one that isn't MIDI at all."""
+    directory = tmp_path / 'midi'
+    (directory / 'sub').mkdir(parents=True)
+    melodies = {}
+    for index in range(12):
+        melody = make_melody(4 + index, seed=index, durations=[0.25, 0.5, 1.0])
+        melodies[f'{index}.mid'] = melody
+        with open(directory / ('sub' if index % 2 else '') / f'{index}.mid', 'wb') as output_file:
+            output_file.write(MidiMaker(melody=melody).to_bytes(use_midiutil=index % 3 == 0))
+    (directory / 'broken.mid').write_bytes(b'not a midi file')
+    return directory, melodies
+
+
+def test_import_preserves_the_notes(midi_directory, tmp_path):
+    directory, melodies = midi_directory
+    corpus.import_corpus([str(directory)], str(tmp_path / 'shards'), shard_size=5, workers=2)
+    imported = dict(corpus.read_corpus(str(tmp_path / 'shards')))
+    assert set(imported) == set(melodies)
+    for name, melody in melodies.items():
+        assert imported[name].pitches == melody.pitches
+        assert imported[name].ticks == melody.ticks
+    assert len(corpus.shard_paths(str(tmp_path / 'shards'))) == 3
+
+
+def test_export_and_reimport(midi_directory, tmp_path):
+    directory, _ = midi_directory
+    corpus.import_corpus([str(directory)], str(tmp_path / 'shards'), workers=2)
+    exported = corpus.export_corpus(str(tmp_path / 'shards'), str(tmp_path / 'exported'), workers=2)
+    assert exported == len(os.listdir(tmp_path / 'exported')) == 12
+    corpus.import_corpus([str(tmp_path / 'exported')], str(tmp_path / 'reimported'), workers=2)
+    assert ({melody.fingerprint for _, melody in corpus.read_corpus(str(tmp_path / 'reimported'))} ==
+            {melody.fingerprint for _, melody in corpus.read_corpus(str(tmp_path / 'shards'))})
+
+
+def test_shard_round_trip(tmp_path):
+    records = [(f'{index}.mid', make_melody(index + 1, seed=index)) for index in range(10)]
+    corpus.write_shard(str(tmp_path / 'corpus-00000.shard'), records)
+    assert list(corpus.read_shard(str(tmp_path / 'corpus-00000.shard'))) == records
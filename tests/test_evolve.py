@@ -0,0 +1,23 @@
+import pytest
+
+import evolve
+from helpers import make_melody
+
+
+def run(workers, seed=1, select=evolve.random_selection):
+    generations = list(evolve.evolve(make_melody(16), 3, population_size=8, children_per_melody=4, seed=seed,
+                                     workers=workers, select=select))
+    return [(generation, [melody.fingerprint for melody in population]) for generation, population in generations]
+
+
+@pytest.mark.parametrize('select', [evolve.random_selection, evolve.fitness_selection])
+def test_runs_are_reproducible_with_any_number_of_workers(select):
+    in_process = run(workers=1, select=select)
+    assert [generation for generation, _ in in_process] == [1, 2, 3]
+    assert [len(population) for _, population in in_process] == [5, 8, 8]
+    assert run(workers=2, select=select) == in_process
+    assert run(workers=3, select=select) == in_process
+
+
+def test_runs_differ_by_seed():
+    assert run(workers=1, seed=1) != run(workers=1, seed=2)
@@ -0,0 +1,163 @@
+import os
+import threading
+
+import pytest
+
+import cache
+from helpers import make_melody
+from lineage import LineageStore
+from mutator import FileHandler, MidiMaker
+from progression_index import ProgressionIndex
+
+
+def legacy_file(directory, filename):
+    """Write a midi file named in the melody notation that predates hashed filenames; returns its melody."""
+    os.makedirs(directory, exist_ok=True)
+    melody = FileHandler.filename_to_list(filename.split('^')[-1])
+    with open(os.path.join(directory, filename), 'wb') as output_file:
+        output_file.write(MidiMaker(melody=melody).to_bytes())
+    return melody
+
+
+def test_seed_and_progression_are_indexed(root_directory):
+    file_handler = FileHandler()
+    first, second = make_melody(8), make_melody(8, seed=1)
+    file_handler.ensure_seed_file(first)
+    selected_file = MidiMaker(output_directory=file_handler.setup_output_directory(), melody=second,
+                              file_handler=file_handler).write()
+    assert file_handler.advance_seed_file(file_handler.full_to_relative_path(selected_file), selected_melody=second)
+    assert file_handler.index.get_seed() == file_handler.melody_to_filename(second)
+    assert [filename for _, filename in file_handler.index.progression_filenames()] == [
+        file_handler.melody_to_filename(first)]
+    assert os.path.basename(file_handler.find_seed_file_on_disk()) == file_handler.melody_to_filename(second)
+
+
+def test_rebuild_index(root_directory):
+    file_handler = FileHandler()
+    seed_melody = make_melody(8)
+    file_handler.ensure_seed_file(seed_melody)
+    output_directory = file_handler.setup_output_directory()
+    candidate = make_melody(8, seed=1)
+    file_handler.record_candidate(candidate, MidiMaker(
+        output_directory=output_directory, melody=candidate, file_handler=file_handler).write())
+    file_handler.index.clear()
+    assert file_handler.index.is_empty()
+    file_handler.rebuild_index()
+    assert file_handler.index.get_seed() == file_handler.melody_to_filename(seed_melody)
+    assert file_handler.index.next_output_directory_increment(file_handler.date_string) == 1
+    assert file_handler.filename_to_melody(file_handler.melody_to_filename(candidate)) == candidate
+
+
+def test_migrate_filenames(root_directory):
+    root_directory = str(root_directory)
+    seed_melody = legacy_file(os.path.join(root_directory, 'seed_file'), '60-1p0_62-1p0.mid')
+    steps = [legacy_file(os.path.join(root_directory, 'progression'), '1^60-1p0.mid'),
+             legacy_file(os.path.join(root_directory, 'progression'), '2^60-2p0.mid')]
+    candidate = legacy_file(os.path.join(root_directory, '2026-01-01'), '60-2p0.mid')
+    legacy_file(os.path.join(root_directory, '2026-01-01', 'seed'), '60-1p0.mid')
+
+    FileHandler().migrate_filenames()
+
+    for directory, _, filenames in os.walk(root_directory):
+        assert all(FileHandler.HASHED_FILENAME_PATTERN.match(filename) for filename in filenames
+                   if filename.endswith('.mid')), directory
+    file_handler = FileHandler()
+    assert file_handler.filename_to_melody(os.path.basename(file_handler.find_seed_file_on_disk())) == seed_melody
+    assert [file_handler.filename_to_melody(filename.split('^', 1)[1])
+            for filename in file_handler.get_sorted_progression_files()] == steps
+    assert file_handler.filename_to_melody(file_handler.melody_to_filename(candidate)) == candidate
+
+
+def test_stores_are_opened_once_per_thread(root_directory):
+    first, second = FileHandler(), FileHandler()
+    assert first.index is second.index
+    assert first.lineage is second.lineage
+    assert isinstance(first.index, ProgressionIndex) and isinstance(first.lineage, LineageStore)
+    other_thread = []
+    thread = threading.Thread(target=lambda: other_thread.append(FileHandler().index))
+    thread.start()
+    thread.join()
+    assert other_thread[0] is not first.index
+
+
+def reopen(root_directory):
+    """Forget everything this process knows about root_directory, as if it was opened by a new process."""
+    FileHandler._prepared_roots.discard(str(root_directory))
+    FileHandler._open_stores.stores.clear()
+    for content_cache in (cache.MELODIES, cache.RECORDED_MELODIES):
+        content_cache.clear()
+
+
+def remove_database(root_directory, name):
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(os.path.join(str(root_directory), name + suffix)):
+            os.remove(os.path.join(str(root_directory), name + suffix))
+
+
+@pytest.fixture
+def progression(root_directory):
+    """A root with two progression steps and a selected candidate; returns (seed melody, selected melody)."""
+    file_handler = FileHandler()
+    first, second, third = make_melody(8), make_melody(8, seed=1), make_melody(8, seed=2)
+    file_handler.ensure_seed_file(first)
+    for melody in (second, third):
+        selected_file = MidiMaker(output_directory=file_handler.setup_output_directory(), melody=melody,
+                                  file_handler=file_handler).write()
+        file_handler.record_candidate(melody, selected_file)
+        file_handler.advance_seed_file(file_handler.full_to_relative_path(selected_file), selected_melody=melody)
+    return [first, second], third
+
+
+def test_lost_index_is_rebuilt_from_the_lineage(root_directory, progression):
+    steps, seed_melody = progression
+    reopen(root_directory)
+    remove_database(root_directory, 'index.sqlite3')
+    file_handler = FileHandler()
+    assert file_handler.filename_to_melody(os.path.basename(file_handler.find_seed_file_on_disk())) == seed_melody
+    assert [file_handler.filename_to_melody(filename) for _, filename in file_handler.index.progression_filenames()
+            ] == steps
+
+
+def test_lost_index_and_lineage_are_rebuilt_from_the_files(root_directory, progression):
+    steps, seed_melody = progression
+    reopen(root_directory)
+    remove_database(root_directory, 'index.sqlite3')
+    remove_database(root_directory, 'lineage.sqlite3')
+    file_handler = FileHandler()
+    recovered = file_handler.filename_to_melody(os.path.basename(file_handler.find_seed_file_on_disk()))
+    assert (recovered.pitches, recovered.ticks) == (seed_melody.pitches, seed_melody.ticks)
+    assert file_handler.lineage.step_count() == 3
+
+
+def test_unreadable_files_are_skipped(root_directory, progression):
+    output_directory = os.path.join(str(root_directory), FileHandler().date_string)
+    with open(os.path.join(output_directory, f'{"0" * 16}.mid'), 'wb') as output_file:
+        output_file.write(b'not a midi file')
+    reopen(root_directory)
+    remove_database(root_directory, 'index.sqlite3')
+    file_handler = FileHandler()
+    assert file_handler.index.get_seed() is not None
+
+
+def test_workspaces_have_their_own_state(root_directory):
+    first, second = FileHandler(workspace='first'), FileHandler(workspace='second')
+    first.ensure_seed_file(make_melody(8))
+    second.ensure_seed_file(make_melody(8, seed=1))
+    assert first.root_directory != second.root_directory
+    assert first.filename_to_melody(first.index.get_seed()) == make_melody(8)
+    assert second.filename_to_melody(second.index.get_seed()) == make_melody(8, seed=1)
+    assert FileHandler().index.get_seed() is None
+    with pytest.raises(ValueError):
+        FileHandler(workspace='../first')
+
+
+def test_seen_melodies_are_merged(root_directory):
+    file_handler = FileHandler()
+    first, second = file_handler.load_seen_melodies(), file_handler.load_seen_melodies()
+    first.add(make_melody(8).fingerprint)
+    second.add(make_melody(8, seed=1).fingerprint)
+    file_handler.save_seen_melodies(first)
+    file_handler.save_seen_melodies(second)  # e.g. by a request that loaded the filter at the same time
+    seen_melodies = file_handler.load_seen_melodies()
+    assert make_melody(8).fingerprint in seen_melodies
+    assert make_melody(8, seed=1).fingerprint in seen_melodies
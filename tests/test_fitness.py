@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+import fitness
+from helpers import make_melody
+from melody import Melody
+from mutator import Mutator
+
+
+def test_batch_splices_children_into_their_parent():
+    parent = make_melody(64)
+    children = Mutator(seed_melody=parent, mutation_percentage=20).mutate_batch(50, rng=1)
+    spliced = fitness.MelodyBatch(children)
+    encoded = fitness.MelodyBatch([Melody(child.note_units) for child in children])  # without an origin
+    assert np.array_equal(spliced.lengths, encoded.lengths)
+    assert np.array_equal(spliced.pitches, encoded.pitches)
+    assert np.array_equal(spliced.durations, encoded.durations)
+    assert np.array_equal(spliced.mask, encoded.mask)
+
+
+@pytest.mark.parametrize('name', sorted(fitness.SCORERS))
+def test_scores_are_between_0_and_1(name):
+    melodies = [make_melody(note_count, seed=note_count) for note_count in (1, 2, 3, 16, 64)]
+    scores = fitness.SCORERS[name](fitness.MelodyBatch(melodies))
+    assert scores.shape == (len(melodies),)
+    assert ((scores >= 0) & (scores <= 1)).all()
+
+
+def test_scorers_prefer_what_they_describe():
+    scale = Melody([[[60, 1.0], [62, 1.0], [64, 1.0], [65, 1.0], [67, 1.0]]])
+    leaps = Melody([[[60, 0.75], [73, 1.25], [62, 0.75], [78, 1.25], [66, 0.75]]])
+    batch = fitness.MelodyBatch([scale, leaps])
+    for name in ('interval_size', 'key_conformance', 'rhythmic_regularity', 'contour_smoothness'):
+        scale_score, leaps_score = fitness.SCORERS[name](batch)
+        assert scale_score > leaps_score, name
+
+
+def test_top_k_ranks_by_weighted_score():
+    melodies = [make_melody(16, seed=seed) for seed in range(20)]
+    weights = {'interval_size': 2, 'key_conformance': 1}
+    scores = fitness.score(melodies, weights=weights)
+    best = fitness.top_k(melodies, k=5, weights=weights)
+    assert [melodies.index(melody) for melody in best] == list(np.argsort(-scores, kind='stable')[:5])
+    assert fitness.top_k([], k=5) == []
+
+
+def test_registered_scorers_are_used(monkeypatch):
+    monkeypatch.setitem(fitness.SCORERS, 'length', lambda batch: batch.lengths / batch.lengths.max())
+    melodies = [make_melody(4), make_melody(16)]
+    assert fitness.top_k(melodies, k=1, weights={'length': 1}) == [melodies[1]]
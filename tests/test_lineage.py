@@ -0,0 +1,88 @@
+import os
+import random
+import multiprocessing
+
+import pytest
+
+from helpers import make_melody
+from lineage import LineageStore
+from mutator import FileHandler, MidiMaker, Mutator
+
+
+@pytest.fixture
+def lineage(tmp_path):
+    return LineageStore(str(tmp_path / 'lineage.sqlite3'))
+
+
+def evolve(lineage, generations=10, count=20, operator_weights=None):
+    """Record generations of candidates, selecting one of each; returns (generated melodies, provenance)."""
+    rng = random.Random(1)
+    parent = make_melody(32)
+    lineage.add_selection(parent)
+    melodies = {parent.fingerprint: parent}
+    provenance = {}
+    for _ in range(generations):
+        generation_provenance = {}
+        candidates = Mutator(seed_melody=parent, mutation_percentage=20, rng=rng,
+                             operator_weights=operator_weights).generate_unique(count, provenance=generation_provenance)
+        lineage.add_candidates(parent, candidates, provenance=generation_provenance)
+        for candidate in candidates:
+            melodies[candidate.fingerprint] = candidate
+            provenance[candidate.fingerprint] = parent, generation_provenance[candidate.fingerprint]
+        parent = candidates[rng.randrange(len(candidates))]
+        lineage.add_selection(parent)
+    return melodies, provenance
+
+
+def test_melody_replays_deltas(lineage):
+    melodies, _ = evolve(lineage)
+    for fingerprint, melody in melodies.items():
+        assert lineage.melody(fingerprint) == melody
+    assert lineage.melody('0' * 32) is None
+
+
+def test_replay_returns_the_selections(lineage):
+    melodies, _ = evolve(lineage, generations=5)
+    replayed = lineage.replay()
+    assert [step for step, _ in replayed] == [1, 2, 3, 4, 5, 6]
+    assert [fingerprint for _, fingerprint in lineage.steps()] == [melody.fingerprint for _, melody in replayed]
+    assert all(melody.fingerprint in melodies for _, melody in replayed)
+
+
+@pytest.mark.parametrize('operator_weights', [None, (10, 200, 30, 5)])
+def test_provenance_regenerates_candidates(lineage, operator_weights):
+    _, provenance = evolve(lineage, generations=3, operator_weights=operator_weights)
+    for fingerprint, (parent, _) in provenance.items():
+        delta, (rng_seed, batch_size, batch_position, mutation_percentage, weights) = lineage.edge(
+            fingerprint, parent.fingerprint)
+        assert weights == operator_weights
+        regenerated = Mutator(parent, mutation_percentage, operator_weights=weights).mutate_batch_deltas(
+            batch_size, rng=rng_seed)[batch_position]
+        assert regenerated == delta
+        assert parent.apply(regenerated).fingerprint == fingerprint
+
+
+def backfill(root_directory, barrier):
+    barrier.wait()
+    os._exit(FileHandler(root_directory=root_directory).lineage.step_count())
+
+
+def test_concurrent_processes_backfill_once(root_directory):
+    root_directory = str(root_directory)
+    steps = ['1^60-1p0.mid', '2^60-2p0.mid', '3^62-1p0.mid']
+    os.makedirs(os.path.join(root_directory, 'progression'))
+    os.makedirs(os.path.join(root_directory, 'seed_file'))
+    for filename in steps:
+        with open(os.path.join(root_directory, 'progression', filename), 'wb') as output_file:
+            output_file.write(MidiMaker(melody=FileHandler.filename_to_list(filename.split('^')[1])).to_bytes())
+    with open(os.path.join(root_directory, 'seed_file', '64-1p0.mid'), 'wb') as output_file:
+        output_file.write(MidiMaker(melody=FileHandler.filename_to_list('64-1p0.mid')).to_bytes())
+    context = multiprocessing.get_context('fork')
+    barrier = context.Barrier(4)
+    processes = [context.Process(target=backfill, args=(root_directory, barrier)) for _ in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert [process.exitcode for process in processes] == [4] * 4
+    assert LineageStore(os.path.join(root_directory, 'lineage.sqlite3')).step_count() == 4
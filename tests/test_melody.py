@@ -0,0 +1,126 @@
+import struct
+import pickle
+import hashlib
+
+import pytest
+
+from helpers import make_melody
+from melody import Melody, NoteUnit, delta_from_bytes, delta_to_bytes
+
+
+def test_note_unit_iterates_as_notes():
+    notes = [(60, 0.5), (62, 1.0), (64, 1 / 3)]
+    note_unit = NoteUnit(notes)
+    assert len(note_unit) == 3
+    assert list(note_unit) == [(60, 0.5), (62, 1.0), (64, pytest.approx(1 / 3))]
+    assert note_unit[1] == (62, 1.0)
+    assert note_unit.to_list() == [[60, 0.5], [62, 1.0], [64, pytest.approx(1 / 3)]]
+
+
+def test_note_unit_from_generator():
+    notes = [(60, 0.5), (62, 1.0)]
+    assert NoteUnit(note for note in notes) == NoteUnit(notes)
+    assert list(NoteUnit(note for note in notes)) == notes
+
+
+@pytest.mark.parametrize('pitch', [-1, 128])
+def test_note_unit_rejects_pitches_outside_the_midi_range(pitch):
+    with pytest.raises(ValueError):
+        NoteUnit([[pitch, 1.0]])
+
+
+def test_melody_equality_and_hash():
+    melody = make_melody(32)
+    copy = Melody(melody.to_list())
+    assert copy == melody
+    assert hash(copy) == hash(melody)
+    assert {melody, copy} == {melody}
+    assert make_melody(32, seed=1) != melody
+
+
+def test_melody_to_list_round_trip():
+    melody = make_melody(32)
+    assert Melody(melody.to_list()).to_list() == melody.to_list()
+    assert sum(len(note_unit) for note_unit in melody) == len(melody.pitches) == len(melody.ticks) == 32
+
+
+def test_melody_pickles():
+    melody = make_melody(32)
+    assert pickle.loads(pickle.dumps(melody)) == melody
+
+
+FINGERPRINT = '878cc4830e50315d6307d49c1d437922'  # of [[48, 1.0]], [[51, 0.25], [53, 200.0]]
+
+
+def test_fingerprint_digests_little_endian_notes():
+    melody = Melody([[[48, 1.0]], [[51, 0.25], [53, 200.0]]])
+    note_unit_digests = [
+        hashlib.blake2b(struct.pack('<I', 1) + struct.pack('<b', 48) + struct.pack('<i', 960), digest_size=16),
+        hashlib.blake2b(struct.pack('<I', 2) + struct.pack('<2b', 51, 53) + struct.pack('<2i', 240, 192000),
+                        digest_size=16),
+    ]
+    digest = hashlib.blake2b(b''.join(digest.digest() for digest in note_unit_digests), digest_size=16)
+    assert melody.fingerprint == digest.hexdigest()
+    assert Melody(melody.to_list()).fingerprint == melody.fingerprint
+
+
+def test_fingerprint_is_stable():
+    # fingerprints name files and key the lineage, so the format must not change
+    assert Melody([[[48, 1.0]], [[51, 0.25], [53, 200.0]]]).fingerprint == FINGERPRINT
+    assert make_melody(8).fingerprint == make_melody(8).fingerprint
+    assert make_melody(8).fingerprint != make_melody(8, seed=1).fingerprint
+
+
+def test_fingerprint_only_digests_changed_note_units():
+    parent = make_melody(64)
+    parent.fingerprint
+    child = parent.apply([(3, NoteUnit([[61, 0.5]])), (10, NoteUnit([[62, 0.5]]))])
+    assert [note_unit._digest is None for note_unit in child] == [index in (3, 10) for index in range(len(child))]
+    assert child.fingerprint == Melody(child.to_list()).fingerprint
+
+
+@pytest.mark.parametrize('note_count', [1, 8, 200])
+def test_bytes_round_trip(note_count):
+    melody = make_melody(note_count)
+    assert Melody.from_bytes(melody.to_bytes()) == melody
+    assert Melody.from_base64(melody.to_base64()) == melody
+
+
+def test_bytes_round_trip_long_durations():
+    melody = Melody([[[60, 1.0]], [[62, 100.0], [64, 0.25]]])  # too many ticks for 16 bits
+    decoded = Melody.from_bytes(melody.to_bytes())
+    assert decoded == melody
+    assert decoded.to_list() == melody.to_list()
+
+
+@pytest.mark.parametrize('data', [b'', b'\x01', Melody([[[60, 1.0]]]).to_bytes()[:-1]])
+def test_from_bytes_rejects_truncated_data(data):
+    with pytest.raises(ValueError):
+        Melody.from_bytes(data)
+
+
+def test_from_bytes_rejects_pitches_outside_the_midi_range():
+    data = bytearray(Melody([[[60, 1.0]]]).to_bytes())
+    data[data.index(60)] = 0x80  # -128 as an int8
+    with pytest.raises(ValueError):
+        Melody.from_bytes(bytes(data))
+
+
+@pytest.mark.parametrize('text', ['', 'not base64!'])
+def test_from_base64_rejects_corrupt_text(text):
+    with pytest.raises(ValueError):
+        Melody.from_base64(text)
+
+
+def test_delta_round_trip():
+    parent = make_melody(64)
+    child = parent.apply([(0, NoteUnit([[61, 0.5], [63, 200.0]])), (5, NoteUnit([[70, 1 / 3]]))])
+    delta = delta_from_bytes(delta_to_bytes(child.diff(parent)))
+    assert parent.apply(delta) == child
+    assert delta_from_bytes(delta_to_bytes([])) == []
+
+
+def test_delta_from_bytes_rejects_truncated_data():
+    data = delta_to_bytes([(0, NoteUnit([[61, 0.5], [63, 2.0]]))])
+    with pytest.raises(ValueError):
+        delta_from_bytes(data[:-1])
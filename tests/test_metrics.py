@@ -0,0 +1,42 @@
+import metrics
+from helpers import make_melody
+from mutator import CANDIDATES_DRAWN, Mutator
+
+
+def test_counter():
+    counter = metrics.Counter('test_total', 'Things counted.')
+    counter.inc()
+    counter.inc(2, reason='seen')
+    counter.inc(reason='seen')
+    assert counter.get() == 1
+    assert counter.get(reason='seen') == 3
+    assert counter.render() == [
+        '# HELP test_total Things counted.', '# TYPE test_total counter', 'test_total 1',
+        'test_total{reason="seen"} 3']
+
+
+def test_histogram():
+    histogram = metrics.Histogram('test_seconds', 'Time taken.', buckets=(0.1, 1.0))
+    histogram.observe(0.05, method='a')
+    histogram.observe(0.5, method='a')
+    assert histogram.render() == [
+        '# HELP test_seconds Time taken.', '# TYPE test_seconds histogram',
+        'test_seconds_bucket{method="a",le="0.1"} 1', 'test_seconds_bucket{method="a",le="1.0"} 2',
+        'test_seconds_bucket{method="a",le="+Inf"} 2', 'test_seconds_sum{method="a"} 0.55',
+        'test_seconds_count{method="a"} 2']
+
+
+def test_histogram_times_calls():
+    histogram = metrics.Histogram('test_seconds', 'Time taken.')
+
+    @histogram.time(method='double')
+    def double(value):
+        return value * 2
+    assert double(2) == 4
+    assert histogram.values[(('method', 'double'),)][-1] == 1
+
+
+def test_generation_is_counted():
+    drawn = CANDIDATES_DRAWN.get()
+    Mutator(seed_melody=make_melody(16), mutation_percentage=20).generate_unique(50)
+    assert CANDIDATES_DRAWN.get() >= drawn + 50
@@ -0,0 +1,114 @@
+import random
+
+import pytest
+
+from helpers import make_melody
+from melody import Melody
+from mutator import BloomFilter, MidiMaker, Mutator
+
+
+def changed_note_units(parent, children):
+    """Return the mean number of note_units that differ from parent's, per child."""
+    return sum(len(child.diff(parent)) for child in children) / len(children)
+
+
+def test_mutate_batch_is_reproducible():
+    mutator = Mutator(seed_melody=make_melody(64), mutation_percentage=20)
+    assert mutator.mutate_batch(100, rng=7) == mutator.mutate_batch(100, rng=7)
+    assert mutator.mutate_batch(100, rng=7) != mutator.mutate_batch(100, rng=8)
+
+
+@pytest.mark.parametrize('operator_weights', [None, (1, 1, 1, 1)])
+def test_mutate_batch_matches_mutate(operator_weights):
+    parent = make_melody(64)
+    mutator = Mutator(seed_melody=parent, mutation_percentage=20, rng=random.Random(1),
+                      operator_weights=operator_weights)
+    batch = changed_note_units(parent, mutator.mutate_batch(2000, rng=1))
+    scalar = changed_note_units(parent, [mutator.mutate() for _ in range(2000)])
+    assert batch == pytest.approx(scalar, rel=0.1)
+
+
+@pytest.mark.parametrize('unit_length', [63, 64, 100])
+def test_long_note_unit_joins_match_mutate(unit_length):
+    parent = Melody([[[60 + i % 12, 0.25] for i in range(unit_length)], [[60, 1.0]]])
+    mutator = Mutator(seed_melody=parent, mutation_percentage=100, rng=random.Random(1),
+                      operator_weights=(0, 0, 1, 0))  # joins only
+
+    def joined_notes(children):
+        return sum(unit_length - len(child[0]) + 1 for child in children) / len(children)
+    batch = mutator.mutate_batch(2000, rng=1)
+    scalar = [mutator.mutate() for _ in range(2000)]
+    # two notes are joined half of the time, three a quarter of the time, ...
+    assert joined_notes(batch) == pytest.approx(3, abs=0.2)
+    assert joined_notes(scalar) == pytest.approx(3, abs=0.2)
+    assert len(mutator.generate_unique(50)) == 50
+
+
+def test_bloom_filter():
+    fingerprints = [melody.fingerprint for melody in Mutator(make_melody(32), 20).mutate_batch(1000, rng=1)]
+    bloom_filter = BloomFilter()
+    for fingerprint in fingerprints[:500]:
+        bloom_filter.add(fingerprint)
+    assert all(fingerprint in bloom_filter for fingerprint in fingerprints[:500])
+    assert sum(fingerprint in bloom_filter for fingerprint in set(fingerprints[500:]) - set(fingerprints[:500])) < 5
+
+
+def test_bloom_filter_save_load_and_update(tmp_path):
+    first, second = BloomFilter(), BloomFilter()
+    first.add(make_melody(8).fingerprint)
+    second.add(make_melody(8, seed=1).fingerprint)
+    second.save(str(tmp_path / 'seen.bloom'))
+    first.update(BloomFilter.load(str(tmp_path / 'seen.bloom')))
+    assert make_melody(8).fingerprint in first
+    assert make_melody(8, seed=1).fingerprint in first
+    with pytest.raises(ValueError):
+        first.update(BloomFilter(size_in_bits=2**10))
+
+
+def test_generate_unique_deduplicates():
+    parent = make_melody(4)
+    melodies = Mutator(seed_melody=parent, mutation_percentage=5, rng=random.Random(1)).generate_unique(200)
+    fingerprints = [melody.fingerprint for melody in melodies]
+    assert len(set(fingerprints)) == len(fingerprints) == 200
+    assert parent.fingerprint not in fingerprints
+
+
+def test_generate_unique_skips_seen_melodies():
+    mutator = Mutator(seed_melody=make_melody(16), mutation_percentage=20, rng=random.Random(1))
+    seen = BloomFilter()
+    for melody in mutator.generate_unique(100):
+        seen.add(melody.fingerprint)
+    assert not any(melody.fingerprint in seen for melody in mutator.generate_unique(100, seen=seen))
+
+
+class Everything(object):
+    def __contains__(self, fingerprint):
+        return True
+
+
+def test_generate_unique_stops_at_its_retry_budget():
+    mutator = Mutator(seed_melody=make_melody(16), mutation_percentage=20, rng=random.Random(1))
+    drawn = []
+    original_mutate_batch = mutator.mutate_batch
+    mutator.mutate_batch = lambda n, rng=None: drawn.append(n) or original_mutate_batch(n, rng=rng)
+    assert mutator.generate_unique(10, seen=Everything(), max_attempts=250) == []
+    assert sum(drawn) == 250
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_native_encoder_matches_midiutil(seed):
+    melody = make_melody(1 + seed * 10, seed=seed, durations=[0.25, 0.5, 0.75, 1.0, 1.5, 2.0, 1 / 3, 100.0])
+    assert MidiMaker(melody=melody).verify_native_encoder()
+
+
+def test_native_encoder_matches_midiutil_for_mutations():
+    for child in Mutator(seed_melody=make_melody(32), mutation_percentage=50).mutate_batch(50, rng=1):
+        assert MidiMaker(melody=child).verify_native_encoder()
+
+
+def test_mutate_is_reproducible():
+    def mutations(seed):
+        mutator = Mutator(seed_melody=make_melody(64), mutation_percentage=20, rng=random.Random(seed))
+        return [mutator.mutate() for _ in range(50)]
+    assert mutations(1) == mutations(1)
+    assert mutations(1) != mutations(2)
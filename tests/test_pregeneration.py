@@ -0,0 +1,78 @@
+import threading
+
+import pytest
+
+from helpers import make_melody
+from pregeneration import CandidatePregenerator
+
+
+@pytest.fixture
+def pregenerator():
+    pregenerator = CandidatePregenerator(pool_size=20, mutation_percentage=20, max_workers=1)
+    yield pregenerator
+    pregenerator.shutdown()
+
+
+def wait(pregenerator, group=None):
+    for future in list(pregenerator.pending[group].values()):
+        future.result()
+
+
+def test_take_returns_the_scheduled_pool(pregenerator):
+    seed_melodies = [make_melody(16, seed=seed) for seed in range(3)]
+    pregenerator.schedule(seed_melodies)
+    wait(pregenerator)
+    pool, provenance = pregenerator.take(seed_melodies[1])
+    assert len(pool) == 20
+    assert set(provenance) == {melody.fingerprint for melody in pool}
+    assert all(len(melody) == len(seed_melodies[1]) for melody in pool)
+    assert pregenerator.take(seed_melodies[1]) is None  # handed over only once
+    assert pregenerator.take(make_melody(16, seed=10)) is None
+
+
+def test_groups_are_separate(pregenerator):
+    seed_melody = make_melody(16)
+    pregenerator.schedule([seed_melody], group='first')
+    wait(pregenerator, 'first')
+    assert pregenerator.take(seed_melody, group='second') is None
+    assert pregenerator.take(seed_melody, group='first') is not None
+
+
+def test_rescheduling_keeps_pools_only_for_the_same_settings(pregenerator):
+    seed_melody = make_melody(16)
+    pregenerator.schedule([seed_melody])
+    future = pregenerator.pending[None][(seed_melody.fingerprint, 20, None)]
+    pregenerator.schedule([seed_melody])
+    assert pregenerator.pending[None][(seed_melody.fingerprint, 20, None)] is future
+    pregenerator.schedule([seed_melody], mutation_percentage=5, operator_weights=(1, 2, 3, 4))
+    assert list(pregenerator.pending[None]) == [(seed_melody.fingerprint, 5, (1, 2, 3, 4))]
+
+
+def test_least_recently_used_groups_are_dropped(pregenerator):
+    pregenerator.max_groups = 2
+    seed_melody = make_melody(16)
+    for group in ('first', 'second'):
+        pregenerator.schedule([seed_melody], group=group)
+    pregenerator.take(make_melody(4), group='first')  # uses 'first'
+    pregenerator.schedule([seed_melody], group='third')
+    assert list(pregenerator.pending) == ['first', 'third']
+
+
+def test_concurrent_schedule_and_take(pregenerator):
+    pregenerator.max_groups = 2
+    seed_melodies = [make_melody(4, seed=seed) for seed in range(4)]
+    errors = []
+
+    def request(group):
+        try:
+            for seed_melody in seed_melodies * 25:
+                pregenerator.schedule([seed_melody], group=group)
+                pregenerator.take(seed_melody, group=group, timeout=0)
+        except Exception as error:
+            errors.append(error)
+    threads = [threading.Thread(target=request, args=(group,)) for group in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
@@ -0,0 +1,66 @@
+import random
+
+import pytest
+
+from helpers import make_melody
+from lineage import LineageStore
+from mutator import Mutator
+from scheduler import MutationScheduler
+
+
+@pytest.fixture
+def scheduler(tmp_path):
+    return MutationScheduler(LineageStore(str(tmp_path / 'lineage.sqlite3')), rng=0)
+
+
+def offer(scheduler, parent, mutation_percentage=5, count=20):
+    provenance = {}
+    candidates = Mutator(seed_melody=parent, mutation_percentage=mutation_percentage,
+                         rng=random.Random(0)).generate_unique(count, provenance=provenance)
+    scheduler.lineage.add_candidates(parent, candidates, provenance=provenance)
+    scheduler.record_offered(parent, candidates, provenance=provenance)
+    return candidates
+
+
+def test_record_offered_counts_trials(scheduler):
+    candidates = offer(scheduler, make_melody(32), count=20)
+    statistics = scheduler.statistics()
+    assert statistics['rate'] == {'5': (0, 20)}
+    assert sum(trials for _, trials in statistics['operator'].values()) >= len(candidates)
+
+
+def test_record_offered_discounts_earlier_observations(scheduler):
+    parent = make_melody(32)
+    offer(scheduler, parent, count=10)
+    offer(scheduler, parent, count=10)
+    assert scheduler.statistics()['rate']['5'] == (0, pytest.approx(10 * MutationScheduler.DISCOUNT + 10))
+
+
+def test_record_selection_counts_successes(scheduler):
+    parent = make_melody(32)
+    candidates = offer(scheduler, parent)
+    assert scheduler.record_selection(parent, candidates[3])
+    statistics = scheduler.statistics()
+    assert statistics['rate']['5'][0] == 1
+    assert sum(successes for successes, _ in statistics['operator'].values()) >= 1
+
+
+def test_record_selection_ignores_melodies_not_generated_from_parent(scheduler):
+    parent = make_melody(32)
+    offer(scheduler, parent)
+    assert not scheduler.record_selection(parent, parent)
+    assert not scheduler.record_selection(parent, make_melody(32, seed=1))
+    assert scheduler.statistics()['rate']['5'][0] == 0
+
+
+def test_choose(scheduler):
+    mutation_percentage, operator_weights = scheduler.choose()
+    assert mutation_percentage in MutationScheduler.RATES
+    assert operator_weights is None  # too few successes to adapt the operators
+    parent = make_melody(32)
+    for _ in range(MutationScheduler.MIN_OPERATOR_SUCCESSES + 1):
+        candidates = offer(scheduler, parent)
+        scheduler.record_selection(parent, candidates[0])
+    mutation_percentage, operator_weights = scheduler.choose()
+    assert len(operator_weights) == len(Mutator.OPERATORS)
+    assert all(1 <= weight <= 255 for weight in operator_weights)